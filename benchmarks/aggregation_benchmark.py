@@ -0,0 +1,84 @@
+""" Benchmark of the engines of project_starter_lib.aggregation against pandas groupby
+
+Covers the three paths with synthetic data:
+- dense: int16 keys as in schemas.INPUT_AGG_FILE, and two small integer keys
+- sort: int64 keys spread over a wide range, already sorted
+- hash: the same keys unsorted, and string keys
+Every engine which can aggregate a case is timed, and its result is checked against pandas.
+
+Run from the root directory:
+	python -m benchmarks.aggregation_benchmark --n-rows 10000000
+"""
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+from project_starter_lib.aggregation import aggregate, choose_engine, AGGREGATIONS
+
+N_KEYS = 1000
+
+
+def generate_data(n_rows: int, seed: int = 0) -> pd.DataFrame:
+	rng = np.random.default_rng(seed)
+	keys = rng.integers(0, N_KEYS, n_rows)
+	return pd.DataFrame({
+		'Key'      : keys.astype('int16'),
+		'WideKey'  : keys.astype('int64') * 1_000_003_000,
+		'SecondKey': rng.integers(0, 10, n_rows).astype('int8'),
+		'StringKey': pd.Series(keys).astype(str).to_numpy(dtype=object),
+		'Value'    : rng.integers(0, 1000, n_rows).astype('int32'),
+		'Price'    : rng.random(n_rows),
+	})
+
+
+# Case -> (group by columns, whether the data is sorted by them)
+CASES = {
+	'int16 key'             : (['Key'], False),
+	'two small integer keys': (['SecondKey', 'Key'], False),
+	'sorted wide int64 key' : (['WideKey'], True),
+	'wide int64 key'        : (['WideKey'], False),
+	'string key'            : (['StringKey'], False),
+}
+
+
+def _best_of(function, repeat):
+	""" Fastest of repeat runs in seconds, and the result """
+	timings = []
+	for _ in range(repeat):
+		start_time = time.perf_counter()
+		result = function()
+		timings.append(time.perf_counter() - start_time)
+	return min(timings), result
+
+
+@click.command()
+@click.option("--n-rows", default=1_000_000, show_default=True, help="Number of rows")
+@click.option("--repeat", default=3, show_default=True, help="Number of runs per engine. The fastest is kept")
+def run(n_rows, repeat):
+	""" Run the benchmark """
+	df_unsorted = generate_data(n_rows)
+	agg_spec = {'Value': 'sum', 'Price': 'mean'}
+	print(f"{n_rows} rows, aggregations {agg_spec}. Supported aggregations: {AGGREGATIONS}")
+
+	for case, (group_by_cols, is_sorted) in CASES.items():
+		df = df_unsorted.sort_values(group_by_cols, ignore_index=True) if is_sorted else df_unsorted
+		pandas_seconds, expected = _best_of(lambda: df.groupby(group_by_cols, as_index=False).agg(agg_spec), repeat)
+		print(f"{case}{' (sorted)' if is_sorted else ''}: auto chooses {choose_engine(df, group_by_cols, agg_spec)}")
+		print(f"\t{'pandas groupby':<16} {pandas_seconds:8.3f}s")
+
+		for engine in ['dense', 'sort', 'hash']:
+			# Only engines which can aggregate the case, other engines fall back to them
+			if engine == 'dense' and choose_engine(df, group_by_cols, agg_spec) != 'dense':
+				continue
+			if engine == 'sort' and not all(pd.api.types.is_numeric_dtype(df[col]) for col in group_by_cols):
+				continue
+			seconds, result = _best_of(lambda: aggregate(df, group_by_cols, agg_spec, engine=engine), repeat)
+			# Integer sums are int64 whatever their values, unlike the ones of pandas
+			pd.testing.assert_frame_equal(result, expected, check_exact=False, check_dtype=False)
+			print(f"\t{engine + ' engine':<16} {seconds:8.3f}s {pandas_seconds / seconds:6.1f}x")
+
+
+if __name__ == "__main__":
+	run()
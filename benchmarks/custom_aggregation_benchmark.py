@@ -0,0 +1,72 @@
+""" Benchmark of the vectorized custom aggregations of project_starter_lib.utils against the per group functions
+
+Times second_last, mode_avg and mode_min against grouped.agg of custom_agg_pandas_second_last, mode_avg_custom and
+mode_max_custom, which pandas calls once per group, and checks that the results are identical, also their dtypes, for
+integer, float and bool columns.
+
+Run from the root directory:
+	python -m benchmarks.custom_aggregation_benchmark --n-rows 1000000 --n-groups 100000
+"""
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+from project_starter_lib import utils
+
+# Vectorized aggregation -> per group function it replaces
+PAIRS = {
+	'second_last': utils.custom_agg_pandas_second_last,
+	'mode_avg'   : utils.mode_avg_custom,
+	'mode_min'   : utils.mode_max_custom,
+}
+
+
+def generate_data(n_rows: int, n_groups: int, seed: int = 0) -> pd.DataFrame:
+	"""
+	Few distinct values per group so that there are tied modes, some missing values, and some groups with a single
+	row
+	"""
+	rng = np.random.default_rng(seed)
+	values = rng.integers(0, 5, n_rows).astype('float64')
+	values[rng.random(n_rows) < 0.05] = np.nan
+	keys = rng.integers(0, n_groups, n_rows)
+	keys[:n_groups // 10] = np.arange(n_groups, n_groups + n_groups // 10)
+	return pd.DataFrame({
+		'Key'    : keys,
+		'Units'  : rng.integers(0, 5, n_rows),
+		'Units32': rng.integers(0, 5, n_rows).astype('int32'),
+		'Price'  : values,
+		'Price32': values.astype('float32'),
+		'Flag'   : rng.random(n_rows) < 0.5,
+	})
+
+
+def _timed(function):
+	start_time = time.perf_counter()
+	result = function()
+	return time.perf_counter() - start_time, result
+
+
+@click.command()
+@click.option("--n-rows", default=200_000, show_default=True, help="Number of rows")
+@click.option("--n-groups", default=20_000, show_default=True, help="Number of groups")
+def run(n_rows, n_groups):
+	""" Run the benchmark """
+	df = generate_data(n_rows, n_groups)
+	grouped = df.groupby('Key')
+	print(f"{n_rows} rows, {grouped.ngroups} groups")
+
+	for col in ['Units', 'Units32', 'Price', 'Price32', 'Flag']:
+		for name, per_group_function in PAIRS.items():
+			per_group_seconds, expected = _timed(lambda: grouped[col].agg(per_group_function))
+			seconds, result = _timed(lambda: utils.CUSTOM_AGGREGATIONS[name](grouped[col]))
+			pd.testing.assert_series_equal(result, expected, check_exact=True)
+			column = f"{col} ({df[col].dtype})"
+			print(f"{column:<16} {name:<12} {per_group_function.__name__:<30} {per_group_seconds:8.3f}s "
+				  f"vectorized {seconds:8.3f}s {per_group_seconds / seconds:8.1f}x")
+
+
+if __name__ == "__main__":
+	run()
@@ -0,0 +1,336 @@
+""" Benchmark of the data layer: load/save, schema checks, ingest, aggregation and copy_to_latest
+
+Synthetic data matching schemas.INPUT_INGEST_FILE is generated at every scale and each scenario is run against the local
+filesystem (LocalStorageHandler) and a local S3 stand-in (moto server). Every measurement runs in a fresh process, which
+only does the measured work, so that peak RSS is not affected by other scenarios. Data needed by a scenario, e.g. the
+input file of ingest, is prepared in a separate process before.
+
+For every scenario the wall clock time, peak RSS of the process and the bytes read and written are recorded and compared
+against a baseline. The command fails if a scenario fails, has no baseline, or is slower or uses more memory than the
+baseline by more than the threshold.
+
+Needs `moto[server]` installed in addition to requirements.txt for the s3 backend. Run from the root directory:
+	python -m benchmarks.data_layer_benchmark --scales 1e5,1e6 --backends local,s3
+	python -m benchmarks.data_layer_benchmark --scales 1e5,1e6 --update-baseline
+"""
+import json
+import logging
+import os
+import platform
+import resource
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+import click
+import numpy as np
+import pandas as pd
+
+SCENARIOS = [
+	'save_csv',
+	'load_csv',
+	'save_parquet',
+	'load_parquet',
+	'clean_checks',
+	'ingest',
+	'aggregate',
+	'copy_to_latest',
+]
+BACKENDS = ['local', 's3']
+BUCKET_NAME = "benchmark-bucket"
+DEFAULT_BASELINE_PATH = 'benchmarks/baselines/data_layer.json'
+
+# Number of distinct values of integer columns, e.g. the number of keys to aggregate by
+N_DISTINCT = 1000
+
+
+def generate_data(schema: dict, n_rows: int, seed: int = 0) -> pd.DataFrame:
+	"""
+	Synthetic data frame with the columns and dtypes of a schema. The same seed always generates the same data
+	:param schema:
+	:param n_rows:
+	:param seed:
+	:return:
+	"""
+	rng = np.random.default_rng(seed)
+	columns = {}
+	for col, dtype in schema.items():
+		dtype = str(dtype)
+		if dtype.startswith('int'):
+			columns[col] = rng.integers(0, N_DISTINCT, n_rows).astype(dtype)
+		elif dtype.startswith('float'):
+			columns[col] = rng.random(n_rows).astype(dtype)
+		elif dtype.startswith('datetime'):
+			columns[col] = pd.Timestamp('2021-01-01') + pd.to_timedelta(rng.integers(0, 365, n_rows), unit='D')
+		elif dtype == 'bool':
+			columns[col] = rng.random(n_rows) > 0.5
+		else:
+			columns[col] = pd.Series(rng.integers(0, N_DISTINCT, n_rows)).astype(str).astype(dtype)
+	return pd.DataFrame(columns)
+
+
+def _quiet_logs():
+	# Per file and per request logs would dominate the timings
+	for logger_name in ["werkzeug", "project_starter_lib", "botocore", "aiobotocore", "s3transfer"]:
+		logging.getLogger(logger_name).setLevel(logging.WARNING)
+
+
+def _data_store_path(n_rows: int, file_format: str) -> str:
+	return f'benchmark/{n_rows}/data.{file_format}'
+
+
+def _input_file_path(n_rows: int) -> str:
+	return f'benchmark/{n_rows}/input_file.csv'
+
+
+def _setup_pipelines():
+	""" Pipelines sharing one AllDataStores, as set up by main_runner """
+	from project_starter_lib.constants import PIPELINE_INGEST_SOURCE_DATA, PIPELINE_AGG_DATA
+	from project_starter_lib.data.data_stores import AllDataStores
+	from project_starter_lib.pipelines import IngestSourceData, AggData
+
+	pipelines = {
+		PIPELINE_INGEST_SOURCE_DATA: IngestSourceData(PIPELINE_INGEST_SOURCE_DATA),
+		PIPELINE_AGG_DATA          : AggData(PIPELINE_AGG_DATA),
+	}
+	all_data_stores = AllDataStores({name: pipeline.current_run_id for name, pipeline in pipelines.items()})
+	for pipeline in pipelines.values():
+		pipeline.all_data_stores = all_data_stores
+	return pipelines[PIPELINE_INGEST_SOURCE_DATA], pipelines[PIPELINE_AGG_DATA]
+
+
+def _size(prefix: str) -> int:
+	""" Bytes of all objects under a prefix """
+	from project_starter_lib.config import config
+	return sum(x.size for x in config.STORAGE_HANDLER.list_object_infos(prefix=prefix))
+
+
+def _prepare(scenario: str, n_rows: int, seed: int) -> dict:
+	""" Write the data a scenario reads. Runs in its own process. Returns what the measuring process needs to know """
+	_quiet_logs()
+	from project_starter_lib.config import config
+	from project_starter_lib.constants import TASK_INGEST_FILE
+	from project_starter_lib.data import schemas
+	from project_starter_lib.data.data_stores import DataStore
+	from project_starter_lib.tasks.ingest_source_data.ingest_file import IngestFile
+
+	if scenario.startswith('load_'):
+		data_store = DataStore(file_name=_data_store_path(n_rows, scenario.split('_')[1]), flag_copy_to_latest=False)
+		data_store.data = generate_data(schemas.INPUT_INGEST_FILE, n_rows, seed=seed)
+
+	if scenario in ['ingest', 'aggregate', 'copy_to_latest']:
+		DataStore(file_name=_input_file_path(n_rows), flag_copy_to_latest=False).data = \
+			generate_data(schemas.INPUT_INGEST_FILE, n_rows, seed=seed)
+
+	if scenario in ['aggregate', 'copy_to_latest']:
+		config.INPUT_FILE = _input_file_path(n_rows)
+		ingest_pipeline, _ = _setup_pipelines()
+		IngestFile(task_name=TASK_INGEST_FILE, pipeline=ingest_pipeline).run_task()
+		return {'ingest_run_id': ingest_pipeline.current_run_id}
+
+	return {}
+
+
+def _measure(scenario: str, n_rows: int, seed: int, prepared: dict) -> dict:
+	""" Run a scenario and measure it. Runs in its own process """
+	_quiet_logs()
+	from project_starter_lib.config import config
+	from project_starter_lib.constants import TASK_INGEST_FILE, TASK_AGG_FILE
+	from project_starter_lib.data import schemas
+	from project_starter_lib.data.data_stores import DataStore, checks, clean
+	from project_starter_lib.tasks.agg_data.agg_file import AggFile
+	from project_starter_lib.tasks.ingest_source_data.ingest_file import IngestFile
+
+	ingest_pipeline, agg_pipeline = _setup_pipelines()
+	all_data_stores = ingest_pipeline.all_data_stores
+	config.INPUT_FILE = _input_file_path(n_rows)
+
+	# Inputs which are generated in memory are not part of the measurement
+	df = None
+	if scenario.startswith('save_') or scenario == 'clean_checks':
+		df = generate_data(schemas.INPUT_INGEST_FILE, n_rows, seed=seed)
+
+	start_time = time.perf_counter()
+	if scenario.startswith('save_'):
+		path = _data_store_path(n_rows, scenario.split('_')[1])
+		DataStore(file_name=path, flag_copy_to_latest=False).data = df
+		seconds = time.perf_counter() - start_time
+		bytes_moved = _size(path)
+	elif scenario.startswith('load_'):
+		path = _data_store_path(n_rows, scenario.split('_')[1])
+		_ = DataStore(file_name=path, schema=schemas.INPUT_INGEST_FILE, flag_copy_to_latest=False).data
+		seconds = time.perf_counter() - start_time
+		bytes_moved = _size(path)
+	elif scenario == 'clean_checks':
+		checks(clean(df, schemas.INPUT_INGEST_FILE), schemas.INPUT_INGEST_FILE)
+		seconds = time.perf_counter() - start_time
+		bytes_moved = int(df.memory_usage(index=False).sum())
+	elif scenario == 'ingest':
+		IngestFile(task_name=TASK_INGEST_FILE, pipeline=ingest_pipeline).run_task()
+		seconds = time.perf_counter() - start_time
+		bytes_moved = _size(config.INPUT_FILE) + _size(
+			all_data_stores.ingest_file.create_file_path(run_id=ingest_pipeline.current_run_id))
+	elif scenario == 'aggregate':
+		AggFile(task_name=TASK_AGG_FILE, pipeline=agg_pipeline).run_task()
+		seconds = time.perf_counter() - start_time
+		bytes_moved = _size(all_data_stores.ingest_file.create_file_path(run_id=prepared['ingest_run_id'])) + _size(
+			all_data_stores.aggregated_file.create_file_path(run_id=agg_pipeline.current_run_id))
+	elif scenario == 'copy_to_latest':
+		summary = all_data_stores.ingest_file.copy_to_latest(run_id=prepared['ingest_run_id'])
+		seconds = time.perf_counter() - start_time
+		bytes_moved = summary.bytes_copied
+	else:
+		raise NotImplementedError(f"Unknown scenario {scenario}")
+
+	return {
+		'seconds'    : seconds,
+		# ru_maxrss is in kilobytes on linux
+		'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+		'bytes'      : int(bytes_moved),
+	}
+
+
+def _in_new_process(function, *args):
+	""" Run a function in a freshly spawned process, which does not share any memory with this one """
+	with ProcessPoolExecutor(max_workers=1, mp_context=get_context('spawn')) as executor:
+		return executor.submit(function, *args).result()
+
+
+def run_benchmark(backends, scales, scenarios, repeat: int = 1, seed: int = 0) -> dict:
+	"""
+	Run all scenarios at all scales against all backends
+	:return: "{backend}/{scenario}/{n_rows}" -> measurements. For repeated runs the minimum of each measurement is kept.
+		{'error': ...} for scenarios which failed
+	"""
+	results = {}
+	for backend in backends:
+		os.environ['STORAGE_HANDLER'] = backend
+		for n_rows in scales:
+			for scenario in scenarios:
+				key = f"{backend}/{scenario}/{n_rows}"
+				try:
+					prepared = _in_new_process(_prepare, scenario, n_rows, seed)
+					runs = [_in_new_process(_measure, scenario, n_rows, seed, prepared) for _ in range(repeat)]
+				except Exception as e:
+					results[key] = {'error': repr(e)}
+					print(f"{key:<40} failed: {e!r}")
+					continue
+				results[key] = {metric: min(run[metric] for run in runs) for metric in runs[0]}
+				print(f"{key:<40} {results[key]['seconds']:9.3f} s {results[key]['peak_rss_mb']:9.1f} MB "
+					  f"{results[key]['bytes'] / 1024 ** 2:10.1f} MB moved")
+	return results
+
+
+def compare(results: dict, baseline: dict, threshold: float) -> list:
+	"""
+	Scenarios which failed, have no baseline, or are slower or use more memory than in the baseline by more than the
+	threshold
+	:param results:
+	:param baseline:
+	:param threshold: e.g. 0.2 allows 20% more time and memory than the baseline
+	:return: Descriptions of the regressions
+	"""
+	regressions = []
+	for key, result in results.items():
+		if 'error' in result:
+			regressions.append(f"{key} failed: {result['error']}")
+			continue
+		if key not in baseline or 'error' in baseline[key]:
+			regressions.append(f"{key} has no baseline")
+			continue
+		for metric in ['seconds', 'peak_rss_mb']:
+			ratio = result[metric] / max(baseline[key][metric], 1e-9)
+			if ratio > 1 + threshold:
+				regressions.append(
+					f"{key} {metric}: {result[metric]:.3f} vs {baseline[key][metric]:.3f} in baseline ({ratio:.2f}x)")
+	return regressions
+
+
+def environment_info() -> dict:
+	""" What the results depend on besides the code """
+	import pyarrow
+	return {
+		'platform': platform.platform(),
+		'cpu_count': os.cpu_count(),
+		'python': platform.python_version(),
+		'pandas': pd.__version__,
+		'pyarrow': pyarrow.__version__,
+	}
+
+
+@click.command()
+@click.option("--scales", default="1e5,1e6", show_default=True, help="Comma separated numbers of rows, e.g. 1e5,1e8")
+@click.option("--backends", default=",".join(BACKENDS), show_default=True, help="Comma separated storage backends")
+@click.option("--scenarios", default=",".join(SCENARIOS), show_default=True, help="Comma separated scenarios")
+@click.option("--repeat", default=1, show_default=True, help="Number of runs of each scenario. The fastest is kept")
+@click.option("--baseline", "baseline_path", default=DEFAULT_BASELINE_PATH, show_default=True,
+			  help="JSON file with the baseline results")
+@click.option("--threshold", default=0.2, show_default=True, help="Allowed relative regression against the baseline")
+@click.option("--update-baseline", is_flag=True, help="Save the results as the new baseline instead of comparing")
+@click.option("--port", default=5124, show_default=True, help="Port of the moto server")
+def run(scales, backends, scenarios, repeat, baseline_path, threshold, update_baseline, port):
+	""" Run the benchmark """
+	scales = [int(float(x)) for x in scales.split(",")]
+	backends = backends.split(",")
+	scenarios = scenarios.split(",")
+	assert set(backends) <= set(BACKENDS), f"Unknown backends {set(backends) - set(BACKENDS)}"
+	assert set(scenarios) <= set(SCENARIOS), f"Unknown scenarios {set(scenarios) - set(SCENARIOS)}"
+
+	server = None
+	with tempfile.TemporaryDirectory() as local_root_dir:
+		# The storage handler is selected by the configs when the processes of the scenarios import them
+		os.environ['STORAGE_LOCAL_ROOT_DIR'] = local_root_dir
+		if 's3' in backends:
+			from moto.server import ThreadedMotoServer
+			import boto3
+
+			os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+			os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+			os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+			os.environ["AWS_BUCKET_NAME"] = BUCKET_NAME
+			os.environ["AWS_ENDPOINT_URL"] = f"http://127.0.0.1:{port}"
+			_quiet_logs()
+			server = ThreadedMotoServer(port=port, verbose=False)
+			server.start()
+			boto3.client("s3", endpoint_url=os.environ["AWS_ENDPOINT_URL"]).create_bucket(Bucket=BUCKET_NAME)
+		try:
+			results = run_benchmark(backends, scales, scenarios, repeat=repeat)
+		finally:
+			if server is not None:
+				server.stop()
+
+	failed = [key for key, result in results.items() if 'error' in result]
+	if update_baseline:
+		if len(failed) > 0:
+			print(f"Not saving the baseline, {len(failed)} scenarios failed: {failed}")
+			raise SystemExit(1)
+		os.makedirs(os.path.dirname(baseline_path), exist_ok=True)
+		with open(baseline_path, 'w') as f:
+			json.dump({'environment': environment_info(), 'results': results}, f, indent=4, sort_keys=True)
+		print(f"Saved baseline to {baseline_path}")
+		return
+
+	if not os.path.exists(baseline_path):
+		print(f"No baseline found at {baseline_path}. Run with --update-baseline to create one")
+		if len(failed) > 0:
+			print(f"{len(failed)} scenarios failed: {failed}")
+			raise SystemExit(1)
+		return
+
+	with open(baseline_path) as f:
+		baseline = json.load(f)
+	if baseline['environment'] != environment_info():
+		print(f"Baseline was recorded on a different environment: {baseline['environment']}")
+
+	regressions = compare(results, baseline['results'], threshold)
+	if len(regressions) > 0:
+		print(f"{len(regressions)} failed scenarios or regressions of more than {threshold:.0%} against the baseline:")
+		for regression in regressions:
+			print(f"\t{regression}")
+		raise SystemExit(1)
+	print(f"No regressions of more than {threshold:.0%} against the baseline")
+
+
+if __name__ == "__main__":
+	run()
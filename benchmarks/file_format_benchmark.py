@@ -0,0 +1,107 @@
+""" Size and write / read time of the data stores of the pipelines in every file format and codec
+
+Generates data with the columns and dtypes of a schema of schemas.py, writes and reads it with a DataStore of every
+FileFormat on the local storage handler, checks that the data read is the data written, and reports the size of the
+file and the best time of --repeat writes and reads.
+
+Run from the root directory:
+	python -m benchmarks.file_format_benchmark --schema INPUT_INGEST_FILE --n-rows 5000000 --tmp-dir /tmp
+"""
+import tempfile
+import time
+
+import click
+import numpy as np
+import pandas as pd
+
+from project_starter_lib.data import schemas
+from project_starter_lib.data.data_stores import DataStore
+from project_starter_lib.data.file_formats import FileFormat
+from project_starter_lib.data.handlers.local import LocalStorageHandler
+
+FILE_FORMATS = {
+	'csv'           : FileFormat('csv'),
+	'csv+gzip'      : FileFormat('csv', 'gzip', compression_level=6),
+	'csv+zstd'      : FileFormat('csv', 'zstd'),
+	'parquet+snappy': FileFormat('parquet', 'snappy'),
+	'parquet+zstd'  : FileFormat('parquet', 'zstd'),
+	'feather'       : FileFormat('feather', 'uncompressed'),
+	'feather+lz4'   : FileFormat('feather', 'lz4'),
+	'feather+zstd'  : FileFormat('feather', 'zstd'),
+}
+
+
+def generate_data(schema: dict, n_rows: int, seed: int = 0) -> pd.DataFrame:
+	""" Random data with the columns and dtypes of the schema. Integers are skewed so that they compress like ids """
+	rng = np.random.default_rng(seed)
+	columns = {}
+	for col, dtype in schema.items():
+		if 'int' in dtype:
+			high = min(np.iinfo(dtype).max, 1_000_000)
+			columns[col] = (rng.pareto(1., n_rows) * 10).clip(0, high).astype(dtype)
+		elif 'float' in dtype:
+			columns[col] = rng.random(n_rows).round(2).astype(dtype)
+		elif 'datetime' in dtype:
+			columns[col] = pd.Timestamp('2021-01-01') + pd.to_timedelta(rng.integers(0, 365, n_rows), unit='D')
+		elif dtype == 'bool':
+			columns[col] = rng.random(n_rows) < 0.5
+		else:
+			columns[col] = pd.Series(rng.integers(0, 1000, n_rows)).map(lambda x: f'value_{x}').to_numpy(dtype=object)
+	return pd.DataFrame(columns)
+
+
+def _best_time(function, repeat: int):
+	best_seconds, result = None, None
+	for _ in range(repeat):
+		start_time = time.perf_counter()
+		result = function()
+		seconds = time.perf_counter() - start_time
+		best_seconds = seconds if best_seconds is None else min(best_seconds, seconds)
+	return best_seconds, result
+
+
+@click.command()
+@click.option("--schema", "schema_name", default="INPUT_INGEST_FILE", show_default=True,
+			  help="Name of the schema in schemas.py")
+@click.option("--n-rows", default=1_000_000, show_default=True, help="Number of rows")
+@click.option("--row-group-size", default=None, type=int, help="Rows per row group of the parquet files")
+@click.option("--repeat", default=3, show_default=True, help="Number of writes and reads of every format")
+@click.option("--tmp-dir", default=None, help="Folder of the files. Temporary folder of the system by default")
+def run(schema_name, n_rows, row_group_size, repeat, tmp_dir):
+	""" Run the benchmark """
+	schema = getattr(schemas, schema_name)
+	df = generate_data(schema, n_rows)
+	print(f"{schema_name}: {n_rows} rows, {df.memory_usage(index=False, deep=True).sum() / 1024 ** 2:.1f}MB in memory")
+
+	results = []
+	with tempfile.TemporaryDirectory(prefix='file_formats_', dir=tmp_dir) as root_dir:
+		storage_handler = LocalStorageHandler(root_dir=root_dir)
+		for name, file_format in FILE_FORMATS.items():
+			if file_format.format == 'parquet' and row_group_size is not None:
+				file_format = FileFormat('parquet', file_format.compression, row_group_size=row_group_size)
+
+			def data_store() -> DataStore:
+				return DataStore(file_name=f"{name}/data.csv", storage_handler=storage_handler, schema=schema,
+								 file_format=file_format, flag_copy_to_latest=False)
+
+			def write():
+				data_store().data = df
+
+			write_seconds, _ = _best_time(write, repeat)
+			read_seconds, df_read = _best_time(lambda: data_store().data, repeat)
+			pd.testing.assert_frame_equal(df_read, df)
+			results.append({
+				'format' : name,
+				'size_mb': storage_handler.head(data_store().file_name).size / 1024 ** 2,
+				'write_s': write_seconds,
+				'read_s' : read_seconds,
+			})
+
+	report = pd.DataFrame(results)
+	report['size_vs_csv'] = report['size_mb'] / report.loc[report['format'] == 'csv', 'size_mb'].iloc[0]
+	report['read_mrows_s'] = n_rows / report['read_s'] / 1e6
+	print(report.to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+
+if __name__ == "__main__":
+	run()
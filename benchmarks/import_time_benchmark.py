@@ -0,0 +1,81 @@
+""" Import time budget of the command line entry point
+
+Checks that showing --help of main_runner stays within a time budget, and that importing main_runner and the configs
+does not import any of the heavy modules, which are only needed once pipelines run. Fails if the budget is exceeded.
+Every measurement runs in a fresh interpreter, since imports are cached.
+
+Run from the root directory:
+	python -m benchmarks.import_time_benchmark --budget-seconds 0.5
+"""
+import json
+import statistics
+import subprocess
+import sys
+import time
+
+import click
+
+ENTRY_POINT = "project_starter_lib.main_runner"
+# Modules which must only be imported when pipelines run
+HEAVY_MODULES = ['pandas', 'numpy', 'pyarrow', 'boto3', 'botocore', 's3fs', 'git', 'joblib']
+
+
+def _help_seconds() -> float:
+	""" Wall clock time of showing --help in a new interpreter """
+	start_time = time.perf_counter()
+	subprocess.run([sys.executable, "-m", ENTRY_POINT, "--help"], check=True, capture_output=True)
+	return time.perf_counter() - start_time
+
+
+def _slowest_imports(n: int):
+	""" Modules with the highest cumulative import time when importing the entry point, from python -X importtime """
+	process = subprocess.run(
+		[sys.executable, "-X", "importtime", "-c", f"import {ENTRY_POINT}"], check=True, capture_output=True, text=True
+	)
+	imports = []
+	for line in process.stderr.splitlines():
+		if not line.startswith("import time:") or "cumulative" in line:
+			continue
+		_, cumulative, module = line[len("import time:"):].split("|")
+		imports.append((int(cumulative) / 1e6, module.strip()))
+	return sorted(imports, reverse=True)[:n]
+
+
+def _imported_heavy_modules():
+	""" Heavy modules imported by importing the entry point and the configs """
+	code = f"import sys, json, {ENTRY_POINT}, project_starter_lib.config.config; " \
+		   f"print(json.dumps([m for m in {HEAVY_MODULES!r} if m in sys.modules]))"
+	process = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True)
+	return json.loads(process.stdout.splitlines()[-1])
+
+
+@click.command()
+@click.option("--budget-seconds", default=0.5, show_default=True, help="Maximum median time of showing --help")
+@click.option("--repeat", default=5, show_default=True, help="Number of measurements")
+@click.option("--top", default=10, show_default=True, help="Number of slowest imports to show")
+def run(budget_seconds, repeat, top):
+	""" Run the benchmark """
+	failures = []
+
+	median_seconds = statistics.median(_help_seconds() for _ in range(repeat))
+	print(f"{ENTRY_POINT} --help: {median_seconds:.3f}s (median of {repeat}), budget {budget_seconds:.3f}s")
+	if median_seconds > budget_seconds:
+		failures.append(f"--help took {median_seconds:.3f}s, more than the budget of {budget_seconds:.3f}s")
+
+	print(f"Slowest imports of {ENTRY_POINT}:")
+	for seconds, module in _slowest_imports(top):
+		print(f"\t{seconds:8.3f}s {module}")
+
+	heavy_modules = _imported_heavy_modules()
+	if len(heavy_modules) > 0:
+		failures.append(f"Importing {ENTRY_POINT} and the configs imports {heavy_modules}")
+
+	if len(failures) > 0:
+		for failure in failures:
+			print(f"FAILED: {failure}")
+		raise SystemExit(1)
+	print("Import time within budget")
+
+
+if __name__ == "__main__":
+	run()
@@ -0,0 +1,105 @@
+""" Check that the incremental aggregation of agg_file gives the same result as the full aggregation
+
+Runs all pipelines on the local storage handler in a temporary folder, once with task_configs.agg_file.incremental and
+once without, after every change of the input file: rows appended, no change, rows changed and rows removed. The
+input is ingested in parts of --chunk-size rows. The command fails if the aggregated files of the two modes differ after
+any of them, or if the incremental aggregation read more than the new rows and the last part folded before when rows
+were only appended.
+
+Run from the root directory:
+	python -m benchmarks.incremental_agg_check --n-rows 100000
+	PARTITIONING_ENABLED=True python -m benchmarks.incremental_agg_check --n-rows 100000
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+import pandas as pd
+
+from benchmarks.file_format_benchmark import generate_data
+from project_starter_lib.config import config
+from project_starter_lib.data import schemas
+
+MODES = {'full': 'False', 'incremental': 'True'}
+
+
+def _run_pipelines(root_dir: str, mode: str, chunk_size: int):
+	""" Run all pipelines with the aggregation mode in the root folder named after it """
+	env = dict(
+		os.environ,
+		STORAGE_HANDLER='local',
+		STORAGE_LOCAL_ROOT_DIR=root_dir,
+		ROOT_FOLDER_NAME=mode,
+		AGG_FILE_INCREMENTAL=MODES[mode],
+		CHUNK_SIZE=str(chunk_size),
+	)
+	subprocess.run([sys.executable, '-m', 'project_starter_lib.main_runner', '-p', 'all'], env=env, check=True,
+				   stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+	# Run ids have a resolution of a second
+	time.sleep(1)
+
+
+def _load_agg_file(root_dir: str, mode: str) -> pd.DataFrame:
+	path = os.path.join(root_dir, 'output_data', mode, 'agg_data', 'latest', 'agg_file', 'agg_file.csv')
+	return pd.read_csv(path).sort_values('Key', ignore_index=True)
+
+
+def _agg_file_rows_read(root_dir: str, mode: str) -> int:
+	""" Rows read by agg_file in the last run, from its timings """
+	agg_data_dir = os.path.join(root_dir, 'output_data', mode, 'agg_data')
+	run_id = max(x for x in os.listdir(agg_data_dir) if x != 'latest')
+	timings = pd.read_csv(os.path.join(agg_data_dir, run_id, 'pipeline_run_info', 'timings.csv'))
+	return int(timings.loc[timings['name'] == 'agg_data.agg_file', 'rows_read'].iloc[0])
+
+
+@click.command()
+@click.option("--n-rows", default=100_000, show_default=True, help="Number of rows of the first input file")
+@click.option("--chunk-size", default=30_000, show_default=True, help="Rows per part of the ingested file")
+@click.option("--tmp-dir", default=None, help="Folder of the files. Temporary folder of the system by default")
+def run(n_rows, chunk_size, tmp_dir):
+	""" Run the check """
+	df = generate_data(schemas.INPUT_INGEST_FILE, n_rows)
+	# Change of the input and whether it only appends rows
+	changes = {
+		'first run'    : (lambda df: df, False),
+		'rows appended': (lambda df: pd.concat([df, generate_data(schemas.INPUT_INGEST_FILE, n_rows // 10, seed=1)],
+											   ignore_index=True), True),
+		'no change'    : (lambda df: df, True),
+		'rows changed' : (lambda df: df.assign(Value=df['Value'].where(df.index % 7 != 0, 0)), False),
+		'rows removed' : (lambda df: df.iloc[n_rows // 2:], False),
+	}
+
+	n_failed = 0
+	with tempfile.TemporaryDirectory(prefix='incremental_agg_', dir=tmp_dir) as root_dir:
+		input_path = os.path.join(root_dir, config.INPUT_FILE)
+		os.makedirs(os.path.dirname(input_path), exist_ok=True)
+		for name, (change, only_appends) in changes.items():
+			n_rows_before = len(df)
+			df = change(df)
+			df.to_csv(input_path, index=False)
+			for mode in MODES:
+				_run_pipelines(root_dir, mode, chunk_size)
+
+			rows_read = _agg_file_rows_read(root_dir, 'incremental')
+			try:
+				pd.testing.assert_frame_equal(_load_agg_file(root_dir, 'incremental'), _load_agg_file(root_dir, 'full'))
+				print(f"\t{name:<14} same result, {rows_read} of {len(df)} rows read")
+			except AssertionError as e:
+				n_failed += 1
+				print(f"\t{name:<14} DIFFERENT result: {e}")
+				continue
+
+			if only_appends and rows_read > len(df) - n_rows_before + chunk_size:
+				n_failed += 1
+				print(f"\t{name:<14} read {rows_read} rows for {len(df) - n_rows_before} new rows")
+
+	if n_failed > 0:
+		raise click.ClickException(f"Incremental aggregation failed {n_failed} checks in {len(changes)} runs")
+	print("Incremental and full aggregation agree")
+
+
+if __name__ == "__main__":
+	run()
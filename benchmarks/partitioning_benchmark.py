@@ -0,0 +1,71 @@
+""" Scaling of the hash partitioned map reduce of project_starter_lib.partitioning with the number of worker processes
+
+Aggregates the same chunks in a single process and with map_reduce on 1, 2, 4, ... up to --max-workers processes, checks
+that the results are identical and reports the speedup over the single process and the parallel efficiency. The time of
+map_reduce includes splitting the chunks into shards, which runs in the parent process.
+
+Run from the root directory:
+	python -m benchmarks.partitioning_benchmark --n-rows 20000000 --max-workers 32 --tmp-dir /dev/shm
+"""
+import os
+import time
+from functools import partial
+
+import click
+import numpy as np
+import pandas as pd
+
+from project_starter_lib import partitioning
+from project_starter_lib.aggregation import aggregate
+
+AGG_SPEC = {'Value': 'sum', 'Price': 'mean'}
+
+
+def generate_chunks(n_rows: int, n_keys: int, chunksize: int, seed: int = 0):
+	""" String keys, so that the aggregation is hash based and dominated by the work per row """
+	rng = np.random.default_rng(seed)
+	df = pd.DataFrame({
+		'Key'  : pd.Series(rng.integers(0, n_keys, n_rows)).map(lambda x: f'key_{x}').to_numpy(dtype=object),
+		'Value': rng.integers(0, 1000, n_rows).astype('int32'),
+		'Price': rng.random(n_rows),
+	})
+	return [df.iloc[start:start + chunksize] for start in range(0, n_rows, chunksize)]
+
+
+@click.command()
+@click.option("--n-rows", default=2_000_000, show_default=True, help="Number of rows")
+@click.option("--n-keys", default=100_000, show_default=True, help="Number of groups")
+@click.option("--chunksize", default=500_000, show_default=True, help="Rows per chunk")
+@click.option("--max-workers", default=os.cpu_count(), show_default=True, help="Largest number of worker processes")
+@click.option("--tmp-dir", default=None, help="Folder of the shard files, e.g. /dev/shm")
+def run(n_rows, n_keys, chunksize, max_workers, tmp_dir):
+	""" Run the benchmark """
+	chunks = generate_chunks(n_rows, n_keys, chunksize)
+	print(f"{n_rows} rows, {n_keys} keys, {len(chunks)} chunks, {os.cpu_count()} cores")
+
+	start_time = time.perf_counter()
+	expected = aggregate(pd.concat(chunks, ignore_index=True), ['Key'], AGG_SPEC)
+	single_seconds = time.perf_counter() - start_time
+	print(f"\t{'single process':<16} {single_seconds:8.3f}s")
+
+	n_workers = 1
+	while n_workers <= max_workers:
+		start_time = time.perf_counter()
+		result = partitioning.map_reduce(
+			iter(chunks),
+			['Key'],
+			partial(aggregate, group_by_cols=['Key'], agg_spec=AGG_SPEC),
+			lambda df: df.sort_values('Key', ignore_index=True),
+			n_partitions=n_workers,
+			max_workers=n_workers,
+			tmp_dir=tmp_dir,
+		)
+		seconds = time.perf_counter() - start_time
+		pd.testing.assert_frame_equal(result, expected, check_exact=False, check_dtype=False)
+		speedup = single_seconds / seconds
+		print(f"\t{f'{n_workers} workers':<16} {seconds:8.3f}s {speedup:6.1f}x, efficiency {speedup / n_workers:.0%}")
+		n_workers *= 2
+
+
+if __name__ == "__main__":
+	run()
@@ -0,0 +1,78 @@
+""" Peak memory and time of saving and loading a large .pkl object with and without out-of-band buffers
+
+Saves and loads a data frame of --size-mb MB with the local storage handler, which writes the out-of-band format of
+project_starter_lib.data.handlers.pickle_buffers, and with pickle.dumps / pickle.load as the handlers did before. The
+peak is the memory allocated by python and numpy on top of the object, measured with tracemalloc. Memory mapped files
+are not allocations and are not counted.
+
+Run from the root directory:
+	python -m benchmarks.pickle_benchmark --size-mb 1000 --tmp-dir /tmp
+"""
+import os
+import pickle
+import tempfile
+import time
+import tracemalloc
+
+import click
+import numpy as np
+import pandas as pd
+
+from project_starter_lib.data.handlers.local import LocalStorageHandler
+
+
+def _measure(function):
+	""" Seconds, peak allocated MB and result of function """
+	tracemalloc.start()
+	start_time = time.perf_counter()
+	result = function()
+	seconds = time.perf_counter() - start_time
+	_, peak = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	return seconds, peak / 1024 ** 2, result
+
+
+@click.command()
+@click.option("--size-mb", default=200, show_default=True, help="Size of the data frame")
+@click.option("--tmp-dir", default=None, help="Folder of the files. Temporary folder of the system by default")
+def run(size_mb, tmp_dir):
+	""" Run the benchmark """
+	n_rows = size_mb * 1024 ** 2 // 16
+	rng = np.random.default_rng(0)
+	df = pd.DataFrame({'Key': rng.integers(0, 1000, n_rows), 'Value': rng.random(n_rows)})
+	print(f"Data frame of {df.memory_usage(index=False).sum() / 1024 ** 2:.0f}MB")
+
+	with tempfile.TemporaryDirectory(prefix='pickle_', dir=tmp_dir) as root_dir:
+		storage_handler = LocalStorageHandler(root_dir=root_dir)
+		in_band_path = os.path.join(root_dir, 'in_band.pkl')
+
+		def save_in_band():
+			with open(in_band_path, 'wb') as f:
+				f.write(pickle.dumps(df))
+
+		def load_in_band():
+			with open(in_band_path, 'rb') as f:
+				return pickle.load(f)
+
+		cases = {
+			'pickle.dumps / pickle.load': (save_in_band, load_in_band),
+			'out-of-band, memory mapped': (
+				lambda: storage_handler.save('out_of_band.pkl', df),
+				lambda: storage_handler.load('out_of_band.pkl'),
+			),
+			'out-of-band, read': (
+				lambda: storage_handler.save('out_of_band.pkl', df),
+				lambda: storage_handler.load('out_of_band.pkl', memory_map=False),
+			),
+		}
+		for name, (save, load) in cases.items():
+			save_seconds, save_peak_mb, _ = _measure(save)
+			load_seconds, load_peak_mb, df_loaded = _measure(load)
+			pd.testing.assert_frame_equal(df_loaded, df)
+			del df_loaded
+			print(f"\t{name:<28} save {save_seconds:7.3f}s peak {save_peak_mb:8.1f}MB   "
+				  f"load {load_seconds:7.3f}s peak {load_peak_mb:8.1f}MB")
+
+
+if __name__ == "__main__":
+	run()
@@ -0,0 +1,93 @@
+""" Benchmark of per operation latency of S3StorageHandler against a local S3 stand-in (moto server)
+
+Compares creating a new boto3 session/client for every call (how the handler used to work) with the pooled client
+owned by S3StorageHandler.
+
+Needs `moto[server]` installed in addition to requirements.txt. Run from the root directory:
+	python -m benchmarks.s3_client_benchmark --n-ops 200 --threads 8
+"""
+import logging
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import boto3
+import boto3.session
+import click
+from moto.server import ThreadedMotoServer
+
+BUCKET_NAME = "benchmark-bucket"
+
+
+def _time_ops(op, n_ops, threads):
+	""" Run op n_ops times on a thread pool and return the latency of each call in milliseconds """
+
+	def timed(i):
+		start = time.perf_counter()
+		op(i)
+		return (time.perf_counter() - start) * 1000
+
+	with ThreadPoolExecutor(max_workers=threads) as executor:
+		return list(executor.map(timed, range(n_ops)))
+
+
+def _summary(name, latencies):
+	latencies = sorted(latencies)
+	p95 = latencies[int(0.95 * (len(latencies) - 1))]
+	return f"{name:<30} mean: {statistics.mean(latencies):8.2f} ms  p50: {statistics.median(latencies):8.2f} ms  " \
+		   f"p95: {p95:8.2f} ms"
+
+
+@click.command()
+@click.option("--n-ops", default=200, show_default=True, help="Number of operations per scenario")
+@click.option("--threads", default=8, show_default=True, help="Number of threads issuing operations")
+@click.option("--port", default=5123, show_default=True, help="Port of the moto server")
+def run(n_ops, threads, port):
+	""" Run the benchmark """
+	endpoint_url = f"http://127.0.0.1:{port}"
+	os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+	os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+	os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+	os.environ["AWS_BUCKET_NAME"] = BUCKET_NAME
+
+	# The bucket name is read when the module is imported, so the import has to happen after setting the env
+	from project_starter_lib.data.handlers.s3 import S3StorageHandler
+
+	# Per request logs would dominate the timings
+	for logger_name in ["werkzeug", "project_starter_lib"]:
+		logging.getLogger(logger_name).setLevel(logging.WARNING)
+
+	server = ThreadedMotoServer(port=port, verbose=False)
+	server.start()
+	try:
+		boto3.client("s3", endpoint_url=endpoint_url).create_bucket(Bucket=BUCKET_NAME)
+		payload = b"x" * 1024
+
+		def fresh_client_put(i):
+			client = boto3.session.Session().client("s3", endpoint_url=endpoint_url)
+			client.put_object(Bucket=BUCKET_NAME, Key=f"fresh/{i}.txt", Body=payload)
+
+		def fresh_client_get(i):
+			resource = boto3.session.Session().resource("s3", endpoint_url=endpoint_url)
+			resource.Object(BUCKET_NAME, f"fresh/{i}.txt").get()["Body"].read()
+
+		handler = S3StorageHandler(max_pool_connections=threads, endpoint_url=endpoint_url)
+
+		def pooled_put(i):
+			handler.save(f"pooled/{i}.txt", payload)
+
+		def pooled_get(i):
+			handler.load(f"pooled/{i}.txt")
+
+		print(f"{n_ops} operations on {threads} threads with a {len(payload)} byte payload")
+		print(_summary("fresh client per call - PUT", _time_ops(fresh_client_put, n_ops, threads)))
+		print(_summary("fresh client per call - GET", _time_ops(fresh_client_get, n_ops, threads)))
+		print(_summary("pooled client - PUT", _time_ops(pooled_put, n_ops, threads)))
+		print(_summary("pooled client - GET", _time_ops(pooled_get, n_ops, threads)))
+	finally:
+		server.stop()
+
+
+if __name__ == "__main__":
+	run()
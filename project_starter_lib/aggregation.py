@@ -0,0 +1,248 @@
+""" Group by aggregation with specialized paths depending on the keys
+
+The aggregation is declared as group by columns and a spec {column: aggregation}, as for pandas
+`df.groupby(group_by_cols, as_index=False).agg(agg_spec)`, which returns the same result. The engine decides how to
+compute it:
+- dense: integer keys whose combinations fit in a small range, e.g. int16 keys. Every row is mapped to the index of its
+  key in that range, without hashing or sorting, and values are accumulated into arrays indexed by key
+- sort: numeric keys which are already sorted, e.g. data written sorted by key. Groups are the runs of equal keys.
+  Unsorted keys are sorted first, which is usually slower than hashing
+- hash: anything else, e.g. string keys. Pandas groupby
+The dtypes of the result only depend on the dtypes of the data, so that results of parts of the data, e.g. the shards of
+partitioning.map_reduce, have the same dtypes. Unlike pandas, which keeps the dtype of an integer column in its sums
+only if they fit in it, integer and bool sums are always int64 (uint64 for unsigned integers).
+"""
+import logging
+from typing import Dict, List, Tuple
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+ENGINES = ['auto', 'dense', 'sort', 'hash']
+AGGREGATIONS = ['sum', 'count', 'min', 'max', 'mean']
+
+# The dense path allocates arrays with one element per possible combination of keys. It is used if there are not more
+# possible combinations than this or than twice the number of rows
+DENSE_MIN_KEYS = 2 ** 16
+
+
+def _is_plain_numeric(series: pd.Series) -> bool:
+	""" numpy integer, float or bool dtype. Nullable and extension dtypes are left to pandas """
+	return isinstance(series.dtype, np.dtype) and series.dtype.kind in 'iufb'
+
+
+def _sum_dtype(dtype: np.dtype) -> np.dtype:
+	""" dtype in which a column is summed """
+	if dtype.kind == 'f':
+		return np.dtype('float64')
+	if dtype.kind == 'u':
+		return np.dtype('uint64')
+	return np.dtype('int64')
+
+
+def _cast_sums(df_agg: pd.DataFrame, df: pd.DataFrame, agg_spec: Dict[str, str]) -> pd.DataFrame:
+	""" Integer and bool sums of pandas, whose dtype depends on their values, as int64 (uint64) """
+	dtypes = {
+		col: _sum_dtype(df[col].dtype) for col, agg in agg_spec.items()
+		if agg == 'sum' and _is_plain_numeric(df[col]) and df[col].dtype.kind in 'iub'
+	}
+	return df_agg.astype(dtypes) if len(dtypes) > 0 else df_agg
+
+
+def _key_ranges(df: pd.DataFrame, group_by_cols: List[str]) -> List[Tuple[int, int]]:
+	""" (min, number of possible values) of every integer key """
+	ranges = []
+	for col in group_by_cols:
+		keys = df[col].to_numpy()
+		ranges.append((int(keys.min()), int(keys.max()) - int(keys.min()) + 1))
+	return ranges
+
+
+def _is_sorted(df: pd.DataFrame, group_by_cols: List[str]) -> bool:
+	""" Whether the rows are sorted by the keys, so that equal keys are next to each other """
+	return df.set_index(group_by_cols).index.is_monotonic_increasing if len(group_by_cols) > 1 \
+		else df[group_by_cols[0]].is_monotonic_increasing
+
+
+def _can_sort(df: pd.DataFrame, group_by_cols: List[str], agg_spec: Dict[str, str]) -> bool:
+	""" Numeric keys and values, without missing keys which pandas would drop """
+	if not all(_is_plain_numeric(df[col]) for col in list(group_by_cols) + list(agg_spec)):
+		return False
+	return not any(df[col].dtype.kind == 'f' and df[col].isna().any() for col in group_by_cols)
+
+
+def _can_aggregate_dense(df: pd.DataFrame, group_by_cols: List[str], agg_spec: Dict[str, str]) -> bool:
+	""" Integer keys whose combinations fit in a small range """
+	if len(df) == 0 or not _can_sort(df, group_by_cols, agg_spec):
+		return False
+	if not all(df[col].dtype.kind in 'iub' for col in group_by_cols):
+		return False
+	n_keys = np.prod([float(n) for _, n in _key_ranges(df, group_by_cols)])
+	return n_keys <= max(DENSE_MIN_KEYS, 2 * len(df))
+
+
+def choose_engine(df: pd.DataFrame, group_by_cols: List[str], agg_spec: Dict[str, str]) -> str:
+	"""
+	Fastest engine which can aggregate the data frame, based on the dtypes, range and order of the keys
+	:param df:
+	:param group_by_cols:
+	:param agg_spec:
+	:return: dense, sort or hash
+	"""
+	if _can_aggregate_dense(df, group_by_cols, agg_spec):
+		return 'dense'
+	if len(df) > 0 and _can_sort(df, group_by_cols, agg_spec) and _is_sorted(df, group_by_cols):
+		return 'sort'
+	return 'hash'
+
+
+def _reduce_groups(values: np.ndarray, codes: np.ndarray, counts: np.ndarray, agg: str) -> np.ndarray:
+	"""
+	Aggregate values per group
+	:param values: Values of one column
+	:param codes: Index of the group of every value
+	:param counts: Number of values of every group
+	:param agg: One of AGGREGATIONS
+	:return: One value per group
+	"""
+	n_groups = len(counts)
+	is_float = values.dtype.kind == 'f'
+	valid = ~np.isnan(values) if is_float else None
+	if valid is not None and valid.all():
+		valid = None
+	valid_codes = codes if valid is None else codes[valid]
+	valid_values = values if valid is None else values[valid]
+	valid_counts = counts if valid is None else np.bincount(valid_codes, minlength=n_groups)
+
+	if agg == 'count':
+		return valid_counts.astype('int64')
+
+	if agg in ['sum', 'mean']:
+		if is_float:
+			result = np.bincount(valid_codes, weights=valid_values, minlength=n_groups)
+		elif len(values) == 0 or max(abs(int(values.min())), abs(int(values.max()))) * len(values) < 2 ** 53:
+			# Sums of integers are exact in float64 below 2 ** 53
+			result = np.bincount(codes, weights=values, minlength=n_groups).astype(_sum_dtype(values.dtype))
+		else:
+			result = np.zeros(n_groups, dtype=_sum_dtype(values.dtype))
+			np.add.at(result, codes, values.astype(_sum_dtype(values.dtype)))
+		if agg == 'sum':
+			# Float sums keep the precision of the column
+			return result.astype(values.dtype, copy=False) if is_float else result
+		with np.errstate(invalid='ignore', divide='ignore'):
+			mean = result / valid_counts
+		return mean.astype(values.dtype) if is_float else mean
+
+	if agg in ['min', 'max']:
+		ufunc = np.minimum if agg == 'min' else np.maximum
+		if values.dtype.kind == 'b':
+			identity = agg == 'min'
+		elif is_float:
+			identity = np.inf if agg == 'min' else -np.inf
+		else:
+			info = np.iinfo(values.dtype)
+			identity = info.max if agg == 'min' else info.min
+		result = np.full(n_groups, identity, dtype=values.dtype)
+		# Missing values are skipped, groups with only missing values are missing
+		ufunc.at(result, valid_codes, valid_values)
+		if is_float:
+			result[valid_counts == 0] = np.nan
+		return result
+
+	raise NotImplementedError(f"Aggregation {agg}. Should be one of {AGGREGATIONS}")
+
+
+def _aggregate_codes(df: pd.DataFrame, codes: np.ndarray, counts: np.ndarray, group_keys: Dict[str, np.ndarray],
+					 agg_spec: Dict[str, str]) -> pd.DataFrame:
+	""" Aggregate every column of the spec, given the group of every row, the size and the keys of every group """
+	columns = dict(group_keys)
+	for col, agg in agg_spec.items():
+		columns[col] = _reduce_groups(df[col].to_numpy(), codes, counts, agg)
+	return pd.DataFrame(columns)
+
+
+def _aggregate_dense(df: pd.DataFrame, group_by_cols: List[str], agg_spec: Dict[str, str]) -> pd.DataFrame:
+	# Index of every row in the range of all key combinations. The first key varies slowest, so that the groups are
+	# sorted by the keys
+	ranges = _key_ranges(df, group_by_cols)
+	codes = None
+	for col, (min_key, n_keys) in zip(group_by_cols, ranges):
+		key_codes = np.subtract(df[col].to_numpy(), min_key, dtype='intp')
+		codes = key_codes if codes is None else codes * n_keys + key_codes
+	n_codes = int(np.prod([n for _, n in ranges]))
+
+	# Only key combinations which occur are groups
+	counts = np.bincount(codes, minlength=n_codes)
+	present = np.flatnonzero(counts > 0)
+
+	group_keys = {}
+	remaining = present.copy()
+	for col, (min_key, n_keys) in reversed(list(zip(group_by_cols, ranges))):
+		group_keys[col] = (remaining % n_keys + min_key).astype(df[col].dtype)
+		remaining //= n_keys
+	group_keys = {col: group_keys[col] for col in group_by_cols}
+
+	# Aggregating over all key combinations and keeping the ones which occur is cheaper than mapping every row to the
+	# index of its group
+	df_agg = _aggregate_codes(df, codes, counts, {}, agg_spec).iloc[present]
+	return pd.concat([pd.DataFrame(group_keys), df_agg.reset_index(drop=True)], axis=1)
+
+
+def _aggregate_sorted(df: pd.DataFrame, group_by_cols: List[str], agg_spec: Dict[str, str]) -> pd.DataFrame:
+	key_arrays = [df[col].to_numpy() for col in group_by_cols]
+	order = None
+	if not _is_sorted(df, group_by_cols):
+		# lexsort sorts by the last key first
+		order = np.argsort(key_arrays[0]) if len(key_arrays) == 1 else np.lexsort(key_arrays[::-1])
+		key_arrays = [keys[order] for keys in key_arrays]
+
+	# A new group starts wherever any key changes
+	is_start = np.zeros(len(df), dtype=bool)
+	is_start[:1] = True
+	for keys in key_arrays:
+		is_start[1:] |= keys[1:] != keys[:-1]
+	sorted_codes = np.cumsum(is_start) - 1
+
+	# Group of every row in the original order, so that the values do not have to be reordered
+	if order is None:
+		codes = sorted_codes
+	else:
+		codes = np.empty(len(df), dtype='int64')
+		codes[order] = sorted_codes
+
+	starts = np.flatnonzero(is_start)
+	counts = np.diff(np.append(starts, len(df)))
+	group_keys = {col: keys[starts] for col, keys in zip(group_by_cols, key_arrays)}
+	return _aggregate_codes(df, codes, counts, group_keys, agg_spec)
+
+
+def aggregate(df: pd.DataFrame, group_by_cols: List[str], agg_spec: Dict[str, str],
+			  engine: str = 'auto') -> pd.DataFrame:
+	"""
+	Same result as df.groupby(group_by_cols, as_index=False).agg(agg_spec), sorted by the group by columns, except for
+	the dtypes of integer sums, see the docstring of the module
+	:param df:
+	:param group_by_cols:
+	:param agg_spec: {column: aggregation}, aggregation is one of AGGREGATIONS
+	:param engine: auto, dense, sort or hash. auto chooses the fastest engine which can aggregate the data frame
+	:return:
+	"""
+	assert engine in ENGINES, f"Unknown aggregation engine {engine}"
+	assert all(agg in AGGREGATIONS for agg in agg_spec.values()), f"Aggregations should be one of {AGGREGATIONS}"
+	if engine == 'auto':
+		engine = choose_engine(df, group_by_cols, agg_spec)
+	if engine == 'dense' and not _can_aggregate_dense(df, group_by_cols, agg_spec):
+		logger.warning(f"Cannot aggregate by {group_by_cols} with the dense engine. Using the sort engine")
+		engine = 'sort'
+	if engine == 'sort' and not _can_sort(df, group_by_cols, agg_spec):
+		logger.warning(f"Cannot aggregate by {group_by_cols} with the sort engine. Using the hash engine")
+		engine = 'hash'
+
+	logger.debug(f"Aggregating {len(df)} rows by {group_by_cols} with the {engine} engine")
+	if len(df) == 0 or engine == 'hash':
+		return _cast_sums(df.groupby(group_by_cols, as_index=False).agg(agg_spec), df, agg_spec)
+	if engine == 'dense':
+		return _aggregate_dense(df, group_by_cols, agg_spec)
+	return _aggregate_sorted(df, group_by_cols, agg_spec)
@@ -1,10 +1,15 @@
 """ Definition of Pipeline and Task """
 import logging
 from datetime import datetime
+from typing import Callable, Dict, Iterable, List, Optional, Type
 
+import pandas as pd
 import pytz
 
-from project_starter_lib.data.data_stores import AllDataStores
+from project_starter_lib import instrumentation, partitioning
+from project_starter_lib.config import config
+from project_starter_lib.data.data_stores import AllDataStores, DataStore
+from project_starter_lib.task_cache import TaskCache
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +19,8 @@ class Pipeline:
 	name: str
 	current_run_id: str
 	all_data_stores: AllDataStores = None
+	# Task name -> Task class of all tasks of the pipeline, in the order in which they run
+	task_classes: Dict[str, Type['Task']] = {}
 
 	def __init__(self, name):
 		self.name = name
@@ -24,17 +31,115 @@ class Pipeline:
 		current_time_str = current_time.strftime("%Y-%m-%d-%H:%M:%S")
 		self.current_run_id = f"{current_time_str}_{self.name}"
 
+		# Metrics of every task run in the current run, see Task.run
+		self.task_metrics: List[dict] = []
+
+	@property
+	def task_runner(self) -> Dict[str, bool]:
+		""" Which tasks to run, from config.yaml """
+		raise NotImplementedError()
+
+	def get_tasks(self) -> List['Task']:
+		""" All tasks of the pipeline which are enabled in the config, in the order in which they run """
+		return [
+			task_class(task_name=task_name, pipeline=self)
+			for task_name, task_class in self.task_classes.items()
+			if self.task_runner[task_name]
+		]
+
+	@property
+	def inputs(self) -> List[str]:
+		""" Data stores read by the tasks of the pipeline """
+		return sorted({name for task_class in self.task_classes.values() for name in task_class.inputs})
+
+	@property
+	def outputs(self) -> List[str]:
+		""" Data stores written by the tasks of the pipeline """
+		return sorted({name for task_class in self.task_classes.values() for name in task_class.outputs})
+
 	def run_pipeline(self):
 		""" Run pipeline """
 		raise NotImplementedError()
 
 
 class Task:
+	# Names of the attributes of AllDataStores which the task reads and writes. Used to build the dependencies between
+	# tasks
+	inputs: List[str] = []
+	outputs: List[str] = []
+	# Columns by which the rows of the inputs can be hash partitioned, so that the task can process them with map_reduce.
+	# None if the task can not be partitioned
+	partition_by: Optional[List[str]] = None
+
 	def __init__(self, task_name: str, pipeline: Pipeline):
 		self.task_name = task_name
 		self.pipeline = pipeline
 		self.all_data_stores: AllDataStores = self.pipeline.all_data_stores
 
+	@property
+	def task_id(self) -> str:
+		""" Unique name of the task across pipelines """
+		return f"{self.pipeline.name}.{self.task_name}"
+
+	def get_source_data_stores(self) -> List[DataStore]:
+		""" Data stores outside of the pipelines which the task reads, e.g. input files """
+		return []
+
+	def config_section(self) -> dict:
+		""" Configs which change the outputs of the task """
+		return config.cfg['task_configs'].get(self.task_name, {})
+
+	def run(self) -> dict:
+		"""
+		Run the task, unless the task cache finds an earlier run with the same inputs. Then its outputs are reused.
+		:return: Metrics of the run, see instrumentation.Metrics
+		"""
+		with instrumentation.measure(
+				self.task_id,
+				profiler=config.INSTRUMENTATION_CONFIGS['profiler'],
+				profile_top_n=config.INSTRUMENTATION_CONFIGS['profile_top_n']
+		) as metrics:
+			if not config.TASK_CACHE_ENABLED:
+				self.run_task()
+			else:
+				task_cache = TaskCache(self)
+				fingerprint = task_cache.fingerprint()
+				entry = task_cache.lookup(fingerprint)
+				if entry is not None:
+					task_cache.reuse(entry)
+					metrics.reused_run_id = entry['run_id']
+				else:
+					self.run_task()
+					task_cache.record(fingerprint)
+
+		if metrics.profile_report is not None:
+			metrics.profile_path = f'output_data/{config.ROOT_FOLDER_NAME}/{self.pipeline.name}/' \
+								   f'{self.pipeline.current_run_id}/pipeline_run_info/profiles/{self.task_name}.txt'
+			DataStore(file_name=metrics.profile_path, flag_copy_to_latest=False).data = metrics.profile_report
+
+		return metrics.to_dict()
+
+	def map_reduce(self, chunks: Iterable[pd.DataFrame], map_function: Callable[[pd.DataFrame], pd.DataFrame],
+				   reduce_function: Callable[[pd.DataFrame], pd.DataFrame] = None) -> pd.DataFrame:
+		"""
+		Split the chunks into shards by partition_by and apply the map function to every shard on a process pool, see
+		partitioning.map_reduce. Uses the partitioning configs
+		:param chunks: Rows of the inputs, e.g. from DataStore.iter_chunks
+		:param map_function: Must be picklable, e.g. a functools.partial of a module level function
+		:param reduce_function: Applied to the concatenated results of the shards
+		:return:
+		"""
+		assert self.partition_by is not None, f"{self.task_name} does not declare partition_by"
+		return partitioning.map_reduce(
+			chunks,
+			self.partition_by,
+			map_function,
+			reduce_function=reduce_function,
+			n_partitions=config.PARTITIONING_CONFIGS['n_partitions'],
+			max_workers=config.PARTITIONING_CONFIGS['max_workers'],
+			tmp_dir=config.PARTITIONING_CONFIGS['tmp_dir'],
+		)
+
 	def run_task(self):
 		""" Run Task """
 		raise NotImplementedError()
@@ -1,17 +1,18 @@
-""" All configs """
+""" All configs
+
+STORAGE_HANDLER and the GIT_* variables are created on first access, see __getattr__, so that importing the configs does
+not import boto3, pandas or git and does not probe the git repository.
+"""
+import hashlib
 import logging
 import os
+import threading
 from datetime import datetime, timedelta
 
-import git
-import pandas as pd
 import pytz
-import yaml
 from dotenv import load_dotenv
 from envyaml import EnvYAML
 
-from project_starter_lib.data.handlers.s3 import S3StorageHandler
-
 logger = logging.getLogger(__name__)
 
 load_dotenv()
@@ -24,9 +25,59 @@ current_time = datetime.now(est)
 if cfg['run_configs']['execution_date'] == 'calculated':
 	current_date = datetime.now(est).date()
 else:
+	import pandas as pd
 	current_date = pd.to_datetime(cfg['run_configs']['execution_date']).date()
 
-STORAGE_HANDLER = S3StorageHandler()
+""" STORAGE CONFIGS """
+STORAGE_S3_CONFIGS = cfg['storage']['s3']
+STORAGE_LOCAL_CONFIGS = cfg['storage']['local']
+STORAGE_COPY_MAX_WORKERS = cfg['storage']['copy_max_workers']
+
+STORAGE_CACHE_CONFIGS = cfg['storage']['cache']
+STORAGE_TRACING_CONFIGS = cfg['storage']['tracing']
+# Format of the files written by each data store of AllDataStores, see file_formats.FileFormat
+STORAGE_FORMATS_CONFIGS = cfg['storage']['formats']
+
+
+def _create_storage_handler():
+	""" Storage handler selected by the configs. Created on first access of STORAGE_HANDLER """
+	from project_starter_lib.data.handlers.cache import CachingStorageHandler
+	from project_starter_lib.data.handlers.local import LocalStorageHandler
+	from project_starter_lib.data.handlers.s3 import S3StorageHandler
+	from project_starter_lib.data.handlers.tracing import TracingStorageHandler
+
+	if cfg['storage']['handler'] == 's3':
+		storage_handler = S3StorageHandler(
+			max_pool_connections=STORAGE_S3_CONFIGS['max_pool_connections'],
+			tcp_keepalive=STORAGE_S3_CONFIGS['tcp_keepalive'],
+			multipart_threshold=STORAGE_S3_CONFIGS['multipart_threshold_mb'] * 1024 ** 2,
+			part_size=STORAGE_S3_CONFIGS['part_size_mb'] * 1024 ** 2,
+			max_concurrency=STORAGE_S3_CONFIGS['max_concurrency'],
+		)
+	elif cfg['storage']['handler'] == 'local':
+		storage_handler = LocalStorageHandler(root_dir=STORAGE_LOCAL_CONFIGS['root_dir'])
+	else:
+		raise NotImplementedError(f"Unknown storage handler {cfg['storage']['handler']}")
+
+	# Keep a local copy of everything that is read
+	if STORAGE_CACHE_CONFIGS['enabled']:
+		storage_handler = CachingStorageHandler(
+			storage_handler=storage_handler,
+			cache_dir=STORAGE_CACHE_CONFIGS['cache_dir'],
+			max_bytes=int(STORAGE_CACHE_CONFIGS['max_gb'] * 1024 ** 3),
+		)
+
+	# Record latency, calls and bytes of every storage operation
+	if STORAGE_TRACING_CONFIGS['enabled']:
+		storage_handler = TracingStorageHandler(
+			storage_handler=storage_handler,
+			slow_call_seconds=STORAGE_TRACING_CONFIGS['slow_call_seconds'],
+			prefix_depth=STORAGE_TRACING_CONFIGS['prefix_depth'],
+			trace_requests=STORAGE_TRACING_CONFIGS['trace_requests'],
+		)
+
+	return {'STORAGE_HANDLER': storage_handler}
+
 
 """ PIPELINE RUN IDS """
 PIPELINE_READ_RUN_IDs = cfg['pipeline_read_run_ids']
@@ -35,23 +86,109 @@ PIPELINE_READ_RUN_IDs = cfg['pipeline_read_run_ids']
 
 ROOT_FOLDER_NAME = cfg['run_configs']['root_folder_name']
 
+# copy: latest folder is a physical copy of the run outputs. manifest: latest is a pointer to the run id
+LATEST_MODE = cfg['run_configs']['latest_mode']
+assert LATEST_MODE in ['copy', 'manifest'], f"Unknown latest_mode {LATEST_MODE}"
+
+# Skip tasks whose inputs, configs and code did not change since an earlier run and reuse the outputs of that run
+TASK_CACHE_ENABLED = cfg['run_configs']['task_cache']
+
+# Number of rows per chunk when data is streamed
+CHUNK_SIZE = cfg['run_configs']['chunk_size']
+
+# Downcast the columns of data stores which are not in their schema when loading them
+DOWNCAST_ON_LOAD = cfg['run_configs']['downcast_on_load']
+
 """ GIT Related Information """
-try:
-	GIT_REPO = git.Repo(search_parent_directories=True)
-	GIT_BRANCH = GIT_REPO.active_branch.name
-	# GIT_HASH = GIT_REPO.head.commit.hexsha
-	GIT_HASH = ""
-	logger.info(f"Git configs -  git_branch: {GIT_BRANCH}")
-except git.exc.InvalidGitRepositoryError as e:
-	logger.warning("Not a valid Git repository. Ignoring Git related arguments in logs")
-	GIT_REPO = "Not a valid git repo"
-	GIT_BRANCH = "Not a valid git repo"
-	GIT_HASH = "Not a valid git repo"
+
+
+def _git_info():
+	""" GIT_REPO, GIT_BRANCH and GIT_HASH. Created on first access of any of them """
+	import git
+
+	try:
+		git_repo = git.Repo(search_parent_directories=True)
+		git_branch = git_repo.active_branch.name
+		try:
+			git_hash = git_repo.head.commit.hexsha
+		except ValueError:
+			logger.warning("Git repository without commits")
+			git_hash = "No commits"
+		logger.info(f"Git configs -  git_branch: {git_branch}")
+	except git.exc.InvalidGitRepositoryError as e:
+		logger.warning("Not a valid Git repository. Ignoring Git related arguments in logs")
+		git_repo = "Not a valid git repo"
+		git_branch = "Not a valid git repo"
+		git_hash = "Not a valid git repo"
+	return {'GIT_REPO': git_repo, 'GIT_BRANCH': git_branch, 'GIT_HASH': git_hash}
+
+
+def _git_diff_info():
+	""" GIT_DIRTY and GIT_DIFF_HASH, the hash of the uncommitted changes of the tracked files. Created on first access """
+	import git
+
+	# Called by __getattr__ with the lock held
+	if 'GIT_REPO' not in globals():
+		globals().update(_git_info())
+	git_repo = globals()['GIT_REPO']
+	if not isinstance(git_repo, git.Repo) or not git_repo.is_dirty():
+		return {'GIT_DIRTY': False, 'GIT_DIFF_HASH': None}
+	if git_repo.head.is_valid():
+		diff = git_repo.git.diff('HEAD', '--binary')
+	else:
+		# Without commits, everything staged is a change
+		diff = git_repo.git.diff('--cached', '--binary') + git_repo.git.diff('--binary')
+	return {'GIT_DIRTY': True, 'GIT_DIFF_HASH': hashlib.sha256(diff.encode()).hexdigest()}
+
+
+_LAZY_ATTRIBUTES = {
+	'STORAGE_HANDLER': _create_storage_handler,
+	'GIT_REPO'       : _git_info,
+	'GIT_BRANCH'     : _git_info,
+	'GIT_HASH'       : _git_info,
+	'GIT_DIRTY'      : _git_diff_info,
+	'GIT_DIFF_HASH'  : _git_diff_info,
+}
+_lazy_lock = threading.Lock()
+
+
+def __getattr__(name):
+	""" Create the expensive module attributes on first access. Afterwards they are regular module attributes """
+	if name not in _LAZY_ATTRIBUTES:
+		raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+	with _lazy_lock:
+		# Another thread could have created it while we waited for the lock
+		if name not in globals():
+			globals().update(_LAZY_ATTRIBUTES[name]())
+	return globals()[name]
+
 
 """ Which tasks to run in which pipeline """
 TASK_RUNNER_INGEST_SOURCE_DATA = cfg['tasks']['ingest_source_data']
 TASK_RUNNER_AGG_DATA = cfg['tasks']['agg_data']
 
+""" Scheduler configs """
+SCHEDULER_CONFIGS = cfg['scheduler']
+
+""" Instrumentation configs """
+INSTRUMENTATION_CONFIGS = cfg['instrumentation']
+assert INSTRUMENTATION_CONFIGS['profiler'] in ['none', 'cprofile'], \
+	f"Unknown profiler {INSTRUMENTATION_CONFIGS['profiler']}"
+
+""" Aggregation configs """
+AGGREGATION_ENGINE = cfg['aggregation']['engine']
+assert AGGREGATION_ENGINE in ['auto', 'dense', 'sort', 'hash'], f"Unknown aggregation engine {AGGREGATION_ENGINE}"
+
+""" Log shipping configs """
+LOG_SHIPPING_CONFIGS = cfg['log_shipping']
+assert LOG_SHIPPING_CONFIGS['codec'] in ['gzip', 'zstd'], f"Unknown log shipping codec {LOG_SHIPPING_CONFIGS['codec']}"
+
+""" Partitioning configs """
+PARTITIONING_CONFIGS = cfg['partitioning']
+
+""" Task specific configs """
+AGG_FILE_INCREMENTAL = cfg['task_configs']['agg_file']['incremental']
+
 
 """ Input files """
 
@@ -1,21 +1,27 @@
 """ All Data Stores specified in the path"""
+import copy
 import logging
 from dataclasses import dataclass
-from typing import Optional, List
+from typing import Optional, List, Iterable, Iterator, Dict
 
-import gc
 import pandas as pd
-from joblib import parallel_backend, Parallel, delayed
 
-from project_starter_lib import constants
+from project_starter_lib import constants, instrumentation
 from project_starter_lib.config import config
-from project_starter_lib.data import schemas
+from project_starter_lib.data import file_formats, schemas
+from project_starter_lib.data.file_formats import FileFormat
+from project_starter_lib.data.schema_plan import compile_schema, SchemaPlan
+from project_starter_lib.data import schema_profiler
 from project_starter_lib.data.handlers.common import (
 	StorageHandler,
+	CopySummary,
 )
 
 logger = logging.getLogger(__name__)
 
+# Index of the parts written by write_chunks, in the folder of the parts
+PART_INDEX_FILE_NAME = '_parts.json'
+
 
 def checks(df, expected_schema):
 	"""Checks if the dataframe has all the columns as specified in the schema
@@ -28,75 +34,96 @@ def checks(df, expected_schema):
 	Returns
 	-------
 	type
-		Returns True if all checks are passed. Else, it raises an error with the right message
+		Returns True if all checks are passed. Else, it raises an error listing all the mismatches
 	"""
 
-	for key, value in expected_schema.items():
-		if value != 'str':
-			expected_schema[key] = value
-		else:
-			expected_schema[key] = 'object'
+	return compile_schema(expected_schema).validate(df)
 
-	# Checking that column names are identical
-	expected_columns = expected_schema.keys()
-	missing_cols = set(expected_columns).difference(df.columns)
-	additional_cols = set(df.columns).difference(expected_columns)
-	assert len(missing_cols) == 0, f"Missing Columns {missing_cols}"
-	assert len(additional_cols) == 0, f"Additional Columns {additional_cols}"
 
-	# Checking that datatypes are identical
-	# Get schema of input  df_billed_rev in string format
-	df_schema = df.dtypes.apply(lambda x: x.name).to_dict()
-	mismatched_cols = {
-		key: df_schema[key]
-		for key in df_schema
-		if df_schema[key] != expected_schema[key]
-	}
-	assert len(mismatched_cols) == 0, f"Data Types do not match the schema: {mismatched_cols}"
+def filter_mask(df: pd.DataFrame, filters: List) -> pd.Series:
+	"""Boolean mask of the rows of a data frame which match filters in the format of pd.read_parquet
+	Parameters
+	----------
+	df :
+		Dataframe
+	filters :
+		List of (column, op, value) tuples which are combined with AND, or a list of such lists combined with OR.
+		op is one of =, ==, !=, <, <=, >, >=, in, not in
+	Returns
+	-------
+	type
+		Boolean series
+	"""
+	# A single list of tuples is one conjunction
+	if len(filters) > 0 and isinstance(filters[0], tuple):
+		filters = [filters]
+
+	mask = pd.Series(False, index=df.index)
+	for conjunction in filters:
+		conjunction_mask = pd.Series(True, index=df.index)
+		for column, op, value in conjunction:
+			series = df[column]
+			if op in ['=', '==']:
+				conjunction_mask &= series == value
+			elif op == '!=':
+				conjunction_mask &= series != value
+			elif op == '<':
+				conjunction_mask &= series < value
+			elif op == '<=':
+				conjunction_mask &= series <= value
+			elif op == '>':
+				conjunction_mask &= series > value
+			elif op == '>=':
+				conjunction_mask &= series >= value
+			elif op == 'in':
+				conjunction_mask &= series.isin(value)
+			elif op == 'not in':
+				conjunction_mask &= ~series.isin(value)
+			else:
+				raise NotImplementedError(f"Filter operation {op}")
+		mask |= conjunction_mask
+	return mask
+
 
-	return True
+def _copy_on_write() -> bool:
+	""" Whether pandas copies data on write, so that a shallow copy of a data frame can not modify the original """
+	if int(pd.__version__.split('.')[0]) >= 3:
+		return True
+	return pd.options.mode.copy_on_write is True
+
+
+def digest_rows(df: pd.DataFrame) -> str:
+	"""Digest of the values of the rows of a data frame, which does not depend on the order of the rows
+	Parameters
+	----------
+	df :
+		Dataframe
+	Returns
+	-------
+	type
+		Hex digest
+	"""
+	digest = pd.util.hash_pandas_object(df, index=False).to_numpy().sum(dtype='uint64')
+	return f"{int(digest):016x}"
 
 
 def clean(df: pd.DataFrame, expected_schema: dict, int_to_string_cols=None):
 	"""Cleans the input Data Frame to a expected schema
 	Parameters
 	----------
-	id_cols: Should be a list of cols which are id and should be first converted to integer and then to string
 	df :
 		Dataframe
 	expected_schema :
 		Expected schema
+	int_to_string_cols :
+		Should be a list of cols which are id and should be first converted to integer and then to string
 	Returns
 	-------
 	type
 		cleaned data frame
-		:param expected_schema:
-		:param df:
-		:param int_to_string_cols:
 	"""
 
-	# Drop columns that are not present in expected columns
-	expected_columns_list = expected_schema.keys()
-	drop_col_list = [x for x in df.columns if x not in expected_columns_list]
-	df = df.drop(labels=drop_col_list, axis=1)
-	if len(drop_col_list) > 0:
-		logger.warning(f"Some columns are being dropped: {drop_col_list}")
-
-	input_dtypes = df.dtypes
-	# Changes dtypes to match the schema_dtypes
-	for column in input_dtypes.index:
-		if (str(input_dtypes[column]) != str(expected_schema[column])) or (
-				int_to_string_cols is not None and column in int_to_string_cols):
-			logger.info(f"Converting schema for {column} from {input_dtypes[column]} to {expected_schema[column]}")
-			# This is done because id cols if specified as object, become int
-			if expected_schema[column] == 'object' or (int_to_string_cols is not None and column in int_to_string_cols):
-				df[column] = df[column].astype(int, errors='raise').astype(str, errors='raise')
-			elif 'datetime' in expected_schema[column]:
-				df[column] = pd.to_datetime(df[column], errors="coerce", infer_datetime_format=True)
-			else:
-				df[column] = df[column].astype(expected_schema[column], errors='raise')
-	gc.collect()
-	return df
+	return compile_schema(expected_schema, int_to_string_cols=int_to_string_cols).coerce(df)
 
 
 class DataStore:
@@ -104,13 +131,17 @@ class DataStore:
 
 	def __init__(self,
 				 file_name,
-				 storage_handler: StorageHandler = config.STORAGE_HANDLER,
+				 storage_handler: StorageHandler = None,
 				 pipeline_name: str = None,
 				 task_name: str = None,
 				 pipeline_current_run_ids: dict = None,
 				 schema: dict = None,
 				 flag_copy_to_latest: bool = True,
 				 int_to_string_cols: List = None,
+				 strict_validation: bool = False,
+				 multipart: bool = False,
+				 downcast: bool = None,
+				 file_format: FileFormat = None,
 				 **kwargs):
 		"""
 		Initializes a DataStore instance that handles read/write of the intermediate data from/to disk.
@@ -119,7 +150,7 @@ class DataStore:
 		Parameters
 		----------
 		storage_handler
-			the handler to pull/push data to/from disk
+			the handler to pull/push data to/from disk. config.STORAGE_HANDLER if None
 		file_name
 			the file name or a list of file names
 		pipeline_name
@@ -128,20 +159,47 @@ class DataStore:
 			Task Name with which this datastore is associated with
 		schema
 			What is the schema of the data
+		strict_validation
+			If True, the data is validated against the schema on every access. By default it is only validated the
+			first time it is accessed after being read or assigned
+		multipart
+			If True, the data is stored as multiple parts `{file_name}/part-00000{extension}`, e.g. when written with
+			`write_chunks`
+		downcast
+			If True, integer and float columns which are not in the schema are downcast to the smallest dtype which
+			holds their values when the data is loaded or read, see schema_profiler.downcast. Defaults to
+			run_configs.downcast_on_load
+		file_format
+			Format and codec of the files written, e.g. FileFormat('parquet', 'zstd'). The extension of file_name is
+			replaced by the one of the format. Reads detect the format of the files, so data written in another format,
+			e.g. by earlier runs, is still read. As given by the extension of file_name if None
 		"""
-		self.storage_handler = storage_handler
+		self.storage_handler = config.STORAGE_HANDLER if storage_handler is None else storage_handler
 		self.pipeline_name = pipeline_name
 		self.task_name = str(task_name)
 		if pipeline_name is None:
 			self.read_run_id = None
 		else:
 			self.read_run_id = config.PIPELINE_READ_RUN_IDs[pipeline_name]
-		self.file_name = file_name
+		self.file_format = file_format
+		self.file_name = file_name if file_format is None else file_format.file_name(file_name)
 		self.pipeline_current_run_ids = pipeline_current_run_ids
 		self._data: Optional[pd.DataFrame] = None
 		self.schema = schema
+		self.schema_plan: Optional[SchemaPlan] = None
+		if schema is not None:
+			self.schema_plan = compile_schema(schema, int_to_string_cols=int_to_string_cols)
 		self.flag_copy_to_latest = flag_copy_to_latest
 		self.int_to_string_cols = int_to_string_cols
+		self.strict_validation = strict_validation
+		self.multipart = multipart
+		self.downcast = config.DOWNCAST_ON_LOAD if downcast is None else downcast
+		# Version of the schema plan the cached data was validated against. None if it has not been validated
+		self._validated_version: Optional[str] = None
+		# Results of `read` by columns and filters
+		self._projections = {}
+		# Sizes in bytes of the files seen by the HEAD requests and listings of reads, for the instrumentation
+		self._file_sizes: Dict[str, int] = {}
 		self.kwargs = kwargs
 
 	def clean_schema(self):
@@ -150,16 +208,8 @@ class DataStore:
 		:return:
 		"""
 
-		final_schema = {}
-		date_cols = []
-		for col_name in self.schema:
-			dtype = self.schema[col_name]
-			if 'datetime' in dtype:
-				date_cols.append(col_name)
-			else:
-				final_schema[col_name] = dtype
-
-		return final_schema, date_cols
+		reader_options = self.schema_plan.csv_reader_options()
+		return reader_options['dtype'], reader_options['parse_dates']
 
 	def create_file_path(self, run_id=None):
 		""" Create File Path to read/write from.
@@ -174,20 +224,252 @@ class DataStore:
 
 		return path
 
-	def _load(self):
-		path = self.create_file_path(run_id=self.read_run_id)
+	def create_manifest_path(self, run_id):
+		""" Path of the manifest listing all files written by the run """
+		return f'output_data/{config.ROOT_FOLDER_NAME}/{self.pipeline_name}/{run_id}/pipeline_run_info/manifests/' \
+			   f'{self.task_name}/{self.file_name}.json'
+
+	def create_latest_pointer_path(self):
+		""" Path of the pointer naming the run id which is the latest for this data store """
+		return f'output_data/{config.ROOT_FOLDER_NAME}/{self.pipeline_name}/latest_pointers/{self.task_name}/' \
+			   f'{self.file_name}.json'
+
+	def resolve_run_id(self, run_id):
+		"""
+		In manifest mode `latest` is not a folder but a pointer to a run id. Resolve it to that run id.
+		Falls back to the latest folder if no pointer has been written yet.
+		:param run_id:
+		:return:
+		"""
+		if run_id != 'latest' or config.LATEST_MODE != 'manifest':
+			return run_id
+
+		pointer_path = self.create_latest_pointer_path()
+		if len(self.storage_handler.list_files(prefix=pointer_path)) == 0:
+			logger.warning(f"No latest pointer found at {pointer_path}. Reading from the latest folder")
+			return run_id
 
-		# This is done so that we do not have to load the entire dataframe
-		if self.schema is not None:
-			if path.endswith(".csv"):
-				self.kwargs['usecols'] = self.schema.keys()
-				self.kwargs['dtype'], self.kwargs['parse_dates'] = self.clean_schema()
-			elif path.endswith(".parquet"):
-				self.kwargs['columns'] = list(self.schema.keys())
+		pointer = self.storage_handler.load(path=pointer_path)
+		logger.info(f"Latest of {self.file_name} points to run_id {pointer['run_id']}")
+		return pointer['run_id']
 
-		self._data = self.storage_handler.load(path=path, **self.kwargs)
+	def _read_path(self):
+		""" Path to read from, which is based on the read run id specified in the configs """
+		return self._detect_path(self.create_file_path(run_id=self.resolve_run_id(self.read_run_id)))
+
+	def _detect_path(self, path):
+		"""
+		Path of the data in the format it was written in. Data written in another format than the current one of the
+		data store has the same path with another extension, e.g. agg_file.csv instead of agg_file.parquet
+		:param path:
+		:return: path if the data is there or can not be found in any format
+		"""
+		stem, extension = file_formats.split_extension(path)
+		if not extension or self._has_data_at(path):
+			return path
+
+		# Files, or folders of parts, of the data in any format
+		candidates = []
+		for info in self.storage_handler.list_object_infos(prefix=f"{stem}."):
+			self._file_sizes[info.key] = info.size
+			name = info.key[len(stem):].split('/')[0]
+			if file_formats.split_extension(name) == ('', name) and stem + name not in candidates:
+				candidates.append(stem + name)
+		if len(candidates) == 0 or path in candidates:
+			return path
+
+		logger.info(f"No data at {path}. Reading {candidates[0]}, which has another format")
+		return candidates[0]
+
+	def _has_data_at(self, path) -> bool:
+		"""
+		Whether there is data at path, from a HEAD request of the file, or of the first part of a multipart data store,
+		instead of a listing
+		"""
+		if self.multipart:
+			candidates = [f"{path}/part-00000{file_formats.extension(path)}", path]
+		else:
+			candidates = [path]
+		for candidate in candidates:
+			try:
+				self._file_sizes[candidate] = self.storage_handler.head(candidate).size
+				return True
+			except Exception:
+				# Missing files raise FileNotFoundError on the local filesystem and ClientError on s3
+				continue
+		return False
+
+	def _write_path(self):
+		""" Path to write to, which is based on the current run id of the pipeline """
+		# This if condition to indicate that we do not want to use the context but directly want to use the file_name
+		# as path
+		if self.read_run_id is None:
+			return self.file_name
+		return self.create_file_path(run_id=self.pipeline_current_run_ids[self.pipeline_name])
+
+	def _reader_kwargs(self, path):
+		""" Read only the columns of the schema with the right dtypes so that we do not have to load everything """
+		reader_kwargs = dict(self.kwargs)
+		if self.schema_plan is not None:
+			file_format = file_formats.detect_format(path)
+			if file_format == 'csv':
+				reader_kwargs.update(self.schema_plan.csv_reader_options())
+			elif file_format in ['parquet', 'feather']:
+				reader_kwargs.update(self.schema_plan.parquet_reader_options())
+		return reader_kwargs
+
+	def _part_paths(self, path) -> List[str]:
+		"""
+		Paths of the files to read the data from, in order. For a multipart data store these are its parts, which have
+		the extension of the folder, or path itself if it is a single file, e.g. written before the data store was
+		multipart. Empty if there is no data
+		"""
+		if not self.multipart:
+			return [path]
+		infos = self.storage_handler.list_object_infos(prefix=path)
+		self._file_sizes.update({info.key: info.size for info in infos})
+		paths = [info.key for info in infos]
+		part_paths = sorted(
+			x for x in paths if x.startswith(f"{path}/part-") and x.endswith(file_formats.extension(path))
+		)
+		if len(part_paths) == 0 and path in paths:
+			logger.info(f"{path} has no parts. Reading it as a single file")
+			return [path]
+		return part_paths
+
+	def _empty_frame(self) -> pd.DataFrame:
+		""" Data frame without rows, with the columns and dtypes of the schema if there is one """
+		if self.schema_plan is None:
+			return pd.DataFrame()
+		return pd.DataFrame({col: pd.Series(dtype=dtype) for col, dtype in self.schema_plan.dtypes})
+
+	def _save_kwargs(self) -> dict:
+		""" Options of the storage handler to write the data in the format of the data store """
+		save_kwargs = dict(self.kwargs)
+		if self.file_format is not None:
+			save_kwargs.update(self.file_format.save_kwargs())
+		return save_kwargs
+
+	@property
+	def io_name(self) -> str:
+		""" Name of the data store in the instrumentation of the tasks """
+		if self.pipeline_name is None:
+			return self.file_name
+		return f"{self.pipeline_name}/{self.task_name}/{self.file_name}"
+
+	def _read_bytes(self, part_paths: List[str]) -> int:
+		""" Size of the files read, as seen by the HEAD request or listing of the read. 0 for files not seen by one """
+		return sum(self._file_sizes.get(part_path, 0) for part_path in part_paths)
+
+	def _record_io(self, rows: int, n_bytes: Optional[int], is_read: bool):
+		""" Add the rows and the bytes read or written to the metrics of the running task, if any """
+		if not instrumentation.is_recording():
+			return
+		n_bytes = n_bytes or 0
+		if is_read:
+			instrumentation.record_io(self.io_name, rows_read=rows, bytes_read=n_bytes)
+		else:
+			instrumentation.record_io(self.io_name, rows_written=rows, bytes_written=n_bytes)
+
+	def _load(self):
+		path = self._read_path()
+		reader_kwargs = self._reader_kwargs(path)
+
+		part_paths = self._part_paths(path)
+		if self.multipart:
+			if len(part_paths) == 0:
+				logger.warning(f"No data at {path}. Using an empty data frame")
+				self._data = self._empty_frame()
+			else:
+				self._data = pd.concat(
+					[self.storage_handler.load(path=part_path, **reader_kwargs) for part_path in part_paths],
+					axis=0,
+					ignore_index=True
+				)
+		else:
+			self._data = self.storage_handler.load(path=path, **reader_kwargs)
 		if isinstance(self._data, pd.DataFrame):
 			logger.info(f"Read {path} with shape: {self._data.shape}")
+			if self.downcast:
+				self._data = self._downcast(self._data)
+		self._record_io(rows=len(self._data) if isinstance(self._data, pd.DataFrame) else 0,
+						n_bytes=self._read_bytes(part_paths), is_read=True)
+
+	def _downcast(self, df: pd.DataFrame) -> pd.DataFrame:
+		""" Downcast the columns which are not in the schema. The schema decides the dtypes of its columns """
+		return schema_profiler.downcast(df, exclude=self.schema_plan.columns if self.schema_plan is not None else ())
+
+	def iter_chunks(self, chunksize: int, parts: List[dict] = None) -> Iterator[pd.DataFrame]:
+		"""
+		Stream the data in chunks of at most chunksize rows instead of loading everything into memory.
+		If a schema is specified, every chunk is cleaned and validated against it.
+		:param chunksize:
+		:param parts: Entries of part_index of the parts to read, without listing them. All parts if None
+		:return: Iterator of data frames
+		"""
+		path = self._read_path()
+		reader_kwargs = self._reader_kwargs(path)
+		if parts is None:
+			part_paths = self._part_paths(path)
+		else:
+			part_paths = [f"{path}/{part['name']}" for part in parts]
+			self._file_sizes.update({f"{path}/{part['name']}": part['size'] or 0 for part in parts})
+		if len(part_paths) == 0:
+			logger.warning(f"No data at {path}. Streaming an empty data frame")
+			yield self._empty_frame()
+
+		n_rows = 0
+		for part_path in part_paths:
+			for chunk in self.storage_handler.load_chunks(path=part_path, chunksize=chunksize, **reader_kwargs):
+				if self.schema_plan is not None:
+					chunk = self.schema_plan.apply(chunk)
+				n_rows += len(chunk)
+				yield chunk
+		logger.info(f"Streamed {n_rows} rows from {path}")
+		self._record_io(rows=n_rows, n_bytes=self._read_bytes(part_paths), is_read=True)
+
+	def part_index(self) -> Optional[List[dict]]:
+		"""
+		Name, size, number of rows and digest of the rows (see digest_rows) of every part, in order, as written by
+		write_chunks. None if the data has no index, e.g. because it was written by an older version
+		:return:
+		"""
+		index_path = f"{self._read_path()}/{PART_INDEX_FILE_NAME}"
+		if len(self.storage_handler.list_files(prefix=index_path)) == 0:
+			return None
+		return self.storage_handler.load(path=index_path)['parts']
+
+	def write_chunks(self, chunks: Iterable[pd.DataFrame]) -> int:
+		"""
+		Write an iterator of chunks as multiple parts, one part per chunk, so that only one chunk has to be in memory
+		at a time. The data store should be created with multipart=True to read the parts back.
+		The parts are listed in an index, see part_index, from which readers can tell which parts changed without
+		reading them.
+		:param chunks:
+		:return: Number of parts written
+		"""
+		path_to_save = self._write_path()
+		extension = file_formats.extension(self.file_name)
+
+		# Remove parts of a previous write, which could be more than the ones we write now
+		self.storage_handler.delete(path=f"{path_to_save}/part-")
+
+		parts = []
+		for chunk in chunks:
+			part_name = f"part-{len(parts):05d}{extension}"
+			logger.info(f"Writing {len(chunk)} rows to {path_to_save}/{part_name}")
+			size = self.storage_handler.save(f"{path_to_save}/{part_name}", chunk, **self._save_kwargs())
+			parts.append({'name': part_name, 'size': size, 'n_rows': len(chunk), 'digest': digest_rows(chunk)})
+		self.storage_handler.save(f"{path_to_save}/{PART_INDEX_FILE_NAME}", {'parts': parts})
+		self._record_io(rows=sum(part['n_rows'] for part in parts), n_bytes=sum(part['size'] or 0 for part in parts),
+						is_read=False)
+
+		if self.flag_copy_to_latest:
+			self.publish_to_latest()
+
+		# The data is not kept in memory, it will be read again on next access
+		del self.data
+		return len(parts)
 
 	@property
 	def data(self) -> pd.DataFrame:
@@ -196,37 +478,163 @@ class DataStore:
 		if self._data is None:
 			self._load()
 
-		if self.schema is not None:
-			try:
-				checks(self._data, expected_schema=self.schema)
-			except AssertionError:
-				logger.warning(f"{self.file_name} has mismatched schema. Trying to clean")
-				self._data = clean(self._data, expected_schema=self.schema, int_to_string_cols=self.int_to_string_cols)
+		if self.schema_plan is not None and (
+				self.strict_validation or self._validated_version != self.schema_plan.version):
+			problems = self.schema_plan.problems(self._data)
+			if len(problems) > 0:
+				logger.warning(f"{self.file_name} has mismatched schema: {problems}. Trying to clean")
+				self._data = self.schema_plan.coerce(self._data)
+			self._validated_version = self.schema_plan.version
 
 		return self._data
 
 	@data.setter
 	def data(self, data):
 
-		# This if condition to indicate that we do not want to use the context but directly want to use the file_name
-		# as path
-		if self.read_run_id is None:
-			path_to_save = self.file_name
-		else:
-			path_to_save = self.create_file_path(run_id=self.pipeline_current_run_ids[self.pipeline_name])
+		path_to_save = self._write_path()
 
 		logger.info(f"Writing file to {path_to_save} with parition_cols {self.kwargs.get('partition_cols')}")
 
-		self.storage_handler.save(path_to_save, data, **self.kwargs)
+		n_bytes = self.storage_handler.save(path_to_save, data, **self._save_kwargs())
+		self._record_io(rows=len(data) if isinstance(data, pd.DataFrame) else 0, n_bytes=n_bytes, is_read=False)
 
 		# Also save it to the latest folder
 		if self.flag_copy_to_latest:
-			self.copy_to_latest()
+			self.publish_to_latest()
 		self._data = data
+		self.invalidate()
 
 	@data.deleter
 	def data(self):
 		self._data = None
+		self.invalidate()
+
+	def invalidate(self):
+		"""
+		Forget that the cached data has been validated, so that it is validated again on next access, and drop the
+		cached results of `read`. Needs to be called after modifying the data returned by `data` in place.
+		"""
+		self._validated_version = None
+		self._projections = {}
+
+	def read(self, columns: List[str] = None, where: List = None) -> pd.DataFrame:
+		"""
+		Read only some columns and rows of the data instead of materializing everything.
+		For parquet the columns and filters are pushed down to the reader, which skips row groups and partitions that
+		do not match. CSV is read in chunks which are filtered one at a time.
+		Results are cached per columns and filters until the data is reassigned or invalidated. Callers get a copy, so
+		modifying the result does not modify the cache.
+		:param columns: Columns to read. All columns of the schema (or file) if None
+		:param where: Filters in the format of pd.read_parquet, e.g. [('Key', '=', 1), ('Value', '>', 10)].
+			See filter_mask
+		:return:
+		"""
+		projection_key = (tuple(columns) if columns is not None else None, repr(where))
+		if projection_key in self._projections:
+			return self._projections[projection_key].copy(deep=not _copy_on_write())
+
+		path = self._read_path()
+		reader_kwargs = self._reader_kwargs(path)
+		part_paths = self._part_paths(path)
+
+		# Columns needed to apply the filters are read as well and dropped afterwards
+		filter_columns = []
+		if where:
+			filter_conjunctions = [where] if isinstance(where[0], tuple) else where
+			filter_columns = [col for conjunction in filter_conjunctions for col, _, _ in conjunction]
+		read_columns = None if columns is None else list(dict.fromkeys(list(columns) + filter_columns))
+
+		is_csv = file_formats.is_csv(path)
+		if read_columns is not None:
+			if is_csv:
+				reader_kwargs['usecols'] = read_columns
+				if 'dtype' in reader_kwargs:
+					reader_kwargs['dtype'] = {k: v for k, v in reader_kwargs['dtype'].items() if k in read_columns}
+				if 'parse_dates' in reader_kwargs:
+					reader_kwargs['parse_dates'] = [x for x in reader_kwargs['parse_dates'] if x in read_columns]
+			else:
+				reader_kwargs['columns'] = read_columns
+
+		chunks = []
+		for part_path in part_paths:
+			if is_csv:
+				for chunk in self.storage_handler.load_chunks(path=part_path, chunksize=config.CHUNK_SIZE, **reader_kwargs):
+					chunks.append(chunk[filter_mask(chunk, where)] if where else chunk)
+			else:
+				reader_kwargs['filters'] = where
+				chunks.append(self.storage_handler.load(path=part_path, **reader_kwargs))
+		if len(chunks) == 0:
+			logger.warning(f"No data at {path}. Using an empty data frame")
+			df = self._empty_frame()
+			if read_columns is not None:
+				df = df.reindex(columns=read_columns)
+		else:
+			df = chunks[0] if len(chunks) == 1 else pd.concat(chunks, axis=0, ignore_index=True)
+
+		if columns is not None:
+			df = df[list(columns)]
+		if self.schema_plan is not None:
+			df = compile_schema(
+				{col: dtype for col, dtype in self.schema_plan.dtypes if col in df.columns},
+				int_to_string_cols=[x for x in self.schema_plan.int_to_string_cols if x in df.columns]
+			).apply(df)
+		if self.downcast:
+			df = self._downcast(df)
+
+		logger.info(f"Read {path} with columns {columns} and filters {where} with shape: {df.shape}")
+		# Bytes of the whole files, even if only a part of them is read
+		self._record_io(rows=len(df), n_bytes=self._read_bytes(part_paths), is_read=True)
+		self._projections[projection_key] = df
+		return df.copy(deep=not _copy_on_write())
+
+	def exists(self) -> bool:
+		""" Whether there is data to read """
+		return len(self.storage_handler.list_files(prefix=self._read_path())) > 0
+
+	def fingerprint(self) -> List[List[str]]:
+		"""
+		Identifies the data that would be read: path and etag of every file at the read path. The etag changes whenever
+		the content of a file changes.
+		:return:
+		"""
+		path = self._read_path()
+		return [[x.key[len(path):], x.etag] for x in self.storage_handler.list_object_infos(prefix=path)]
+
+	def at_run(self, run_id) -> 'DataStore':
+		"""
+		Copy of this data store which reads the data written by the given run id
+		:param run_id:
+		:return:
+		"""
+		data_store = copy.copy(self)
+		data_store.read_run_id = run_id
+		data_store.kwargs = dict(self.kwargs)
+		data_store._data = None
+		data_store.invalidate()
+		return data_store
+
+	def list_run_ids(self) -> List[str]:
+		"""
+		All run ids of the pipeline which have written this data store, in chronological order. Does not include latest
+		:return:
+		"""
+		prefix = f'output_data/{config.ROOT_FOLDER_NAME}/{self.pipeline_name}/'
+		run_ids = set()
+		for path in self.storage_handler.list_files(prefix=prefix):
+			# {run_id}/{task_name}/{file_name}[/part]
+			parts = path[len(prefix):].split('/')
+			if len(parts) >= 3 and parts[0] != 'latest' and parts[1] == self.task_name and self._is_same_data(parts[2]):
+				run_ids.add(parts[0])
+
+		# Run ids start with a timestamp, so they sort chronologically
+		return sorted(run_ids)
+
+	def _is_same_data(self, file_name) -> bool:
+		""" Whether file_name is the file name of this data store, in any format """
+		if file_name == self.file_name:
+			return True
+		stem, extension = file_formats.split_extension(file_name)
+		return bool(extension) and stem == file_formats.split_extension(self.file_name)[0]
 
 	def list_files(self) -> List[str]:
 		""" List all files """
@@ -235,25 +643,60 @@ class DataStore:
 
 		return matches
 
-	def copy_to_latest(self, run_id=None):
+	def publish_to_latest(self, run_id=None):
+		""" Make the data of run_id the latest, either by copying it or by pointing to it. See run_configs.latest_mode """
+		if config.LATEST_MODE == 'manifest':
+			self.promote_to_latest(run_id=run_id)
+		else:
+			self.copy_to_latest(run_id=run_id)
+
+	def copy_to_latest(self, run_id=None) -> CopySummary:
 		"""
 		Copy Files from run_id folder to latest folder
 		:param run_id:
-		:param file_path:
-		:param source_run_id:
-		:return:
+		:return: Summary of the copied objects
 		"""
 		if run_id is None:
 			run_id = self.pipeline_current_run_ids[self.pipeline_name]
 
-		# Delete data in latest folder first
-		self.storage_handler.delete(path=self.create_file_path(run_id='latest'))
-		all_source_files = self.storage_handler.list_files(prefix=self.create_file_path(run_id=run_id))
-		with parallel_backend("multiprocessing", n_jobs=16):
-			Parallel()(
-				delayed(self.storage_handler.copy)(from_path, from_path.replace(run_id, 'latest'))
-				for from_path in all_source_files
-			)
+		# Data in latest folder is deleted by the copy first
+		summary = self.storage_handler.copy_prefix(
+			source_prefix=self.create_file_path(run_id=run_id),
+			dest_prefix=self.create_file_path(run_id='latest'),
+			max_workers=config.STORAGE_COPY_MAX_WORKERS,
+		)
+		logger.info(f"Copied {summary.objects_copied} objects ({summary.bytes_copied} bytes) of {self.file_name} to "
+					f"latest")
+		return summary
+
+	def promote_to_latest(self, run_id=None) -> dict:
+		"""
+		Write a manifest of all the files of run_id and point latest to it. Unlike copy_to_latest no data is copied,
+		promoting is a single write of the pointer.
+		:param run_id:
+		:return: The pointer
+		"""
+		if run_id is None:
+			run_id = self.pipeline_current_run_ids[self.pipeline_name]
+
+		manifest_path = self.create_manifest_path(run_id=run_id)
+		manifest = {
+			'pipeline_name': self.pipeline_name,
+			'task_name'    : self.task_name,
+			'file_name'    : self.file_name,
+			'run_id'       : run_id,
+			'files'        : self.storage_handler.list_files(prefix=self.create_file_path(run_id=run_id)),
+		}
+		self.storage_handler.save(manifest_path, manifest)
+
+		pointer = {
+			'run_id'  : run_id,
+			'manifest': manifest_path,
+		}
+		self.storage_handler.save(self.create_latest_pointer_path(), pointer)
+		logger.info(f"Latest of {self.file_name} now points to run_id {run_id} with {len(manifest['files'])} files")
+
+		return pointer
 
 	def upload_to_cloud(self, local_path):
 		"""
@@ -274,9 +717,13 @@ class DataStore:
 
 		if run_id is None:
 			run_id = config.PIPELINE_READ_RUN_IDs[self.pipeline_name]
+		run_id = self.resolve_run_id(run_id)
 
 		all_source_files = self.storage_handler.list_files(prefix=self.create_file_path(run_id=run_id))
-		all_source_files = [x for x in all_source_files if x.endswith(self.file_name.split(".")[-1])]
+		all_source_files = [x for x in all_source_files if x.endswith(file_formats.extension(self.file_name))]
+
+		# Only needed here, not imported at the top to keep the import of the data stores fast
+		from joblib import parallel_backend, Parallel, delayed
 
 		with parallel_backend("multiprocessing", n_jobs=16):
 			Parallel()(
@@ -302,7 +749,10 @@ class AllDataStores:
 			pipeline_name=constants.PIPELINE_INGEST_SOURCE_DATA,
 			task_name=constants.TASK_INGEST_FILE,
 			pipeline_current_run_ids=self.pipeline_current_ids,
-			schema=schemas.INPUT_INGEST_FILE
+			schema=schemas.INPUT_INGEST_FILE,
+			# Written in chunks by the ingest_file task
+			multipart=True,
+			file_format=FileFormat.from_config(config.STORAGE_FORMATS_CONFIGS.get('ingest_file')),
 		)
 
 		self.aggregated_file = DataStore(
@@ -310,5 +760,14 @@ class AllDataStores:
 			pipeline_name=constants.PIPELINE_AGG_DATA,
 			task_name=constants.TASK_AGG_FILE,
 			pipeline_current_run_ids=self.pipeline_current_ids,
-			schema=schemas.INPUT_AGG_FILE
+			schema=schemas.INPUT_AGG_FILE,
+			file_format=FileFormat.from_config(config.STORAGE_FORMATS_CONFIGS.get('aggregated_file')),
+		)
+
+		# Partial aggregates per key and the last ingest run folded into them. Used by the incremental mode of agg_file
+		self.aggregated_file_state = DataStore(
+			file_name="agg_file_state.pkl",
+			pipeline_name=constants.PIPELINE_AGG_DATA,
+			task_name=constants.TASK_AGG_FILE,
+			pipeline_current_run_ids=self.pipeline_current_ids,
 		)
\ No newline at end of file
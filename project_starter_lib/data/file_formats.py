@@ -0,0 +1,107 @@
+""" Formats and compression codecs of the files of data stores
+
+The format of a file is given by its extension, so readers detect it without any setting:
+	.csv, .csv.gz, .csv.zst     csv, uncompressed or compressed with gzip or zstd
+	.parquet, .parquet.gzip     parquet. The codec is stored in the file
+	.feather, .arrow            Arrow IPC. The codec is stored in the file
+Compressed csv files are compressed and decompressed by arrow, so zstd needs no other package.
+"""
+from dataclasses import dataclass
+from typing import Optional, Tuple
+
+# Extension -> (format, compression). Checked in this order, so .parquet.gzip is found before .parquet
+EXTENSIONS = {
+	'.csv.gz'      : ('csv', 'gzip'),
+	'.csv.zst'     : ('csv', 'zstd'),
+	'.parquet.gzip': ('parquet', None),
+	'.parquet'     : ('parquet', None),
+	'.feather'     : ('feather', None),
+	'.arrow'       : ('feather', None),
+	'.csv'         : ('csv', None),
+	# Name of some csv files uploaded to s3
+	'.csv.'        : ('csv', None),
+}
+
+# Codecs of every format. None is the default of the format: uncompressed csv, snappy parquet and lz4 feather
+COMPRESSIONS = {
+	'csv'    : [None, 'gzip', 'zstd'],
+	'parquet': [None, 'none', 'snappy', 'gzip', 'zstd', 'lz4', 'brotli'],
+	'feather': [None, 'uncompressed', 'lz4', 'zstd'],
+}
+
+
+def split_extension(file_name: str) -> Tuple[str, str]:
+	""" (stem, extension) of a file name, e.g. ('agg_file', '.csv.gz'). The extension is empty if it is not known """
+	for extension in EXTENSIONS:
+		if file_name.endswith(extension):
+			return file_name[:-len(extension)], extension
+	return file_name, ''
+
+
+def extension(file_name: str) -> str:
+	""" Extension of a file name, e.g. .csv.gz. The last suffix, e.g. .pkl, if it is not the one of a known format """
+	_, known_extension = split_extension(file_name)
+	return known_extension or f".{file_name.split('.')[-1]}"
+
+
+def detect_format(path: str) -> Optional[str]:
+	""" csv, parquet or feather from the extension of path. None for other files, e.g. .pkl or .json """
+	_, extension = split_extension(path)
+	return EXTENSIONS[extension][0] if extension else None
+
+
+def csv_compression(path: str) -> Optional[str]:
+	""" Codec of a csv file from its extension. None if it is not compressed """
+	_, extension = split_extension(path)
+	return EXTENSIONS[extension][1] if extension else None
+
+
+def is_csv(path: str) -> bool:
+	return detect_format(path) == 'csv'
+
+
+@dataclass(frozen=True)
+class FileFormat:
+	""" Format in which a data store writes its files """
+	# csv, parquet or feather
+	format: str = 'csv'
+	# See COMPRESSIONS
+	compression: Optional[str] = None
+	# Level of the codec. None for its default
+	compression_level: Optional[int] = None
+	# Rows per row group of parquet files. None for the default of pyarrow
+	row_group_size: Optional[int] = None
+
+	def __post_init__(self):
+		assert self.format in COMPRESSIONS, f"Unknown format {self.format}. Should be one of {list(COMPRESSIONS)}"
+		assert self.compression in COMPRESSIONS[self.format], \
+			f"Unknown compression {self.compression} of {self.format}. Should be one of {COMPRESSIONS[self.format]}"
+		assert self.row_group_size is None or self.format == 'parquet', "row_group_size is only used by parquet"
+
+	@classmethod
+	def from_config(cls, configs: Optional[dict]) -> Optional['FileFormat']:
+		""" From a section of data_store_formats in config.yaml. None if there is none """
+		if not configs:
+			return None
+		return cls(**{key: value for key, value in configs.items() if value is not None})
+
+	@property
+	def extension(self) -> str:
+		if self.format == 'csv':
+			return {None: '.csv', 'gzip': '.csv.gz', 'zstd': '.csv.zst'}[self.compression]
+		return f'.{self.format}'
+
+	def file_name(self, file_name: str) -> str:
+		""" file_name with the extension of this format, e.g. agg_file.csv -> agg_file.parquet """
+		stem, _ = split_extension(file_name)
+		return stem + self.extension
+
+	def save_kwargs(self) -> dict:
+		""" Options of StorageHandler.save. The codec of csv files is given by their extension """
+		kwargs = {
+			'compression'      : None if self.format == 'csv' else self.compression,
+			# The level of the default codec is left to the writer
+			'compression_level': self.compression_level if self.compression is not None else None,
+			'row_group_size'   : self.row_group_size,
+		}
+		return {key: value for key, value in kwargs.items() if value is not None}
@@ -0,0 +1,278 @@
+""" Storage handler which keeps a local copy of everything read through another (remote) storage handler """
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+from typing import List
+
+from project_starter_lib.data.handlers.common import StorageHandler, CopySummary, ObjectInfo
+from project_starter_lib.data.handlers.local import LocalStorageHandler
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class CacheStats:
+	""" Statistics of the cache since the handler was created """
+	hits: int = 0
+	misses: int = 0
+	evictions: int = 0
+	bytes_downloaded: int = 0
+	bytes_evicted: int = 0
+
+
+class CachingStorageHandler(StorageHandler):
+	"""
+	Read-through cache in front of another storage handler.
+	Every object read by `load` is downloaded once to cache_dir and read from local disk afterwards. Cache entries are
+	keyed by bucket, key and ETag and revalidated with a listing on each load, so a changed object is downloaded
+	again. The least recently used entries are evicted when the cache grows beyond max_bytes.
+	Processes sharing cache_dir, e.g. the workers of a process pool, merge their entries into index.json under a file
+	lock.
+	All other methods are passed through to the wrapped handler.
+	"""
+
+	def __init__(self, storage_handler: StorageHandler, cache_dir: str, max_bytes: int):
+		"""
+		Parameters
+		----------
+		storage_handler
+			Handler to read from on a cache miss
+		cache_dir
+			Local directory in which the cached objects are stored
+		max_bytes
+			Maximum total size of the cached objects
+		"""
+		self.storage_handler = storage_handler
+		self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+		self.max_bytes = max_bytes
+		self.stats = CacheStats()
+		self._lock = threading.RLock()
+		# entry id -> {'bucket', 'key', 'etag', 'size', 'local_path'}. Ordered from least to most recently used
+		self._index = self._read_index()
+
+	def __getstate__(self):
+		""" Locks cannot be pickled, e.g. when sent to a joblib worker """
+		state = self.__dict__.copy()
+		state.pop('_lock')
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.RLock()
+
+	def __getattr__(self, item):
+		""" Everything not related to the cache, e.g. confirm_access, comes from the wrapped handler """
+		if item == 'storage_handler':
+			raise AttributeError(item)
+		return getattr(self.storage_handler, item)
+
+	@property
+	def index_path(self):
+		return os.path.join(self.cache_dir, "index.json")
+
+	@property
+	def cached_bytes(self) -> int:
+		""" Total size of all cached objects """
+		return sum(entry['size'] for entry in self._index.values())
+
+	@staticmethod
+	def _entry_id(info: ObjectInfo):
+		return f"{info.bucket}/{info.key}"
+
+	def _bucket_dir(self, bucket):
+		""" Objects of each bucket are stored in their own folder with the same layout as in the bucket """
+		return os.path.join(self.cache_dir, "objects", hashlib.sha256(bucket.encode()).hexdigest()[:16])
+
+	def _read_index(self) -> OrderedDict:
+		if not os.path.exists(self.index_path):
+			return OrderedDict()
+		with open(self.index_path) as f:
+			index = OrderedDict(json.load(f))
+
+		# Files could have been removed by someone else
+		return OrderedDict((k, v) for k, v in index.items() if os.path.exists(v['local_path']))
+
+	@contextlib.contextmanager
+	def _index_file_lock(self):
+		""" Exclusive lock of index.json between processes """
+		os.makedirs(self.cache_dir, exist_ok=True)
+		with open(os.path.join(self.cache_dir, "index.lock"), 'w') as f:
+			fcntl.flock(f, fcntl.LOCK_EX)
+			try:
+				yield
+			finally:
+				fcntl.flock(f, fcntl.LOCK_UN)
+
+	def _merge_index(self):
+		""" Add the entries written to index.json by other processes since it was read, as least recently used """
+		for entry_id, entry in reversed(list(self._read_index().items())):
+			if entry_id not in self._index:
+				self._index[entry_id] = entry
+				self._index.move_to_end(entry_id, last=False)
+
+	def _write_index(self):
+		""" Must be called with the index file lock held, after _merge_index """
+		tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+		with open(tmp_path, 'w') as f:
+			json.dump(list(self._index.items()), f)
+		os.replace(tmp_path, self.index_path)
+
+	def _remove_entry(self, entry_id):
+		entry = self._index.pop(entry_id)
+		if os.path.exists(entry['local_path']):
+			os.remove(entry['local_path'])
+		return entry
+
+	def _evict(self, pinned: List[str]):
+		""" Evict least recently used entries until the cache fits in max_bytes. Pinned entries are never evicted """
+		cached_bytes = self.cached_bytes
+		for entry_id in list(self._index.keys()):
+			if cached_bytes <= self.max_bytes:
+				break
+			if entry_id in pinned:
+				continue
+			entry = self._remove_entry(entry_id)
+			cached_bytes -= entry['size']
+			self.stats.evictions += 1
+			self.stats.bytes_evicted += entry['size']
+			logger.debug(f"Evicted {entry['key']} from cache")
+
+	def _ensure_cached(self, info: ObjectInfo):
+		""" Download an object if it is not in the cache with the same ETag and mark it as most recently used """
+		entry_id = self._entry_id(info)
+		with self._lock:
+			entry = self._index.get(entry_id)
+			if entry is not None and entry['etag'] == info.etag and os.path.exists(entry['local_path']):
+				self._index.move_to_end(entry_id)
+				self.stats.hits += 1
+				return
+			if entry is not None:
+				# Stale entry
+				self._remove_entry(entry_id)
+			self.stats.misses += 1
+
+		local_path = os.path.join(self._bucket_dir(info.bucket), info.key)
+		os.makedirs(os.path.dirname(local_path), exist_ok=True)
+		tmp_path = f"{local_path}.{os.getpid()}.{threading.get_ident()}.tmp"
+		self.storage_handler.download_file(info.key, tmp_path)
+		os.replace(tmp_path, local_path)
+
+		with self._lock:
+			self._index[entry_id] = {
+				'bucket'    : info.bucket,
+				'key'       : info.key,
+				'etag'      : info.etag,
+				'size'      : info.size,
+				'local_path': local_path,
+			}
+			self.stats.bytes_downloaded += info.size
+
+	def _remove_stale_files(self, bucket, path, keys: List[str]):
+		"""
+		Remove the local files in the folder of path which are not one of the keys, e.g. parts of a partitioned dataset
+		which was written again with other part names
+		:param bucket:
+		:param path:
+		:param keys: Keys of all objects of path
+		:return:
+		"""
+		bucket_dir = self._bucket_dir(bucket)
+		local_dir = os.path.join(bucket_dir, path)
+		if not os.path.isdir(local_dir):
+			return
+
+		keys = set(keys)
+		with self._lock:
+			for root, _, file_names in os.walk(local_dir, topdown=False):
+				for file_name in file_names:
+					local_path = os.path.join(root, file_name)
+					key = os.path.relpath(local_path, bucket_dir).replace(os.sep, '/')
+					# Temporary files are downloads in progress
+					if key in keys or file_name.endswith('.tmp'):
+						continue
+					entry_id = f"{bucket}/{key}"
+					if entry_id in self._index:
+						self._remove_entry(entry_id)
+					else:
+						os.remove(local_path)
+					logger.debug(f"Removed {key} from cache, which is not in {path} anymore")
+				if len(os.listdir(root)) == 0:
+					os.rmdir(root)
+
+	def _cached_handler(self, path) -> LocalStorageHandler:
+		"""
+		Make sure an object (or all objects of a partitioned dataset) is in the local cache, downloading what is
+		missing or has changed
+		:param path:
+		:return: Handler to read the local copy
+		"""
+		# A partitioned dataset consists of all objects in the folder named path. The listing has their ETags
+		infos = [
+			x for x in self.storage_handler.list_object_infos(prefix=path)
+			if x.key == path or x.key.startswith(path + '/')
+		]
+		if len(infos) == 0:
+			infos = [self.storage_handler.head(path)]
+
+		# The local copy of path is read as a whole, so it must only have the listed objects
+		self._remove_stale_files(infos[0].bucket, path, [info.key for info in infos])
+		for info in infos:
+			self._ensure_cached(info)
+
+		with self._lock, self._index_file_lock():
+			self._merge_index()
+			self._evict(pinned=[self._entry_id(info) for info in infos])
+			self._write_index()
+
+		logger.info(f"Reading {path} from cache. Cache stats: {asdict(self.stats)}")
+		return LocalStorageHandler(root_dir=self._bucket_dir(infos[0].bucket))
+
+	def load(self, path, **kwargs):
+		return self._cached_handler(path).load(path, **kwargs)
+
+	def load_chunks(self, path, chunksize, **kwargs):
+		return self._cached_handler(path).load_chunks(path, chunksize, **kwargs)
+
+	def clear(self):
+		""" Remove all cached objects """
+		with self._lock, self._index_file_lock():
+			self._merge_index()
+			for entry_id in list(self._index.keys()):
+				self._remove_entry(entry_id)
+			self._write_index()
+
+	def save(self, file_path, data, **kwargs):
+		return self.storage_handler.save(file_path, data, **kwargs)
+
+	def list_files(self, prefix: str = "", suffix: str = "") -> List[str]:
+		return self.storage_handler.list_files(prefix=prefix, suffix=suffix)
+
+	def copy(self, source_location, dest_location, **kwargs):
+		self.storage_handler.copy(source_location, dest_location, **kwargs)
+
+	def copy_prefix(self, source_prefix, dest_prefix, max_workers=16, **kwargs) -> CopySummary:
+		return self.storage_handler.copy_prefix(source_prefix, dest_prefix, max_workers=max_workers, **kwargs)
+
+	def upload(self, local_path, dest_path, **kwqrgs):
+		self.storage_handler.upload(local_path, dest_path, **kwqrgs)
+
+	def delete(self, path: str, **kwargs):
+		return self.storage_handler.delete(path, **kwargs)
+
+	def download(self, to_dir, from_path, file_name, **kwargs):
+		self.storage_handler.download(to_dir, from_path, file_name, **kwargs)
+
+	def download_file(self, path, local_path):
+		self.storage_handler.download_file(path, local_path)
+
+	def head(self, path) -> ObjectInfo:
+		return self.storage_handler.head(path)
+
+	def list_object_infos(self, prefix) -> List[ObjectInfo]:
+		return self.storage_handler.list_object_infos(prefix)
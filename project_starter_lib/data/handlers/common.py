@@ -1,13 +1,83 @@
 """ Base class handlers handler inherited by others"""
 
+import io
 from abc import abstractmethod
-from typing import Union, List
+from dataclasses import dataclass
+from typing import Union, List, Optional, Iterator
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+from project_starter_lib.data.file_formats import csv_compression
 
 """ Set handler variables to be used throughout the codebase"""
 
 
+@dataclass
+class CopySummary:
+	""" Summary of a copy of all files below a prefix """
+	objects_copied: int
+	bytes_copied: Optional[int] = None
+	objects_deleted: Optional[int] = None
+	seconds: Optional[float] = None
+
+
+@dataclass
+class ObjectInfo:
+	""" Metadata of a stored object. The etag changes whenever the content of the object changes """
+	bucket: str
+	key: str
+	etag: str
+	size: int
+
+
+def iter_dataset_chunks(source: str, chunksize: int, file_format: str = 'parquet', filesystem=None,
+						columns: List[str] = None, filters=None) -> Iterator[pd.DataFrame]:
+	"""
+	Read a parquet/feather file or a partitioned folder of files in batches of at most chunksize rows
+	:param source: Path of the file or folder
+	:param chunksize: Maximum number of rows per chunk
+	:param file_format: parquet or ipc (feather)
+	:param filesystem: pyarrow or fsspec file system, e.g. s3fs. Local file system if None
+	:param columns: Columns to read
+	:param filters: Filters in the format of pd.read_parquet
+	:return:
+	"""
+	dataset = ds.dataset(source, format=file_format, filesystem=filesystem, partitioning='hive')
+	filter_expression = pq.filters_to_expression(filters) if filters else None
+	for batch in dataset.to_batches(columns=columns, filter=filter_expression, batch_size=chunksize):
+		yield batch.to_pandas()
+
+
+def compress_csv(data: pd.DataFrame, path: str, compression_level: int = None, **kwargs) -> bytes:
+	"""
+	The data frame as a csv file compressed with the codec of the extension of path, e.g. zstd for .csv.zst
+	:param data:
+	:param path:
+	:param compression_level: Level of the codec. None for its default
+	:param kwargs: Options of to_csv
+	:return:
+	"""
+	buffer = io.BytesIO()
+	data.to_csv(buffer, index=False, **kwargs)
+	return pa.Codec(csv_compression(path), compression_level).compress(buffer.getbuffer(), asbytes=True)
+
+
+def csv_source(source: pa.NativeFile, path: str) -> pa.NativeFile:
+	""" Source of the csv file at path for pd.read_csv, decompressed while it is read if the file is compressed """
+	compression = csv_compression(path)
+	return source if compression is None else pa.CompressedInputStream(source, compression)
+
+
+def parquet_options(compression: str = None, compression_level: int = None, row_group_size: int = None,
+					**kwargs) -> dict:
+	""" Options of to_parquet among the kwargs of StorageHandler.save. Options which are not set keep their defaults """
+	options = {'compression': compression, 'compression_level': compression_level, 'row_group_size': row_group_size}
+	return {key: value for key, value in options.items() if value is not None}
+
+
 class StorageHandler:
 	""" """
 
@@ -19,14 +89,31 @@ class StorageHandler:
 	def load(self, path: str, **kwargs) -> pd.DataFrame:
 		pass
 
+	def load_chunks(self, path: str, chunksize: int, **kwargs) -> Iterator[pd.DataFrame]:
+		""" Read a data frame in chunks of at most chunksize rows. Handlers should override this with a streaming
+		read, this one reads everything at once"""
+		yield self.load(path, **kwargs)
+
 	@abstractmethod
-	def save(self, path: str, data: Union[pd.DataFrame, str], **kwargs):
+	def save(self, path: str, data: Union[pd.DataFrame, str], **kwargs) -> Optional[int]:
+		""" Write data to path. Returns the number of bytes written, None if it is not known """
 		pass
 
 	@abstractmethod
 	def copy(self, source_location: str, dest_location: str, **kwargs):
 		pass
 
+	def copy_prefix(self, source_prefix: str, dest_prefix: str, max_workers: int = 16, **kwargs) -> CopySummary:
+		"""
+		Replace everything below dest_prefix by a copy of everything below source_prefix.
+		Handlers should override this with a bulk implementation, this one copies file by file.
+		"""
+		self.delete(path=dest_prefix)
+		all_source_files = self.list_files(prefix=source_prefix)
+		for from_path in all_source_files:
+			self.copy(from_path, dest_prefix + from_path[len(source_prefix):])
+		return CopySummary(objects_copied=len(all_source_files))
+
 	@abstractmethod
 	def upload(self, local_path: str, dest_path: str, **kwqrgs):
 		""" Upload a file from local to location"""
@@ -40,3 +127,15 @@ class StorageHandler:
 	def download(self, to_dir: str, from_path: str, file_name: str, **kwargs):
 		""" Download a file to local"""
 		pass
+
+	def download_file(self, path: str, local_path: str):
+		""" Download a single object to a local file path"""
+		raise NotImplementedError()
+
+	def head(self, path: str) -> ObjectInfo:
+		""" Metadata of a single object, without reading it"""
+		raise NotImplementedError()
+
+	def list_object_infos(self, prefix: str) -> List[ObjectInfo]:
+		""" Metadata of all objects starting with prefix. Handlers should override this to avoid a head per object"""
+		return [self.head(path) for path in self.list_files(prefix=prefix)]
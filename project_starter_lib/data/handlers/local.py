@@ -0,0 +1,410 @@
+""" Class whose object is used to interact with the local file system, e.g. a fast local NVMe disk """
+import errno
+import fcntl
+import json
+import logging
+import os
+import shutil
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+
+from project_starter_lib.data.file_formats import csv_compression, is_csv
+from project_starter_lib.data.handlers import pickle_buffers
+from project_starter_lib.data.handlers.common import (
+	StorageHandler,
+	CopySummary,
+	ObjectInfo,
+	iter_dataset_chunks,
+	compress_csv,
+	csv_source,
+	parquet_options,
+)
+
+logger = logging.getLogger(__name__)
+
+# ioctl request to clone a file (reflink) on file systems that support it, e.g. btrfs and xfs
+FICLONE = 0x40049409
+
+
+def clone_file(source_path: str, dest_path: str):
+	"""
+	Copy a file as cheaply as the file system allows:
+	1. reflink, i.e. a copy on write clone of the file
+	2. hardlink. Safe because the handler never writes to an existing file in place
+	3. a regular copy
+	"""
+	try:
+		with open(source_path, 'rb') as source, open(dest_path, 'wb') as dest:
+			fcntl.ioctl(dest.fileno(), FICLONE, source.fileno())
+		return
+	except OSError:
+		if os.path.exists(dest_path):
+			os.remove(dest_path)
+
+	try:
+		os.link(source_path, dest_path)
+	except OSError as e:
+		if e.errno not in [errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP]:
+			raise
+		shutil.copy2(source_path, dest_path)
+
+
+def local_size(local_path) -> int:
+	""" Size of a local file, or of all files in a local folder """
+	if os.path.isfile(local_path):
+		return os.path.getsize(local_path)
+	return sum(
+		os.path.getsize(os.path.join(root, file_name))
+		for root, _, file_names in os.walk(local_path)
+		for file_name in file_names
+	)
+
+
+class LocalStorageHandler(StorageHandler):
+	""" """
+
+	def __init__(self, root_dir: str = "./data"):
+		"""
+		All paths are relative to root_dir, the same way S3 paths are relative to the bucket
+		Parameters
+		----------
+		root_dir
+			Directory in which all data is stored
+		"""
+		self.root_dir = os.path.abspath(root_dir)
+
+	def get_local_file_path(self, file_path):
+		""" Returns the absolute local path of a path relative to root_dir """
+		return os.path.join(self.root_dir, file_path)
+
+	def _prepare_destination(self, full_path):
+		"""
+		Create the parent directory and remove an existing file at the destination. Removing instead of overwriting
+		ensures that hardlinked copies of the file are never modified.
+		"""
+		os.makedirs(os.path.dirname(full_path), exist_ok=True)
+		if os.path.isfile(full_path):
+			os.remove(full_path)
+
+	def _write_bytes(self, full_path, data: bytes):
+		""" Write to a temporary file and then rename it so that readers never see a partial file """
+		self._write_parts(full_path, [data])
+
+	def _write_parts(self, full_path, parts: List):
+		"""
+		Write the parts one after the other, without joining them, like _write_bytes. Replacing the file instead of
+		writing into it also keeps memory mapped earlier versions of the file valid
+		"""
+		self._prepare_destination(full_path)
+		tmp_path = f"{full_path}.{os.getpid()}.tmp"
+		with open(tmp_path, 'wb') as f:
+			for part in parts:
+				f.write(part)
+		os.replace(tmp_path, full_path)
+
+	@staticmethod
+	def _csv_source(full_path, path):
+		""" Compressed csv files are memory mapped and decompressed while they are read """
+		if csv_compression(path) is None:
+			return full_path
+		return csv_source(pa.memory_map(full_path), path)
+
+	def confirm_access(self):
+		""" raise if root directory doesn't exist or is not writable """
+		if not os.access(self.root_dir, os.W_OK):
+			raise PermissionError(f"Can not write to {self.root_dir}")
+
+	def load(self, path, **kwargs):
+		"""Read data from the local file system. Parquet and Arrow/Feather files are memory mapped.
+		Parameters
+		----------
+		path : str
+			Path of file relative to root_dir
+		Returns
+		-------
+		data
+			Data object output
+		"""
+
+		logger.info(f"Reading file from {path} with filters {kwargs.get('filters')}")
+		full_path = self.get_local_file_path(path)
+		if path.endswith(".pkl"):
+			# The arrays of the object are memory mapped, unless memory_map=False
+			data = pickle_buffers.load_file(full_path, memory_map=kwargs.get('memory_map', True))
+
+		elif is_csv(path):
+			# Datetime columns are parsed by the parse_dates of the schema, see SchemaPlan.csv_reader_options
+			data = pd.read_csv(
+				self._csv_source(full_path, path),
+				memory_map=csv_compression(path) is None,
+				**kwargs
+			)
+		elif path.endswith(".txt") or path.endswith(".gz") or path.endswith(".zst"):
+			with open(full_path, 'rb') as f:
+				data = f.read()
+
+		elif path.endswith(".json"):
+			with open(full_path, 'rb') as f:
+				data = json.load(f)
+
+		elif path.endswith(".xlsx"):
+			data = pd.read_excel(full_path, **kwargs)
+
+		elif path.endswith(".parquet.gzip") or path.endswith(".parquet"):
+			data = pq.read_table(
+				full_path,
+				filters=kwargs.get('filters'),
+				columns=kwargs.get('columns'),
+				memory_map=True,
+			).to_pandas()
+		elif (path.endswith(".feather") or path.endswith(".arrow")) and kwargs.get('filters'):
+			data = ds.dataset(full_path, format='ipc').to_table(
+				columns=kwargs.get('columns'),
+				filter=pq.filters_to_expression(kwargs['filters']),
+			).to_pandas()
+		elif path.endswith(".feather") or path.endswith(".arrow"):
+			data = feather.read_table(
+				full_path,
+				columns=kwargs.get('columns'),
+				memory_map=True,
+			).to_pandas()
+		else:
+			raise Exception("Not implemented data read: " + path)
+
+		return data
+
+	def load_chunks(self, path, chunksize, **kwargs):
+		"""Stream a csv, parquet or feather file (or partitioned folder) in chunks of at most chunksize rows.
+		Parameters
+		----------
+		path : str
+			Path of file relative to root_dir
+		chunksize : int
+			Maximum number of rows per chunk
+		Returns
+		-------
+		Iterator of data frames
+		"""
+
+		logger.info(f"Reading file in chunks of {chunksize} rows from {path}")
+		full_path = self.get_local_file_path(path)
+		if is_csv(path):
+			reader = pd.read_csv(
+				self._csv_source(full_path, path),
+				memory_map=csv_compression(path) is None,
+				chunksize=chunksize,
+				**kwargs
+			)
+			for chunk in reader:
+				yield chunk
+		elif path.endswith(".parquet.gzip") or path.endswith(".parquet"):
+			yield from iter_dataset_chunks(
+				full_path,
+				chunksize=chunksize,
+				columns=kwargs.get('columns'),
+				filters=kwargs.get('filters'),
+			)
+		elif path.endswith(".feather") or path.endswith(".arrow"):
+			yield from iter_dataset_chunks(full_path, chunksize=chunksize, file_format='ipc', columns=kwargs.get('columns'))
+		else:
+			yield self.load(path, **kwargs)
+
+	def save(self, file_path, data, **kwargs):
+		"""Saves data as pkl, csv, json, parquet or feather to the local file system. If csv, then
+		should be a pandas dataframe
+		Parameters
+		----------
+		data : Object
+		file_path : str
+			Path relative to root_dir. It should end with .pkl, .csv or .json
+		**kwargs : Optional params
+			Optional csv / json parameters. compression, compression_level and row_group_size for parquet,
+			compression and compression_level for feather and compressed csv, see file_formats.FileFormat
+		Returns
+		-------
+		n_bytes : int
+			Size of the written file, or of all files of a partitioned parquet folder
+		"""
+
+		full_path = self.get_local_file_path(file_path)
+		if file_path.endswith(".pkl"):
+			logger.debug("Saving pkl to " + full_path)
+			self._write_parts(full_path, pickle_buffers.dump_parts(data))
+		elif is_csv(file_path) and csv_compression(file_path) is not None:
+			logger.debug("Saving compressed csv to " + full_path)
+			self._write_bytes(full_path, compress_csv(data, file_path, **kwargs))
+		elif file_path.endswith(".csv"):
+			logger.debug("Saving csv to " + full_path)
+			self._prepare_destination(full_path)
+			data.to_csv(full_path, index=False, **kwargs)
+		elif file_path.endswith(".xlsx"):
+			logger.debug("Saving Excel to " + full_path)
+			self._prepare_destination(full_path)
+			data.to_excel(full_path, index=False, **kwargs)
+		elif file_path.endswith(".json"):
+			logger.debug("Saving json to " + full_path)
+			self._write_bytes(full_path, json.dumps(data, **kwargs).encode())
+		elif file_path.endswith(".parquet.gzip") or file_path.endswith(".parquet"):
+			logger.debug("Saving parquet to " + full_path)
+			self._prepare_destination(full_path)
+			data.to_parquet(
+				full_path,
+				index=False,
+				partition_cols=kwargs.get('partition_cols'),
+				**parquet_options(**kwargs)
+			)
+		elif file_path.endswith(".feather") or file_path.endswith(".arrow"):
+			logger.debug("Saving feather to " + full_path)
+			self._prepare_destination(full_path)
+			feather.write_feather(
+				pa.Table.from_pandas(data, preserve_index=False),
+				full_path,
+				compression=kwargs.get('compression'),
+				compression_level=kwargs.get('compression_level'),
+			)
+		elif file_path.endswith(".txt") or file_path.endswith(".log"):
+			self._write_bytes(full_path, data if isinstance(data, bytes) else data.encode())
+		elif file_path.endswith(".gz") or file_path.endswith(".zst"):
+			# Bytes which are already compressed, e.g. log segments
+			self._write_bytes(full_path, data)
+		else:
+			raise NotImplementedError()
+		return local_size(full_path)
+
+	def list_files(self, prefix: str = "", suffix: str = "") -> List[str]:
+		"""Retrieve the paths of all files below root_dir which start with prefix, like keys in a bucket.
+		Parameters
+		----------
+		prefix : str
+			Only fetch paths that start with this prefix (optional).
+		suffix : str
+			Only fetch paths that end with this suffix (optional).
+		Returns
+		-------
+		matches : list of str
+			Files that match the given prefix and/or suffix, relative to root_dir
+		"""
+		# Only walk the deepest directory that contains the prefix
+		search_dir = self.get_local_file_path(os.path.dirname(prefix))
+
+		matches = []
+		for subdir, dirs, files in os.walk(search_dir):
+			for file in files:
+				path = os.path.relpath(os.path.join(subdir, file), self.root_dir).replace(os.sep, '/')
+				if path.startswith(prefix) and path.endswith(suffix):
+					matches.append(path)
+
+		return sorted(matches)
+
+	def copy(self, source_location, dest_location, **kwargs):
+		"""
+		Copy a file from one location to another, using a reflink or hardlink when possible
+		:param source_location:
+		:param dest_location:
+		:return:
+		"""
+
+		logger.info(f"Copying {source_location} to {dest_location} folder")
+
+		# Deleting data at dest location if it exists
+		self.delete(path=dest_location)
+
+		dest_full_path = self.get_local_file_path(dest_location)
+		self._prepare_destination(dest_full_path)
+		clone_file(self.get_local_file_path(source_location), dest_full_path)
+
+	def copy_prefix(self, source_prefix, dest_prefix, max_workers=16, **kwargs) -> CopySummary:
+		"""
+		Replace everything below dest_prefix by a copy of everything below source_prefix
+		:param source_prefix:
+		:param dest_prefix:
+		:param max_workers: Number of concurrent copies
+		:return: Summary of the copied files
+		"""
+		start_time = time.perf_counter()
+		all_source_files = self.list_files(prefix=source_prefix)
+		objects_deleted = self.delete(path=dest_prefix)
+
+		def copy_file(from_path):
+			dest_full_path = self.get_local_file_path(dest_prefix + from_path[len(source_prefix):])
+			self._prepare_destination(dest_full_path)
+			clone_file(self.get_local_file_path(from_path), dest_full_path)
+
+		with ThreadPoolExecutor(max_workers=max_workers) as executor:
+			list(executor.map(copy_file, all_source_files))
+
+		return CopySummary(
+			objects_copied=len(all_source_files),
+			bytes_copied=sum(os.path.getsize(self.get_local_file_path(x)) for x in all_source_files),
+			objects_deleted=objects_deleted,
+			seconds=time.perf_counter() - start_time,
+		)
+
+	def upload(self, local_path, dest_path, **kwqrgs):
+		""" Copy a local file or folder into root_dir """
+
+		file_name = dest_path.split('/')[-1]
+		for subdir, dirs, files in os.walk(local_path):
+			for file in files:
+				full_local_path = os.path.join(subdir, file)
+				dest_full_path = self.get_local_file_path(f"{dest_path}{full_local_path.split(file_name)[-1]}")
+				logger.info(f"Uploading file from {full_local_path} to {dest_full_path} ")
+				self._prepare_destination(dest_full_path)
+				shutil.copy2(full_local_path, dest_full_path)
+
+	def delete(self, path: str, **kwargs) -> int:
+		""" Deleting all files starting with path. Returns the number of deleted files """
+		logger.info(f"Deleting Data at {path}")
+
+		all_files = self.list_files(prefix=path)
+		for file in all_files:
+			os.remove(self.get_local_file_path(file))
+
+		# Remove the folders left empty
+		for file in all_files:
+			directory = os.path.dirname(self.get_local_file_path(file))
+			while directory.startswith(self.root_dir) and directory != self.root_dir:
+				try:
+					os.rmdir(directory)
+				except OSError:
+					break
+				directory = os.path.dirname(directory)
+
+		return len(all_files)
+
+	def download(self, to_dir, from_path, file_name, **kwargs):
+		"""
+
+		:param file_name:
+		:param to_dir:
+		:param from_path:
+		:return:
+		"""
+
+		if from_path.endswith(file_name):
+			full_path = os.path.join(to_dir, file_name)
+		else:
+			path_suffix = from_path.split(file_name)[-1][1:]
+			full_path = os.path.join(to_dir, file_name, path_suffix)
+
+		# Ensure directory is present
+		os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+		logger.info(f"Copying file from {from_path} to {full_path}")
+		shutil.copy2(self.get_local_file_path(from_path), full_path)
+
+	def download_file(self, path, local_path):
+		""" Copy a single file to local_path """
+		clone_file(self.get_local_file_path(path), local_path)
+
+	def head(self, path) -> ObjectInfo:
+		""" Metadata of a single file. The modification time and size are used as etag """
+		stat = os.stat(self.get_local_file_path(path))
+		return ObjectInfo(bucket=self.root_dir, key=path, etag=f"{stat.st_mtime_ns}-{stat.st_size}", size=stat.st_size)
@@ -0,0 +1,115 @@
+""" Pickle files whose large buffers, e.g. the arrays of numpy arrays and data frames, are stored out-of-band
+
+pickle.dumps copies every array of the object into one bytes object, which is copied again into the upload buffer, and
+pickle.loads copies the arrays out of the downloaded bytes. With protocol 5 the arrays are handed to a buffer_callback
+instead, and are written to storage directly from the memory of the object as separate parts of the file:
+
+	MAGIC | header length | header | pickle stream | buffer 0 | buffer 1 | ...
+
+The header is json with the size of the pickle stream and of every buffer, and every part starts at a multiple of
+ALIGNMENT bytes. On load the buffers are slices of the downloaded buffer or of the memory mapped file, which the
+unpickled arrays use without copying them. Files written by pickle.dump, which do not start with MAGIC, are read as
+before.
+"""
+import io
+import json
+import mmap
+import os
+import pickle
+import struct
+from typing import List
+
+MAGIC = b'PKL5OOB\n'
+ALIGNMENT = 64
+_HEADER_LENGTH = struct.Struct('<Q')
+
+
+def dump_parts(obj) -> List[memoryview]:
+	"""
+	Parts of the file of obj, in order. The buffers are views of the memory of obj, so obj must not be modified until
+	the parts are written
+	:param obj:
+	:return:
+	"""
+	buffers = []
+	stream = pickle.dumps(obj, protocol=5, buffer_callback=buffers.append)
+	views = [memoryview(stream)] + [buffer.raw() for buffer in buffers]
+
+	header = json.dumps({'sizes': [view.nbytes for view in views]}).encode()
+	parts = [memoryview(MAGIC + _HEADER_LENGTH.pack(len(header)) + header)]
+	offset = parts[0].nbytes
+	for view in views:
+		padding = -offset % ALIGNMENT
+		if padding > 0:
+			parts.append(memoryview(bytes(padding)))
+		parts.append(view)
+		offset += padding + view.nbytes
+	return parts
+
+
+def loads(data):
+	"""
+	Object from the content of a pickle file in either format. The buffers of the object are slices of data, so data
+	should be writable, e.g. a bytearray, for the arrays of the object to be writable
+	"""
+	view = memoryview(data)
+	if view[:len(MAGIC)] != MAGIC:
+		return pickle.loads(data)
+
+	start = len(MAGIC) + _HEADER_LENGTH.size
+	header_length, = _HEADER_LENGTH.unpack_from(view, len(MAGIC))
+	sizes = json.loads(bytes(view[start:start + header_length]))['sizes']
+	offset = start + header_length
+	views = []
+	for size in sizes:
+		offset += -offset % ALIGNMENT
+		views.append(view[offset:offset + size])
+		offset += size
+	return pickle.loads(views[0], buffers=views[1:])
+
+
+def load_file(path: str, memory_map: bool = True):
+	"""
+	Object from a local pickle file in either format
+	:param path:
+	:param memory_map: Whether the buffers are memory mapped, copy on write. Else the file is read into memory
+	:return:
+	"""
+	with open(path, 'rb') as f:
+		if f.read(len(MAGIC)) != MAGIC:
+			f.seek(0)
+			return pickle.load(f)
+		if memory_map:
+			# The mapping stays valid after the file is closed, and as long as the arrays of the object use it
+			return loads(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY))
+		f.seek(0)
+		data = bytearray(os.fstat(f.fileno()).st_size)
+		f.readinto(data)
+	return loads(data)
+
+
+class PartsReader(io.RawIOBase):
+	""" Readable file of the parts, e.g. for an upload, which does not join them into one buffer """
+
+	def __init__(self, parts: List[memoryview]):
+		super().__init__()
+		self._parts = [part.cast('B') for part in parts]
+		self._index = 0
+		self._position = 0
+
+	def readable(self) -> bool:
+		return True
+
+	def readinto(self, buffer) -> int:
+		target = memoryview(buffer).cast('B')
+		n_bytes = 0
+		while n_bytes < target.nbytes and self._index < len(self._parts):
+			part = self._parts[self._index]
+			size = min(target.nbytes - n_bytes, part.nbytes - self._position)
+			target[n_bytes:n_bytes + size] = part[self._position:self._position + size]
+			n_bytes += size
+			self._position += size
+			if self._position == part.nbytes:
+				self._index += 1
+				self._position = 0
+		return n_bytes
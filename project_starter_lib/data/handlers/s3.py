@@ -1,27 +1,175 @@
 """ Class whose object is used to interact with S3 Bucket"""
+import io
 import json
 import logging
 import os
-import pickle
+import threading
 from typing import List
 
 import boto3
 import boto3.session
 import pandas as pd
+import pyarrow as pa
+import pyarrow.feather as feather
+import pyarrow.parquet as pq
+import s3fs
+from boto3.s3.transfer import TransferConfig
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from dotenv import load_dotenv
 
-from project_starter_lib.data.handlers.common import StorageHandler
+from project_starter_lib.data.file_formats import csv_compression, is_csv
+from project_starter_lib.data.handlers import pickle_buffers
+from project_starter_lib.data.handlers.common import (
+	StorageHandler,
+	CopySummary,
+	ObjectInfo,
+	iter_dataset_chunks,
+	compress_csv,
+	csv_source,
+	parquet_options,
+)
+from project_starter_lib.data.handlers.s3_bulk_copy import S3BulkCopyEngine
+from project_starter_lib.data.handlers.s3_transfer import parallel_get
 
 logger = logging.getLogger(__name__)
 
 load_dotenv()
 
 S3_BUCKET = os.getenv("AWS_BUCKET_NAME")
+S3_ENDPOINT_URL = os.getenv("AWS_ENDPOINT_URL")
 
 
 class S3StorageHandler(StorageHandler):
 	""" """
 
+	def __init__(self,
+				 max_pool_connections: int = 50,
+				 tcp_keepalive: bool = True,
+				 endpoint_url: str = S3_ENDPOINT_URL,
+				 multipart_threshold: int = 64 * 1024 ** 2,
+				 part_size: int = 64 * 1024 ** 2,
+				 max_concurrency: int = 10):
+		"""
+		The boto3 session, client and resource are created lazily on first use and then reused by every call.
+		The client is shared by all threads, the resource is created once per thread since boto3 resources are
+		not thread safe. After a fork all of them are rebuilt in the child process.
+		Objects larger than multipart_threshold are downloaded with concurrent byte-range GETs and uploaded with
+		concurrent multipart uploads.
+		Parameters
+		----------
+		max_pool_connections
+			Maximum number of connections kept open in the connection pool
+		tcp_keepalive
+			Whether to keep connections alive between requests
+		endpoint_url
+			Optional S3 endpoint, e.g. a local S3 stand-in
+		multipart_threshold
+			Size in bytes above which objects are transferred in parts
+		part_size
+			Size in bytes of each part
+		max_concurrency
+			Maximum number of parts transferred at the same time for one object
+		"""
+		self.max_pool_connections = max_pool_connections
+		self.tcp_keepalive = tcp_keepalive
+		self.endpoint_url = endpoint_url
+		self.multipart_threshold = multipart_threshold
+		self.part_size = part_size
+		self.max_concurrency = max_concurrency
+		# (event name, handler) of botocore events, registered on every session. See register_event_handler
+		self._event_handlers = []
+		self._reset_clients()
+
+	def _reset_clients(self):
+		""" Drop all cached boto3 objects. They will be recreated on next use """
+		self._pid = os.getpid()
+		self._lock = threading.Lock()
+		self._session = None
+		self._client = None
+		self._thread_local = threading.local()
+
+	def __getstate__(self):
+		""" boto3 objects and locks cannot be pickled, e.g. when sent to a joblib worker """
+		state = self.__dict__.copy()
+		for key in ['_pid', '_lock', '_session', '_client', '_thread_local']:
+			state.pop(key)
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._reset_clients()
+
+	def _check_fork(self):
+		""" Connections cannot be shared with a forked child process, so rebuild them if the pid changed """
+		if self._pid != os.getpid():
+			self._reset_clients()
+
+	@property
+	def session(self) -> boto3.session.Session:
+		""" boto3 session shared by the client and all resources """
+		self._check_fork()
+		if self._session is None:
+			with self._lock:
+				if self._session is None:
+					session = boto3.session.Session()
+					for event_name, handler in self._event_handlers:
+						session.events.register(event_name, handler)
+					self._session = session
+		return self._session
+
+	def register_event_handler(self, event_name: str, handler):
+		"""
+		Register a handler of botocore events, e.g. before-send.s3, on the client and the resources, also those created
+		later or after a fork
+		:param event_name:
+		:param handler:
+		:return:
+		"""
+		self._event_handlers.append((event_name, handler))
+		# Clients copy the handlers of the session when they are created
+		self._reset_clients()
+
+	@property
+	def client_config(self) -> Config:
+		""" Connection pool settings used by the client and the resources """
+		return Config(
+			max_pool_connections=self.max_pool_connections,
+			tcp_keepalive=self.tcp_keepalive,
+		)
+
+	@property
+	def transfer_config(self) -> TransferConfig:
+		""" Settings of multipart uploads and downloads """
+		return TransferConfig(
+			multipart_threshold=self.multipart_threshold,
+			multipart_chunksize=self.part_size,
+			max_concurrency=self.max_concurrency,
+			use_threads=True,
+		)
+
+	@property
+	def client(self):
+		""" Pooled S3 client shared by all threads """
+		session = self.session
+		if self._client is None:
+			with self._lock:
+				if self._client is None:
+					self._client = session.client("s3", config=self.client_config, endpoint_url=self.endpoint_url)
+		return self._client
+
+	@property
+	def resource(self):
+		""" S3 resource for the current thread """
+		session = self.session
+		resource = getattr(self._thread_local, 'resource', None)
+		if resource is None:
+			# Creating clients/resources from a session is not thread safe
+			with self._lock:
+				resource = session.resource("s3", config=self.client_config, endpoint_url=self.endpoint_url)
+			self._thread_local.resource = resource
+		return resource
+
 	def get_s3_file_path(self, file_path):
 		"""Returns the s3 file path, in form s3://{bucket_name}/{path}
 
@@ -40,10 +188,40 @@ class S3StorageHandler(StorageHandler):
 
 		return s3_file_path
 
+	def _get_object_bytes(self, path) -> bytearray:
+		"""
+		Content of an object, in one writable buffer. The first multipart_threshold bytes are fetched with one GET,
+		the rest of larger objects with concurrent range GETs
+		:raises FileNotFoundError: If there is no object with this key, e.g. for a partitioned folder
+		"""
+		try:
+			return parallel_get(
+				self.client,
+				bucket=S3_BUCKET,
+				key=path,
+				part_size=self.part_size,
+				max_concurrency=self.max_concurrency,
+				first_part_size=self.multipart_threshold
+			)
+		except ClientError as e:
+			if e.response['Error']['Code'] in ['404', 'NoSuchKey']:
+				raise FileNotFoundError(f"No object {path} in {S3_BUCKET}") from e
+			raise
+
+	def _upload_bytes(self, path, buffer: io.BytesIO) -> int:
+		"""
+		Upload a buffer, with a concurrent multipart upload if it is larger than multipart_threshold
+		:return: Size of the buffer
+		"""
+		n_bytes = buffer.seek(0, io.SEEK_END)
+		buffer.seek(0)
+		with buffer:
+			self.client.upload_fileobj(buffer, S3_BUCKET, path, Config=self.transfer_config)
+		return n_bytes
+
 	def confirm_access(self):
 		""" raise if bad aws credentials, bucket doesn't exist, or forbidden from bucket """
-		s3 = boto3.client("s3")
-		s3.head_bucket(Bucket=S3_BUCKET)
+		self.client.head_bucket(Bucket=S3_BUCKET)
 
 	def load(self, path, **kwargs):
 		"""Download data from S3 bucket and return a pandas dataframe.
@@ -59,42 +237,96 @@ class S3StorageHandler(StorageHandler):
 
 		logger.info(f"Reading file from {path} with filters {kwargs.get('filters')}")
 		if path.endswith(".pkl"):
-			# Here we create a new session per function call
-			session = boto3.session.Session()
-			s3_resource = session.resource("s3")
-			response = s3_resource.Object(S3_BUCKET, path).get()["Body"].read()
-			data = pickle.loads(response)
-
-		elif path.endswith(".txt"):
-			# Here we create a new session per function call
-			session = boto3.session.Session()
-			s3_resource = session.resource("s3")
-			data = s3_resource.Object(S3_BUCKET, path).get()["Body"].read()
+			# Downloaded into one writable buffer, which the arrays of the object use without copying
+			data = pickle_buffers.loads(self._get_object_bytes(path))
 
-		elif path.endswith(".xlsx"):
-			data = pd.read_excel(self.get_s3_file_path(path), **kwargs)
 		# Had to add a .csv. or condition because of the file name being uploaded to s3 :(
-		elif path.endswith(".csv") or path.endswith(".csv."):
-			parser = lambda x: pd.to_datetime(x, errors='coerce', infer_datetime_format=True)
+		elif is_csv(path):
+			# The downloaded buffer is read by the parser without being copied, and decompressed while it is read.
+			# Datetime columns are parsed by the parse_dates of the schema, see SchemaPlan.csv_reader_options
 			data = pd.read_csv(
-				self.get_s3_file_path(path),
-				date_parser=parser,
+				csv_source(pa.BufferReader(self._get_object_bytes(path)), path),
 				**kwargs
-
 			)
+		elif path.endswith(".txt") or path.endswith(".gz") or path.endswith(".zst"):
+			data = self._get_object_bytes(path)
+
+		elif path.endswith(".json"):
+			data = json.loads(self.client.get_object(Bucket=S3_BUCKET, Key=path)["Body"].read())
+
+		elif path.endswith(".xlsx"):
+			data = pd.read_excel(self.get_s3_file_path(path), **kwargs)
 		elif path.endswith(".parquet.gzip") or path.endswith(".parquet"):
-			data = pd.read_parquet(
-				self.get_s3_file_path(path),
-				filters=kwargs.get('filters'),
-				columns=kwargs.get('columns')
-			)
+			try:
+				data = pq.read_table(
+					pa.BufferReader(self._get_object_bytes(path)),
+					filters=kwargs.get('filters'),
+					columns=kwargs.get('columns')
+				).to_pandas()
+			except FileNotFoundError:
+				# Partitioned folder of parquet files
+				data = pd.read_parquet(
+					self.get_s3_file_path(path),
+					filters=kwargs.get('filters'),
+					columns=kwargs.get('columns')
+				)
+		elif path.endswith(".feather") or path.endswith(".arrow"):
+			table = feather.read_table(pa.BufferReader(self._get_object_bytes(path)), columns=kwargs.get('columns'))
+			if kwargs.get('filters'):
+				table = table.filter(pq.filters_to_expression(kwargs['filters']))
+			data = table.to_pandas()
 		else:
 			raise Exception("Not implemented data download: " + path)
 
 		return data
 
+	def load_chunks(self, path, chunksize, **kwargs):
+		"""Stream a csv or parquet file (or partitioned parquet folder) from S3 in chunks of at most chunksize rows.
+		Parameters
+		----------
+		path : str
+			S3 file path of file
+		chunksize : int
+			Maximum number of rows per chunk
+		Returns
+		-------
+		Iterator of data frames
+		"""
+
+		logger.info(f"Reading file in chunks of {chunksize} rows from {path}")
+		if is_csv(path):
+			# Compressed files are downloaded and decompressed while they are parsed
+			reader = pd.read_csv(
+				self.get_s3_file_path(path) if csv_compression(path) is None else csv_source(
+					pa.BufferReader(self._get_object_bytes(path)), path),
+				chunksize=chunksize,
+				**kwargs
+			)
+			for chunk in reader:
+				yield chunk
+		elif path.endswith(".parquet.gzip") or path.endswith(".parquet"):
+			client_kwargs = {'endpoint_url': self.endpoint_url} if self.endpoint_url else None
+			yield from iter_dataset_chunks(
+				f"{S3_BUCKET}/{path}",
+				chunksize=chunksize,
+				filesystem=s3fs.S3FileSystem(client_kwargs=client_kwargs),
+				columns=kwargs.get('columns'),
+				filters=kwargs.get('filters'),
+			)
+		elif path.endswith(".feather") or path.endswith(".arrow"):
+			client_kwargs = {'endpoint_url': self.endpoint_url} if self.endpoint_url else None
+			yield from iter_dataset_chunks(
+				f"{S3_BUCKET}/{path}",
+				chunksize=chunksize,
+				file_format='ipc',
+				filesystem=s3fs.S3FileSystem(client_kwargs=client_kwargs),
+				columns=kwargs.get('columns'),
+			)
+		else:
+			yield self.load(path, **kwargs)
+
 	def save(self, file_path, data, **kwargs):
-		"""Saves data as pkl, csv or json to S3 bucket. If csv, then
+		"""Saves data as pkl, csv, json, parquet or feather to S3 bucket. If csv, then
 		should be a pandas dataframe
 		Parameters
 		----------
@@ -102,44 +334,75 @@ class S3StorageHandler(StorageHandler):
 		file_path : str
 			S3 file path. It should end with .pkl, .csv or .json
 		**kwargs : Optional params
-			Optional csv / json parameters
+			Optional csv / json parameters. compression, compression_level and row_group_size for parquet,
+			compression and compression_level for feather and compressed csv, see file_formats.FileFormat
+		Returns
+		-------
+		n_bytes : int
+			Number of bytes uploaded. None for Excel and partitioned parquet files, which are written by pandas
 		"""
 
 		if file_path.endswith(".pkl"):
-			bucket = S3_BUCKET
-			pickle_byte_obj = pickle.dumps(data)
-			# Here we create a new session per function call
-			session = boto3.session.Session()
-			s3_resource = session.resource("s3")
-			file_path = file_path
 			logger.debug("Saving pkl to " + file_path)
-			s3_resource.Object(bucket, file_path).put(Body=pickle_byte_obj)
+			# The buffers of the object are streamed from its memory, in multiple parts if it is large
+			parts = pickle_buffers.dump_parts(data)
+			self.client.upload_fileobj(
+				pickle_buffers.PartsReader(parts),
+				S3_BUCKET,
+				file_path,
+				Config=self.transfer_config
+			)
+			return sum(part.nbytes for part in parts)
+		elif is_csv(file_path) and csv_compression(file_path) is not None:
+			logger.debug("Saving compressed csv to " + file_path)
+			return self._upload_bytes(file_path, io.BytesIO(compress_csv(data, file_path, **kwargs)))
 		elif file_path.endswith(".csv"):
-			s3_path = self.get_s3_file_path(file_path)
-			logger.debug("Saving csv to " + s3_path)
-			data.to_csv(s3_path, index=False, **kwargs)
+			logger.debug("Saving csv to " + file_path)
+			buffer = io.BytesIO()
+			data.to_csv(buffer, index=False, **kwargs)
+			return self._upload_bytes(file_path, buffer)
 		elif file_path.endswith(".xlsx"):
 			s3_path = self.get_s3_file_path(file_path)
 			logger.debug("Saving Excel to " + s3_path)
 			data.to_excel(s3_path, index=False, **kwargs)
+			return None
 		elif file_path.endswith(".json"):
-			bucket = S3_BUCKET
 			json_bytes = json.dumps(data, **kwargs).encode()
 			logger.debug("Saving json to " + file_path)
-			s3_resource = boto3.resource("s3")
-			s3_resource.Object(bucket, file_path).put(Body=json_bytes)
-		elif file_path.endswith(".parquet.gzip") or file_path.endswith(".parquet"):
+			self.client.put_object(Bucket=S3_BUCKET, Key=file_path, Body=json_bytes)
+			return len(json_bytes)
+		elif (file_path.endswith(".parquet.gzip") or file_path.endswith(".parquet")) and kwargs.get('partition_cols'):
 			s3_path = self.get_s3_file_path(file_path)
 			logger.debug("Saving parquet.gzip to " + s3_path)
 			data.to_parquet(
 				s3_path,
 				index=False,
-				partition_cols=kwargs.get('partition_cols')
+				partition_cols=kwargs.get('partition_cols'),
+				**parquet_options(**kwargs)
 			)
+			return None
+		elif file_path.endswith(".parquet.gzip") or file_path.endswith(".parquet"):
+			logger.debug("Saving parquet to " + file_path)
+			buffer = io.BytesIO()
+			data.to_parquet(buffer, index=False, **parquet_options(**kwargs))
+			return self._upload_bytes(file_path, buffer)
+		elif file_path.endswith(".feather") or file_path.endswith(".arrow"):
+			logger.debug("Saving feather to " + file_path)
+			buffer = io.BytesIO()
+			feather.write_feather(
+				pa.Table.from_pandas(data, preserve_index=False),
+				buffer,
+				compression=kwargs.get('compression'),
+				compression_level=kwargs.get('compression_level'),
+			)
+			return self._upload_bytes(file_path, buffer)
 		elif file_path.endswith(".txt") or file_path.endswith(".log"):
-			s3 = boto3.resource('s3')
-			s3_object = s3.Object(S3_BUCKET, file_path)
-			s3_object.put(Body=data)
+			body = data.encode() if isinstance(data, str) else data
+			self.client.put_object(Bucket=S3_BUCKET, Key=file_path, Body=body)
+			return len(body)
+		elif file_path.endswith(".gz") or file_path.endswith(".zst"):
+			# Bytes which are already compressed, e.g. log segments
+			return self._upload_bytes(file_path, io.BytesIO(data))
 		else:
 			raise NotImplementedError()
 
@@ -161,12 +424,12 @@ class S3StorageHandler(StorageHandler):
 			"Bucket": S3_BUCKET,
 			"Prefix": prefix
 		}
-		s3 = boto3.client("s3")
+		s3 = self.client
 
 		matches = []
 		while True:
 			resp = s3.list_objects_v2(**kwargs)
-			for obj in resp["Contents"]:
+			for obj in resp.get("Contents", []):
 				key = obj["Key"]
 				if key.endswith(suffix):
 					matches.append(key)
@@ -187,10 +450,8 @@ class S3StorageHandler(StorageHandler):
 
 		logger.info(f"Copying {source_location} to {dest_location} folder")
 
-		s3 = boto3.resource('s3')
-
 		# Deleting data at dest location if it exists
-		bucket = s3.Bucket(S3_BUCKET)
+		bucket = self.resource.Bucket(S3_BUCKET)
 		objects = bucket.objects.filter(Prefix=dest_location)
 		objects.delete()
 
@@ -198,28 +459,36 @@ class S3StorageHandler(StorageHandler):
 			'Bucket': S3_BUCKET,
 			'Key'   : source_location
 		}
-		s3.meta.client.copy(copy_source, S3_BUCKET, dest_location)
+		self.client.copy(copy_source, S3_BUCKET, dest_location)
+
+	def copy_prefix(self, source_prefix, dest_prefix, max_workers=16, **kwargs) -> CopySummary:
+		"""
+		Replace everything below dest_prefix by a server side copy of everything below source_prefix
+		:param source_prefix:
+		:param dest_prefix:
+		:param max_workers: Number of concurrent copy requests
+		:return: Summary of the copied objects
+		"""
+		engine = S3BulkCopyEngine(client=self.client, bucket=S3_BUCKET, max_workers=max_workers)
+		return engine.run(source_prefix=source_prefix, dest_prefix=dest_prefix)
 
 	def upload(self, local_path, dest_path, **kwqrgs):
 		""" Upload a file from local to S3"""
 
-		s3 = boto3.resource('s3')
 		file_name = dest_path.split('/')[-1]
 		for subdir, dirs, files in os.walk(local_path):
 			for file in files:
 				full_local_path = os.path.join(subdir, file)
 				dest_full_path = f"{dest_path}{full_local_path.split(file_name)[-1]}"
 				logger.info(f"Uploading file from {full_local_path} to {dest_full_path} ")
-				s3.meta.client.upload_file(full_local_path, S3_BUCKET, dest_full_path)
+				self.client.upload_file(full_local_path, S3_BUCKET, dest_full_path, Config=self.transfer_config)
 
 	def delete(self, path: str, **kwargs):
 		""" Deleting a folder """
 		logger.info(f"Deleting Data at {path}")
 
-		s3 = boto3.resource('s3')
-
 		# Deleting data at dest location if it exists
-		bucket = s3.Bucket(S3_BUCKET)
+		bucket = self.resource.Bucket(S3_BUCKET)
 		objects = bucket.objects.filter(Prefix=path)
 		objects.delete()
 
@@ -232,7 +501,7 @@ class S3StorageHandler(StorageHandler):
 		:return:
 		"""
 
-		s3_client = boto3.client('s3')
+		s3_client = self.client
 		if from_path.endswith(file_name):
 			full_path = os.path.join(to_dir, file_name)
 		else:
@@ -249,4 +518,22 @@ class S3StorageHandler(StorageHandler):
 				logger.info("Directory exists")
 
 		logger.info(f"Copying file from {from_path} to {full_path}")
-		s3_client.download_file(S3_BUCKET, from_path, full_path)
+		s3_client.download_file(S3_BUCKET, from_path, full_path, Config=self.transfer_config)
+
+	def download_file(self, path, local_path):
+		""" Download a single object to local_path """
+		self.client.download_file(S3_BUCKET, path, local_path, Config=self.transfer_config)
+
+	def head(self, path) -> ObjectInfo:
+		""" HEAD request of a single object """
+		response = self.client.head_object(Bucket=S3_BUCKET, Key=path)
+		return ObjectInfo(bucket=S3_BUCKET, key=path, etag=response['ETag'], size=response['ContentLength'])
+
+	def list_object_infos(self, prefix) -> List[ObjectInfo]:
+		""" Metadata of all objects starting with prefix, from the listing without a HEAD request per object """
+		paginator = self.client.get_paginator("list_objects_v2")
+		return [
+			ObjectInfo(bucket=S3_BUCKET, key=obj['Key'], etag=obj['ETag'], size=obj['Size'])
+			for page in paginator.paginate(Bucket=S3_BUCKET, Prefix=prefix)
+			for obj in page.get("Contents", [])
+		]
@@ -0,0 +1,101 @@
+""" Bulk copy of all objects below an S3 prefix to another prefix """
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+from project_starter_lib.data.handlers.common import CopySummary
+
+logger = logging.getLogger(__name__)
+
+# S3 limits
+MAX_KEYS_PER_DELETE = 1000
+MAX_COPY_OBJECT_SIZE = 5 * 1024 ** 3
+
+
+class S3BulkCopyEngine:
+	"""
+	Copies every object below a source prefix to a destination prefix:
+	1. One listing of the source and the destination prefix
+	2. Batched DeleteObjects of everything at the destination, at most 1000 keys per request
+	3. Server side copies on a bounded thread pool sharing a single client
+	"""
+
+	def __init__(self, client, bucket: str, max_workers: int = 16):
+		"""
+		Parameters
+		----------
+		client
+			boto3 S3 client. It is shared by all threads, so its connection pool should have at least max_workers
+			connections
+		bucket
+			Bucket in which the copy happens
+		max_workers
+			Maximum number of concurrent copy requests
+		"""
+		self.client = client
+		self.bucket = bucket
+		self.max_workers = max_workers
+
+	def list_objects(self, prefix: str) -> List[Dict]:
+		""" List all objects below a prefix along with their size """
+		paginator = self.client.get_paginator("list_objects_v2")
+		objects = []
+		for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+			objects.extend({'Key': obj['Key'], 'Size': obj['Size']} for obj in page.get("Contents", []))
+		return objects
+
+	def delete_keys(self, keys: List[str]) -> int:
+		""" Delete keys in batches of at most 1000 keys per request. Returns the number of deleted objects """
+		for i in range(0, len(keys), MAX_KEYS_PER_DELETE):
+			batch = keys[i:i + MAX_KEYS_PER_DELETE]
+			response = self.client.delete_objects(
+				Bucket=self.bucket,
+				Delete={'Objects': [{'Key': key} for key in batch], 'Quiet': True}
+			)
+			errors = response.get('Errors', [])
+			if len(errors) > 0:
+				raise Exception(f"Failed to delete {len(errors)} objects, e.g. {errors[0]}")
+		return len(keys)
+
+	def copy_object(self, source_key: str, dest_key: str, size: int):
+		""" Server side copy of a single object """
+		copy_source = {'Bucket': self.bucket, 'Key': source_key}
+		if size > MAX_COPY_OBJECT_SIZE:
+			# CopyObject only supports objects up to 5GB. The managed copy switches to a multipart copy
+			self.client.copy(copy_source, self.bucket, dest_key)
+		else:
+			self.client.copy_object(CopySource=copy_source, Bucket=self.bucket, Key=dest_key)
+
+	def run(self, source_prefix: str, dest_prefix: str) -> CopySummary:
+		"""
+		Replace everything below dest_prefix by a copy of everything below source_prefix
+		:param source_prefix:
+		:param dest_prefix:
+		:return: Summary of the copied objects
+		"""
+		start_time = time.perf_counter()
+
+		source_objects = self.list_objects(source_prefix)
+		dest_keys = [obj['Key'] for obj in self.list_objects(dest_prefix)]
+
+		logger.info(f"Deleting {len(dest_keys)} objects at {dest_prefix}")
+		objects_deleted = self.delete_keys(dest_keys)
+
+		logger.info(f"Copying {len(source_objects)} objects from {source_prefix} to {dest_prefix} "
+					f"with {self.max_workers} workers")
+		with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+			futures = [
+				executor.submit(self.copy_object, obj['Key'], dest_prefix + obj['Key'][len(source_prefix):], obj['Size'])
+				for obj in source_objects
+			]
+			# Raise the first error, if any
+			for future in futures:
+				future.result()
+
+		return CopySummary(
+			objects_copied=len(source_objects),
+			bytes_copied=sum(obj['Size'] for obj in source_objects),
+			objects_deleted=objects_deleted,
+			seconds=time.perf_counter() - start_time,
+		)
@@ -0,0 +1,66 @@
+""" Download of large S3 objects with concurrent byte-range GET requests """
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.exceptions import ClientError
+
+logger = logging.getLogger(__name__)
+
+
+def parallel_get(client, bucket: str, key: str, part_size: int, max_concurrency: int,
+				 first_part_size: int = None) -> bytearray:
+	"""
+	Download an object with byte-range GET requests into a single preallocated buffer. Each part is written directly to
+	its slice of the buffer, so the buffer can be handed to a parser without being copied again.
+	The first range is requested alone and the headers of its response give the size and the ETag of the object, so no
+	HEAD request is needed and an object smaller than the first range takes a single request. All other ranges are then
+	requested at once, while the body of the first range is read, with IfMatch of that ETag, so that they fail with
+	PreconditionFailed instead of mixing the bytes of two versions if the object is replaced during the download.
+	:param client: boto3 S3 client, shared by all threads
+	:param bucket:
+	:param key:
+	:param part_size: Size of each range in bytes
+	:param max_concurrency: Maximum number of concurrent requests
+	:param first_part_size: Size of the first range in bytes. Defaults to part_size
+	:return: Content of the object
+	"""
+	first_part_size = first_part_size or part_size
+	try:
+		response = client.get_object(Bucket=bucket, Key=key, Range=f"bytes=0-{first_part_size - 1}")
+	except ClientError as e:
+		# A range of an empty object can not be satisfied
+		if e.response['Error']['Code'] == 'InvalidRange':
+			return bytearray()
+		raise
+	# The whole object is returned without ContentRange if the range covers it
+	size = int(response['ContentRange'].split('/')[-1]) if 'ContentRange' in response else response['ContentLength']
+	etag = response['ETag']
+
+	buffer = bytearray(size)
+	view = memoryview(buffer)
+
+	def read_range(body, start, end):
+		position = start
+		for chunk in body.iter_chunks(chunk_size=1024 * 1024):
+			view[position:position + len(chunk)] = chunk
+			position += len(chunk)
+		if position != end + 1:
+			raise IOError(f"Expected {end + 1 - start} bytes for range {start}-{end} of {key}, got {position - start}")
+
+	def get_range(start):
+		end = min(start + part_size, size) - 1
+		body = client.get_object(Bucket=bucket, Key=key, Range=f"bytes={start}-{end}", IfMatch=etag)["Body"]
+		read_range(body, start, end)
+
+	if size <= first_part_size:
+		read_range(response["Body"], 0, size - 1)
+		return buffer
+
+	logger.info(f"Downloading {key} ({size} bytes) in parts of {part_size} bytes with {max_concurrency} threads")
+	with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+		futures = [executor.submit(read_range, response["Body"], 0, first_part_size - 1)]
+		futures += [executor.submit(get_range, start) for start in range(first_part_size, size, part_size)]
+		for future in futures:
+			future.result()
+
+	return buffer
@@ -0,0 +1,333 @@
+""" Storage handler which records the latency, calls and bytes of every operation of another storage handler """
+import bisect
+import itertools
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import List, Dict, Tuple, Iterator
+
+import pandas as pd
+
+from project_starter_lib.data.handlers.common import StorageHandler, CopySummary, ObjectInfo
+from project_starter_lib.data.handlers.local import local_size
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds in seconds of the buckets of the latency histograms
+LATENCY_BUCKETS = [0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120]
+QUANTILES = [0.5, 0.95, 0.99]
+
+
+def _n_bytes(data) -> int:
+	""" Size of data which is loaded or saved. For data frames it is their size in memory, not the size of the file """
+	if isinstance(data, pd.DataFrame):
+		return int(data.memory_usage(index=False).sum())
+	if isinstance(data, (bytes, bytearray, memoryview, str)):
+		return len(data)
+	return 0
+
+
+@dataclass
+class OperationStats:
+	""" Calls of one operation on one prefix """
+	calls: int = 0
+	errors: int = 0
+	slow_calls: int = 0
+	bytes: int = 0
+	seconds: float = 0
+	max_seconds: float = 0
+	# Number of calls per bucket of LATENCY_BUCKETS, and of the calls slower than the last bucket
+	latency_counts: List[int] = field(default_factory=lambda: [0] * (len(LATENCY_BUCKETS) + 1), repr=False)
+
+	def add_latency(self, seconds: float):
+		self.latency_counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+
+	def quantile(self, q: float) -> float:
+		"""
+		Estimate from the histogram, as histogram_quantile of Prometheus: interpolated linearly within the bucket of
+		the quantile. At most the slowest call
+		"""
+		n_calls = sum(self.latency_counts)
+		if n_calls == 0:
+			return 0.
+		rank = q * n_calls
+		lower_bound, n_below = 0., 0
+		for bound, count in zip(LATENCY_BUCKETS, self.latency_counts):
+			if n_below + count >= rank and count > 0:
+				return min(lower_bound + (bound - lower_bound) * (rank - n_below) / count, self.max_seconds)
+			lower_bound, n_below = bound, n_below + count
+		return self.max_seconds
+
+	def bucket_counts(self) -> List[int]:
+		""" Cumulative number of calls per bucket of LATENCY_BUCKETS, as in Prometheus histograms """
+		return list(itertools.accumulate(self.latency_counts[:len(LATENCY_BUCKETS)]))
+
+
+class TracingStorageHandler(StorageHandler):
+	"""
+	Wraps any storage handler and records for every operation (method of the handler) and prefix the number of calls,
+	errors, bytes and a histogram of the latencies of the calls. Calls slower than slow_call_seconds are logged as
+	warnings.
+	If the wrapped handler sends requests with botocore, every request is also recorded as operation s3:{name of the
+	request}, e.g. s3:GetObject or s3:ListObjectsV2 per page of a listing. Their latency is the time from sending the
+	request until its response is parsed, including retries, but not reading the body of a download. So the latency of
+	a load is split into its requests and the parsing of the data.
+	The prefix of a path is its first prefix_depth folders, so that e.g. the run ids in the paths do not create a prefix
+	per run.
+	Stats are kept per process. Calls made in worker processes are not included.
+	"""
+
+	def __init__(self, storage_handler: StorageHandler, slow_call_seconds: float = 1., prefix_depth: int = 3,
+				 trace_requests: bool = True):
+		"""
+		Parameters
+		----------
+		storage_handler
+			Handler to trace
+		slow_call_seconds
+			Calls which take longer are logged
+		prefix_depth
+			Number of folders of a path which are kept as its prefix
+		trace_requests
+			Whether to record the botocore requests of the wrapped handler, if it has register_event_handler
+		"""
+		self.storage_handler = storage_handler
+		self.slow_call_seconds = slow_call_seconds
+		self.prefix_depth = prefix_depth
+		# (operation, prefix) -> stats
+		self.stats: Dict[Tuple[str, str], OperationStats] = {}
+		self._lock = threading.Lock()
+		if trace_requests and hasattr(storage_handler, 'register_event_handler'):
+			storage_handler.register_event_handler('provide-client-params.s3', self._on_request_params)
+			storage_handler.register_event_handler('before-send.s3', self._on_request_send)
+			storage_handler.register_event_handler('after-call.s3', self._on_request_done)
+			storage_handler.register_event_handler('after-call-error.s3', self._on_request_error)
+
+	def __getstate__(self):
+		""" Locks cannot be pickled, e.g. when sent to a joblib worker """
+		state = self.__dict__.copy()
+		state.pop('_lock')
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._lock = threading.Lock()
+
+	def __getattr__(self, item):
+		""" Everything which is not traced, e.g. confirm_access, comes from the wrapped handler """
+		if item == 'storage_handler':
+			raise AttributeError(item)
+		return getattr(self.storage_handler, item)
+
+	def prefix(self, path: str) -> str:
+		return "/".join(path.split("/")[:self.prefix_depth])
+
+	def record(self, operation: str, path: str, seconds: float, n_bytes: int = 0, error: bool = False):
+		""" Add a call to the stats """
+		prefix = self.prefix(path)
+		with self._lock:
+			stats = self.stats.setdefault((operation, prefix), OperationStats())
+			stats.calls += 1
+			stats.errors += int(error)
+			stats.bytes += n_bytes
+			stats.seconds += seconds
+			stats.add_latency(seconds)
+			stats.max_seconds = max(stats.max_seconds, seconds)
+			if seconds > self.slow_call_seconds:
+				stats.slow_calls += 1
+		if seconds > self.slow_call_seconds:
+			logger.warning(f"Slow storage call: {operation} {path} took {seconds:.2f}s")
+
+	@staticmethod
+	def _on_request_params(params, model, context, **kwargs):
+		"""
+		botocore event before a request is built. Keeps its name and path in the context, which all events of the
+		request share
+		"""
+		context['trace_operation'] = f"s3:{model.name}"
+		context['trace_path'] = params.get('Key', params.get('Prefix', ''))
+
+	@staticmethod
+	def _on_request_send(request, **kwargs):
+		""" botocore event before every attempt of a request is sent. Only the first one starts the clock """
+		request.context.setdefault('trace_start_time', time.perf_counter())
+		# Uploads with a checksum trailer are sent in aws-chunked encoding, without Content-Length
+		n_bytes = request.headers.get('X-Amz-Decoded-Content-Length') or request.headers.get('Content-Length')
+		request.context.setdefault('trace_bytes', int(n_bytes or 0))
+
+	def _on_request_done(self, http_response, parsed, model, context, **kwargs):
+		""" botocore event after the response of a request is parsed """
+		if 'trace_start_time' not in context:
+			return
+		n_bytes = context['trace_bytes']
+		if model.has_streaming_output:
+			n_bytes += parsed.get('ContentLength', 0)
+		self.record(context['trace_operation'], context['trace_path'], time.perf_counter() - context['trace_start_time'],
+					n_bytes=n_bytes, error=http_response.status_code >= 300)
+
+	def _on_request_error(self, context, **kwargs):
+		""" botocore event if a request failed without a response, e.g. a connection error """
+		if 'trace_start_time' not in context:
+			return
+		self.record(context['trace_operation'], context['trace_path'], time.perf_counter() - context['trace_start_time'],
+					error=True)
+
+	def _trace(self, operation: str, path: str, function, *args, n_bytes=None, **kwargs):
+		"""
+		Call function and record the call
+		:param n_bytes: Function returning the bytes of the call from the result of function. Size of the result if None
+		"""
+		start_time = time.perf_counter()
+		try:
+			result = function(*args, **kwargs)
+		except Exception:
+			self.record(operation, path, time.perf_counter() - start_time, error=True)
+			raise
+		seconds = time.perf_counter() - start_time
+		self.record(operation, path, seconds, n_bytes=_n_bytes(result) if n_bytes is None else n_bytes(result))
+		return result
+
+	def _trace_chunks(self, operation: str, path: str, chunks: Iterator[pd.DataFrame]) -> Iterator[pd.DataFrame]:
+		""" Record the time spent producing the chunks, not the time the consumer spends on them, as one call """
+		seconds, n_bytes = 0., 0
+		error = False
+		try:
+			while True:
+				start_time = time.perf_counter()
+				try:
+					chunk = next(chunks)
+				except StopIteration:
+					seconds += time.perf_counter() - start_time
+					break
+				seconds += time.perf_counter() - start_time
+				n_bytes += _n_bytes(chunk)
+				yield chunk
+		except Exception:
+			error = True
+			raise
+		finally:
+			self.record(operation, path, seconds, n_bytes=n_bytes, error=error)
+
+	def list_files(self, prefix: str = "", suffix: str = "") -> List[str]:
+		return self._trace(
+			'list_files', prefix, self.storage_handler.list_files, prefix=prefix, suffix=suffix, n_bytes=lambda x: 0)
+
+	def load(self, path, **kwargs):
+		return self._trace('load', path, self.storage_handler.load, path, **kwargs)
+
+	def load_chunks(self, path, chunksize, **kwargs):
+		return self._trace_chunks(
+			'load_chunks', path, iter(self.storage_handler.load_chunks(path, chunksize, **kwargs)))
+
+	def save(self, file_path, data, **kwargs):
+		return self._trace('save', file_path, self.storage_handler.save, file_path, data,
+						   n_bytes=lambda x: _n_bytes(data), **kwargs)
+
+	def copy(self, source_location, dest_location, **kwargs):
+		self._trace('copy', dest_location, self.storage_handler.copy, source_location, dest_location, **kwargs)
+
+	def copy_prefix(self, source_prefix, dest_prefix, max_workers=16, **kwargs) -> CopySummary:
+		return self._trace(
+			'copy_prefix', dest_prefix, self.storage_handler.copy_prefix, source_prefix, dest_prefix,
+			max_workers=max_workers, n_bytes=lambda x: x.bytes_copied or 0, **kwargs
+		)
+
+	def upload(self, local_path, dest_path, **kwqrgs):
+		self._trace('upload', dest_path, self.storage_handler.upload, local_path, dest_path,
+					n_bytes=lambda x: local_size(local_path), **kwqrgs)
+
+	def delete(self, path: str, **kwargs):
+		return self._trace('delete', path, self.storage_handler.delete, path, n_bytes=lambda x: 0, **kwargs)
+
+	def download(self, to_dir, from_path, file_name, **kwargs):
+		self._trace('download', from_path, self.storage_handler.download, to_dir, from_path, file_name, **kwargs)
+
+	def download_file(self, path, local_path):
+		self._trace('download_file', path, self.storage_handler.download_file, path, local_path,
+					n_bytes=lambda x: local_size(local_path))
+
+	def head(self, path) -> ObjectInfo:
+		return self._trace('head', path, self.storage_handler.head, path, n_bytes=lambda x: 0)
+
+	def list_object_infos(self, prefix) -> List[ObjectInfo]:
+		return self._trace('list_object_infos', prefix, self.storage_handler.list_object_infos, prefix,
+						   n_bytes=lambda x: 0)
+
+	def summary(self) -> pd.DataFrame:
+		""" One row per operation and prefix, slowest first """
+		with self._lock:
+			rows = [
+				{
+					'operation' : operation,
+					'prefix'    : prefix,
+					'calls'     : stats.calls,
+					'errors'    : stats.errors,
+					'slow_calls': stats.slow_calls,
+					'bytes'     : stats.bytes,
+					'seconds'   : stats.seconds,
+					**{f'p{int(q * 100)}_seconds': stats.quantile(q) for q in QUANTILES},
+				}
+				for (operation, prefix), stats in self.stats.items()
+			]
+		if len(rows) == 0:
+			return pd.DataFrame()
+		return pd.DataFrame(rows).sort_values('seconds', ascending=False, ignore_index=True)
+
+	def to_prometheus(self) -> str:
+		""" The stats in the Prometheus text format, e.g. for the textfile collector of the node exporter """
+		with self._lock:
+			items = sorted(self.stats.items())
+
+		def labels(operation, prefix, **extra):
+			pairs = {'operation': operation, 'prefix': prefix, **extra}
+			escaped = {k: str(v).replace('\\', '\\\\').replace('"', '\\"') for k, v in pairs.items()}
+			return "{" + ",".join(f'{k}="{v}"' for k, v in escaped.items()) + "}"
+
+		lines = [
+			"# HELP storage_operation_duration_seconds Latency of storage handler calls",
+			"# TYPE storage_operation_duration_seconds histogram",
+		]
+		for (operation, prefix), stats in items:
+			for bound, count in zip(LATENCY_BUCKETS, stats.bucket_counts()):
+				lines.append(f"storage_operation_duration_seconds_bucket{labels(operation, prefix, le=bound)} {count}")
+			lines.append(f"storage_operation_duration_seconds_bucket{labels(operation, prefix, le='+Inf')} {stats.calls}")
+			lines.append(f"storage_operation_duration_seconds_sum{labels(operation, prefix)} {stats.seconds}")
+			lines.append(f"storage_operation_duration_seconds_count{labels(operation, prefix)} {stats.calls}")
+
+		lines += [
+			"# HELP storage_operation_duration_quantile_seconds Quantiles of the latency of storage handler calls",
+			"# TYPE storage_operation_duration_quantile_seconds gauge",
+		]
+		for (operation, prefix), stats in items:
+			for q in QUANTILES:
+				lines.append(f"storage_operation_duration_quantile_seconds{labels(operation, prefix, quantile=q)} "
+							 f"{stats.quantile(q)}")
+
+		for name, attribute, description in [
+			('storage_operation_bytes_total', 'bytes', 'Bytes loaded, saved, copied, uploaded or downloaded'),
+			('storage_operation_errors_total', 'errors', 'Storage handler calls which raised'),
+			('storage_operation_slow_calls_total', 'slow_calls', 'Storage handler calls slower than the threshold'),
+		]:
+			lines += [f"# HELP {name} {description}", f"# TYPE {name} counter"]
+			for (operation, prefix), stats in items:
+				lines.append(f"{name}{labels(operation, prefix)} {getattr(stats, attribute)}")
+
+		return "\n".join(lines) + "\n"
+
+	def export(self, textfile_path: str):
+		"""
+		Write the stats to a Prometheus textfile and log a summary. The file is replaced atomically so that a collector
+		never reads a partial file
+		"""
+		summary = self.summary()
+		if len(summary) > 0:
+			logger.info(f"Storage I/O summary:\n{summary.to_string()}")
+
+		os.makedirs(os.path.dirname(os.path.abspath(textfile_path)), exist_ok=True)
+		tmp_path = f"{textfile_path}.{os.getpid()}.tmp"
+		with open(tmp_path, 'w') as f:
+			f.write(self.to_prometheus())
+		os.replace(tmp_path, textfile_path)
+		logger.info(f"Saved storage I/O metrics to {textfile_path}")
@@ -0,0 +1,141 @@
+""" Schemas compiled once into an immutable plan to read, validate and coerce data frames """
+import hashlib
+import json
+import logging
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Dict, List, Tuple, Optional, Iterable
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass(frozen=True)
+class SchemaPlan:
+	"""
+	Immutable plan compiled from a schema dict like the ones in schemas.py
+	- reader options: what to pass to read_csv/read_parquet so that only the schema columns are read
+	- cast plan: dtype of each column, datetime columns and columns which are ids stored as string
+	- validation plan: expected columns and dtype names
+	"""
+	columns: Tuple[str, ...]
+	dtypes: Tuple[Tuple[str, str], ...]
+	int_to_string_cols: Tuple[str, ...]
+	version: str
+
+	@property
+	def dtype_map(self) -> Dict[str, str]:
+		return dict(self.dtypes)
+
+	@property
+	def date_cols(self) -> List[str]:
+		return [col for col, dtype in self.dtypes if 'datetime' in dtype]
+
+	def csv_reader_options(self) -> dict:
+		""" read_csv cannot change datetime dtypes directly, they have to be sent as parse_dates """
+		return {
+			'usecols'    : list(self.columns),
+			'dtype'      : {col: dtype for col, dtype in self.dtypes if 'datetime' not in dtype},
+			'parse_dates': self.date_cols,
+		}
+
+	def parquet_reader_options(self) -> dict:
+		return {'columns': list(self.columns)}
+
+	def problems(self, df: pd.DataFrame) -> List[str]:
+		""" All differences between the data frame and the schema, empty if the data frame matches """
+		expected = self.dtype_map
+		missing_cols = [col for col in self.columns if col not in df.columns]
+		additional_cols = [col for col in df.columns if col not in expected]
+		mismatched_cols = {
+			col: dtype.name
+			for col, dtype in df.dtypes.items()
+			if col in expected and dtype.name != expected[col]
+		}
+
+		problems = []
+		if len(missing_cols) > 0:
+			problems.append(f"Missing Columns {set(missing_cols)}")
+		if len(additional_cols) > 0:
+			problems.append(f"Additional Columns {set(additional_cols)}")
+		if len(mismatched_cols) > 0:
+			problems.append(f"Data Types do not match the schema: {mismatched_cols}")
+		return problems
+
+	def validate(self, df: pd.DataFrame) -> bool:
+		""" Returns True if the data frame matches the schema. Else raises an AssertionError with all differences """
+		problems = self.problems(df)
+		assert len(problems) == 0, ". ".join(problems)
+		return True
+
+	def coerce(self, df: pd.DataFrame) -> pd.DataFrame:
+		"""
+		Drop the columns which are not in the schema and cast the others to the schema dtypes.
+		The input data frame is not modified and only the columns which need a cast are copied.
+		"""
+		expected = self.dtype_map
+		drop_col_list = [col for col in df.columns if col not in expected]
+		if len(drop_col_list) > 0:
+			logger.warning(f"Some columns are being dropped: {drop_col_list}")
+			df = df[[col for col in df.columns if col in expected]]
+		else:
+			# Assigning columns to a shallow copy does not touch the input data frame
+			df = df.copy(deep=False)
+
+		converted = {}
+		for column, dtype in df.dtypes.items():
+			expected_dtype = expected[column]
+			is_id_col = column in self.int_to_string_cols or (expected_dtype == 'object' and dtype.name != 'object')
+			if dtype.name == expected_dtype and not is_id_col:
+				continue
+
+			if is_id_col:
+				# id cols if specified as object, become int. Integers can be converted to string directly
+				series = df[column]
+				if not pd.api.types.is_integer_dtype(series.dtype):
+					series = series.astype(int, errors='raise')
+				df[column] = series.astype(str, errors='raise')
+			elif 'datetime' in expected_dtype:
+				df[column] = pd.to_datetime(df[column], errors="coerce").astype(expected_dtype)
+			else:
+				df[column] = df[column].astype(expected_dtype, errors='raise')
+			converted[column] = f"{dtype.name} -> {expected_dtype}"
+
+		if len(converted) > 0:
+			logger.info(f"Converted schema of columns {converted}")
+		return df
+
+	def apply(self, df: pd.DataFrame) -> pd.DataFrame:
+		""" Coerce the data frame to the schema and validate the result """
+		df = self.coerce(df)
+		self.validate(df)
+		return df
+
+
+def _normalize_dtype(dtype) -> str:
+	dtype = str(dtype)
+	return 'object' if dtype == 'str' else dtype
+
+
+@lru_cache(maxsize=None)
+def _compile(dtypes: Tuple[Tuple[str, str], ...], int_to_string_cols: Tuple[str, ...]) -> SchemaPlan:
+	version = hashlib.sha1(json.dumps([dtypes, int_to_string_cols]).encode()).hexdigest()[:12]
+	return SchemaPlan(
+		columns=tuple(col for col, _ in dtypes),
+		dtypes=dtypes,
+		int_to_string_cols=int_to_string_cols,
+		version=version,
+	)
+
+
+def compile_schema(schema: dict, int_to_string_cols: Optional[Iterable[str]] = None) -> SchemaPlan:
+	"""
+	Compile a schema dict into a SchemaPlan. Plans are cached, so compiling the same schema again is cheap.
+	The schema dict is not modified.
+	:param schema: column name -> dtype
+	:param int_to_string_cols: id columns which should be first converted to integer and then to string
+	:return:
+	"""
+	dtypes = tuple((col, _normalize_dtype(dtype)) for col, dtype in schema.items())
+	return _compile(dtypes, tuple(int_to_string_cols or ()))
@@ -0,0 +1,260 @@
+""" Suggest compact schemas for the files of the pipelines, and downcast data frames at load time
+
+Columns which are read without a schema are int64, float64 or object, which often uses several times the memory that is
+needed. The profiler streams a file in chunks, keeps a few statistics per column and suggests for every column the
+smallest dtype which holds all its values:
+- integers, and floats which only have whole numbers: the smallest integer dtype whose range fits the values. A nullable
+  integer dtype, e.g. Int16, if there are missing values
+- other floats: float32 if every value is exactly representable as float32, else float64
+- booleans: bool, or the nullable boolean if there are missing values
+- strings: category if there are few distinct values, else object
+
+Run from the root directory, for a file of the storage handler:
+	python -m project_starter_lib.data.schema_profiler input_data/sample_input_data.csv --chunksize 1000000
+"""
+import logging
+import sys
+from dataclasses import dataclass, field
+from typing import Dict, Iterable, Optional, Set
+
+import click
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+INT_DTYPES = ['int8', 'int16', 'int32', 'int64']
+
+# Defaults of when strings become a category: at most this many distinct values, and at most this share of the values
+MAX_CATEGORIES = 1000
+MAX_CATEGORY_RATIO = 0.5
+
+
+def smallest_int_dtype(min_value: int, max_value: int) -> Optional[str]:
+	""" Smallest integer dtype which can hold all values between min_value and max_value. None if there is none """
+	for dtype in INT_DTYPES:
+		info = np.iinfo(dtype)
+		if info.min <= min_value and max_value <= info.max:
+			return dtype
+	if min_value >= 0 and max_value <= np.iinfo('uint64').max:
+		return 'uint64'
+	return None
+
+
+def _is_float32_lossless(values: np.ndarray) -> bool:
+	"""
+	Whether every value is the same after a round trip through float32. Values out of the float32 range become inf.
+	NaN stays NaN
+	"""
+	with np.errstate(over='ignore'):
+		round_trip = values.astype('float32').astype(values.dtype)
+	return bool(((round_trip == values) | np.isnan(values)).all())
+
+
+def _kind(series: pd.Series) -> str:
+	""" bool, int, float, datetime or string, where string is everything else """
+	if pd.api.types.is_bool_dtype(series.dtype):
+		return 'bool'
+	if pd.api.types.is_integer_dtype(series.dtype):
+		return 'int'
+	if pd.api.types.is_float_dtype(series.dtype):
+		return 'float'
+	if pd.api.types.is_datetime64_any_dtype(series.dtype):
+		return 'datetime'
+	return 'string'
+
+
+@dataclass
+class ColumnProfile:
+	""" Statistics of one column, accumulated over the chunks of a file """
+	name: str
+	n_rows: int = 0
+	n_missing: int = 0
+	# Kinds of the column in the chunks. A column can e.g. be int in one chunk and float in another with missing values
+	kinds: Set[str] = field(default_factory=set)
+	# dtypes in which the column was read, and its memory in those dtypes
+	read_dtypes: Set[str] = field(default_factory=set)
+	read_bytes: int = 0
+	# Range of the numeric values
+	min_value: Optional[float] = None
+	max_value: Optional[float] = None
+	# Whether all numeric values are whole numbers, and whether they are exactly representable as float32
+	is_integral: bool = True
+	is_float32_lossless: bool = True
+	# Distinct values of strings. None once there are more than max_distinct
+	distinct: Optional[Set] = field(default_factory=set, repr=False)
+
+	@property
+	def n_values(self) -> int:
+		return self.n_rows - self.n_missing
+
+	@property
+	def n_distinct(self) -> Optional[int]:
+		""" Number of distinct strings. None if the column is not a string or has too many distinct values """
+		return len(self.distinct) if self.distinct is not None and 'string' in self.kinds else None
+
+	def update(self, series: pd.Series, max_distinct: int = MAX_CATEGORIES):
+		""" Add the values of a chunk """
+		kind = _kind(series)
+		self.kinds.add(kind)
+		self.read_dtypes.add(str(series.dtype))
+		self.read_bytes += int(series.memory_usage(index=False, deep=True))
+
+		is_missing = series.isna()
+		self.n_rows += len(series)
+		self.n_missing += int(is_missing.sum())
+		values = series[~is_missing]
+		if len(values) == 0:
+			return
+
+		if kind in ['int', 'float', 'bool']:
+			array = values.to_numpy(dtype='float64' if kind == 'float' else 'int64')
+			min_value, max_value = array.min(), array.max()
+			# Integers are kept as python ints so that large int64 values are not rounded
+			if kind != 'float':
+				min_value, max_value = int(min_value), int(max_value)
+			self.min_value = min_value if self.min_value is None else min(self.min_value, min_value)
+			self.max_value = max_value if self.max_value is None else max(self.max_value, max_value)
+			if kind == 'float':
+				self.is_integral &= bool((np.isfinite(array) & (array == np.round(array))).all())
+			self.is_float32_lossless &= _is_float32_lossless(array) if kind == 'float' else bool(
+				abs(min_value) <= 2 ** 24 and abs(max_value) <= 2 ** 24)
+		elif kind == 'string' and self.distinct is not None:
+			self.distinct.update(values.unique())
+			if len(self.distinct) > max_distinct:
+				self.distinct = None
+
+	def suggest_dtype(self, max_categories: int = MAX_CATEGORIES, max_category_ratio: float = MAX_CATEGORY_RATIO) -> str:
+		""" Smallest dtype which holds all values of the column """
+		if self.n_values == 0:
+			return 'object'
+		if self.kinds == {'bool'}:
+			return 'bool' if self.n_missing == 0 else 'boolean'
+		if self.kinds <= {'int', 'float', 'bool'}:
+			int_dtype = smallest_int_dtype(self.min_value, self.max_value) if self.is_integral else None
+			if int_dtype is not None:
+				# Nullable integer dtypes are capitalized, e.g. Int16
+				return int_dtype if self.n_missing == 0 else int_dtype.capitalize().replace('Uint', 'UInt')
+			return 'float32' if self.is_float32_lossless else 'float64'
+		if self.kinds == {'datetime'}:
+			return 'datetime64[ns]'
+		if self.n_distinct is not None and self.n_distinct <= min(max_categories, max_category_ratio * self.n_values):
+			return 'category'
+		return 'object'
+
+	def projected_bytes(self, dtype: str) -> int:
+		""" Memory of the column in the given dtype """
+		if dtype == 'object':
+			return self.read_bytes
+		if dtype == 'category':
+			codes_dtype = smallest_int_dtype(-1, len(self.distinct))
+			return self.n_rows * np.dtype(codes_dtype).itemsize + sum(sys.getsizeof(x) for x in self.distinct)
+		pandas_dtype = pd.api.types.pandas_dtype(dtype)
+		# Nullable dtypes have a mask of one byte per row
+		mask_bytes = self.n_rows if isinstance(pandas_dtype, pd.api.extensions.ExtensionDtype) else 0
+		return self.n_rows * np.dtype(pandas_dtype.type).itemsize + mask_bytes
+
+
+def profile_chunks(chunks: Iterable[pd.DataFrame], max_distinct: int = MAX_CATEGORIES) -> Dict[str, ColumnProfile]:
+	"""
+	Profile all columns of the chunks of a file. Only the statistics are kept in memory, not the chunks
+	:param chunks: e.g. DataStore.iter_chunks
+	:param max_distinct: Distinct values of strings are only counted up to this number
+	:return: Column -> profile
+	"""
+	profiles = {}
+	for chunk in chunks:
+		for col in chunk.columns:
+			profiles.setdefault(col, ColumnProfile(name=col)).update(chunk[col], max_distinct=max_distinct)
+	return profiles
+
+
+def suggest_schema(profiles: Dict[str, ColumnProfile], max_categories: int = MAX_CATEGORIES,
+				   max_category_ratio: float = MAX_CATEGORY_RATIO) -> Dict[str, str]:
+	""" Schema dict like the ones in schemas.py """
+	return {col: profile.suggest_dtype(max_categories, max_category_ratio) for col, profile in profiles.items()}
+
+
+def memory_report(profiles: Dict[str, ColumnProfile], schema: Dict[str, str]) -> pd.DataFrame:
+	""" Memory of every column as read without a schema and in the suggested dtype """
+	report = pd.DataFrame([
+		{
+			'column'         : col,
+			'read_dtype'     : ", ".join(sorted(profile.read_dtypes)),
+			'suggested_dtype': schema[col],
+			'missing'        : profile.n_missing,
+			'distinct'       : profile.n_distinct,
+			'read_mb'        : profile.read_bytes / 1024 ** 2,
+			'projected_mb'   : profile.projected_bytes(schema[col]) / 1024 ** 2,
+		}
+		for col, profile in profiles.items()
+	])
+	report['distinct'] = report['distinct'].astype('Int64')
+	report['saving'] = 1 - report['projected_mb'] / report['read_mb']
+	return report
+
+
+def format_schema(schema: Dict[str, str], name: str) -> str:
+	""" The schema as python code in the style of schemas.py """
+	width = max(len(repr(col)) for col in schema)
+	lines = [f"\t{repr(col):<{width}}: {dtype!r}," for col, dtype in schema.items()]
+	return "\n".join([f"{name} = {{"] + lines + ["}"])
+
+
+def downcast(df: pd.DataFrame, exclude: Iterable[str] = ()) -> pd.DataFrame:
+	"""
+	Safe downcasts of the columns, which keep every value and the semantics of missing values: integers to the smallest
+	integer dtype which fits, floats to float32 if all values are exactly representable. Other columns, e.g. strings,
+	are not changed. The input data frame is not modified and only the downcast columns are copied.
+	:param df:
+	:param exclude: Columns which are not downcast, e.g. the columns of a schema
+	:return:
+	"""
+	exclude = set(exclude)
+	converted = {}
+	df = df.copy(deep=False)
+	for col in df.columns:
+		series = df[col]
+		# Only numpy dtypes. Nullable and extension dtypes are left as they are
+		if col in exclude or not isinstance(series.dtype, np.dtype) or len(series) == 0:
+			continue
+		dtype = None
+		if series.dtype.kind in 'iu':
+			dtype = smallest_int_dtype(int(series.min()), int(series.max()))
+		elif series.dtype == np.dtype('float64') and _is_float32_lossless(series.to_numpy()):
+			dtype = 'float32'
+		if dtype is not None and np.dtype(dtype).itemsize < series.dtype.itemsize:
+			df[col] = series.astype(dtype)
+			converted[col] = f"{series.dtype.name} -> {dtype}"
+	if len(converted) > 0:
+		logger.info(f"Downcast columns {converted}")
+	return df
+
+
+@click.command()
+@click.argument("file_name")
+@click.option("--chunksize", default=1_000_000, show_default=True, help="Number of rows read at a time")
+@click.option("--max-categories", default=MAX_CATEGORIES, show_default=True,
+			  help="Strings with at most this many distinct values become a category")
+@click.option("--max-category-ratio", default=MAX_CATEGORY_RATIO, show_default=True,
+			  help="and with at most this share of distinct values")
+@click.option("--name", default="SUGGESTED_SCHEMA", show_default=True, help="Name of the schema in the output")
+def cli(file_name, chunksize, max_categories, max_category_ratio, name):
+	""" Suggest a schema for FILE_NAME, a path of the storage handler, and report the memory it would save """
+	from project_starter_lib.data.data_stores import DataStore
+
+	profiles = profile_chunks(DataStore(file_name=file_name).iter_chunks(chunksize=chunksize), max_categories)
+	schema = suggest_schema(profiles, max_categories, max_category_ratio)
+	report = memory_report(profiles, schema)
+
+	n_rows = max(profile.n_rows for profile in profiles.values()) if len(profiles) > 0 else 0
+	print(f"{file_name}: {n_rows} rows, {len(profiles)} columns\n")
+	print(report.to_string(index=False, float_format=lambda x: f"{x:.2f}"))
+	read_mb, projected_mb = report['read_mb'].sum(), report['projected_mb'].sum()
+	print(f"\nMemory: {read_mb:.2f}MB as read, {projected_mb:.2f}MB with the suggested schema "
+		  f"({1 - projected_mb / max(read_mb, 1e-9):.0%} less)\n")
+	print(format_schema(schema, name))
+
+
+if __name__ == "__main__":
+	cli()
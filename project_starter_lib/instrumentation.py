@@ -0,0 +1,137 @@
+""" Resource usage of tasks and pipelines, and the rows and bytes they read and write """
+import cProfile
+import io
+import logging
+import pstats
+import resource
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from dataclasses import dataclass, field, asdict
+from typing import Dict, Optional, Iterator
+
+logger = logging.getLogger(__name__)
+
+PROFILERS = ['none', 'cprofile']
+
+# Metrics of the task running in the current thread. Data stores add the rows and bytes they read and write to it
+_active_metrics: ContextVar[Optional['Metrics']] = ContextVar('active_metrics', default=None)
+
+
+@dataclass
+class DataStoreIO:
+	""" Rows and bytes read and written through one data store """
+	rows_read: int = 0
+	rows_written: int = 0
+	bytes_read: int = 0
+	bytes_written: int = 0
+
+
+@dataclass
+class Metrics:
+	"""
+	Resource usage of a task or pipeline.
+	CPU time and peak RSS are counters of the whole process, including finished child processes. When tasks run
+	concurrently on threads they include the usage of the other tasks.
+	"""
+	name: str
+	wall_seconds: float = 0
+	cpu_seconds: float = 0
+	# How much the peak RSS of the process increased while running. 0 if it stayed below an earlier peak
+	peak_rss_delta_mb: float = 0
+	data_stores: Dict[str, DataStoreIO] = field(default_factory=dict)
+	# Set if the outputs of an earlier run were reused by the task cache instead of running the task
+	reused_run_id: Optional[str] = None
+	profile_path: Optional[str] = None
+	# Text report of the profiler, sorted by cumulative time. Not part of to_dict
+	profile_report: Optional[str] = field(default=None, repr=False)
+
+	def totals(self) -> DataStoreIO:
+		""" Rows and bytes over all data stores """
+		return DataStoreIO(**{
+			key: sum(getattr(x, key) for x in self.data_stores.values()) for key in asdict(DataStoreIO())
+		})
+
+	def to_dict(self) -> dict:
+		output = asdict(self)
+		output.pop('profile_report')
+		output.update(asdict(self.totals()))
+		return output
+
+
+def is_recording() -> bool:
+	""" Whether the current thread is measuring a task, i.e. whether the data stores should record what they read """
+	return _active_metrics.get() is not None
+
+
+def record_io(data_store_name: str, rows_read: int = 0, rows_written: int = 0, bytes_read: int = 0,
+			  bytes_written: int = 0):
+	""" Add rows and bytes read or written through a data store to the metrics of the running task, if any """
+	metrics = _active_metrics.get()
+	if metrics is None:
+		return
+	data_store_io = metrics.data_stores.setdefault(data_store_name, DataStoreIO())
+	data_store_io.rows_read += rows_read
+	data_store_io.rows_written += rows_written
+	data_store_io.bytes_read += bytes_read
+	data_store_io.bytes_written += bytes_written
+
+
+def _cpu_seconds() -> float:
+	cpu_seconds = 0
+	for who in [resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN]:
+		usage = resource.getrusage(who)
+		cpu_seconds += usage.ru_utime + usage.ru_stime
+	return cpu_seconds
+
+
+def _peak_rss_mb() -> float:
+	# ru_maxrss is in kilobytes on linux
+	return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+@contextmanager
+def measure(name: str, profiler: str = 'none', profile_top_n: int = 50) -> Iterator[Metrics]:
+	"""
+	Measure the code run inside the context. The metrics are filled in when the context exits, also if it raises
+	:param name: Name of the task or pipeline
+	:param profiler: none or cprofile
+	:param profile_top_n: Number of functions in the profile report
+	:return: Metrics
+	"""
+	assert profiler in PROFILERS, f"Unknown profiler {profiler}"
+	metrics = Metrics(name=name)
+	token = _active_metrics.set(metrics)
+
+	profile = None
+	if profiler == 'cprofile':
+		profile = cProfile.Profile()
+		try:
+			profile.enable()
+		except ValueError:
+			# Only one profiler can be active at a time, e.g. when other tasks are profiled on other threads
+			logger.warning(f"Could not profile {name}, another profiler is already active")
+			profile = None
+
+	start_wall, start_cpu, start_peak_rss = time.perf_counter(), _cpu_seconds(), _peak_rss_mb()
+	try:
+		yield metrics
+	finally:
+		metrics.wall_seconds = time.perf_counter() - start_wall
+		metrics.cpu_seconds = _cpu_seconds() - start_cpu
+		metrics.peak_rss_delta_mb = _peak_rss_mb() - start_peak_rss
+		if profile is not None:
+			profile.disable()
+			report = io.StringIO()
+			pstats.Stats(profile, stream=report).sort_stats('cumulative').print_stats(profile_top_n)
+			metrics.profile_report = report.getvalue()
+		_active_metrics.reset(token)
+
+		# The rows and bytes of a task are also part of the pipeline it runs in
+		parent_metrics = _active_metrics.get()
+		if parent_metrics is not None:
+			for data_store_name, data_store_io in metrics.data_stores.items():
+				record_io(data_store_name, **asdict(data_store_io))
+
+		logger.info(f"{name} took {metrics.wall_seconds:.1f}s wall, {metrics.cpu_seconds:.1f}s cpu, "
+					f"peak RSS +{metrics.peak_rss_delta_mb:.0f}MB")
@@ -0,0 +1,268 @@
+""" Logging handler which ships the logs of a run to the storage handler while the run is going on
+
+Records are formatted and appended to an in-memory buffer, which is all that happens on the thread that logs. A
+background thread compresses the buffer every few seconds into the current segment, and uploads the segment as its own
+object once it is large or old enough:
+	{prefix}/part-00000.log.gz, {prefix}/part-00001.log.gz, ...
+So if the process dies, everything up to the last rotated segment has been shipped. Segments are complete gzip (or
+zstd) files and can be read one by one, or concatenated, e.g. `cat part-*.log.gz | gunzip`.
+Processes forked from the logging process, e.g. by the process pools of the tasks, do not ship their records: the
+background thread only runs in the process which created the handler.
+"""
+import logging
+import os
+import sys
+import threading
+import time
+import weakref
+import zlib
+from typing import List, Tuple
+
+from project_starter_lib.data.handlers.common import StorageHandler
+
+CODECS = ['gzip', 'zstd']
+EXTENSIONS = {'gzip': 'gz', 'zstd': 'zst'}
+
+
+class _ArrowCompressor:
+	""" Compresses every call of compress into its own frame with a pyarrow codec. Concatenated frames are one file """
+
+	def __init__(self, codec: str, level: int):
+		import pyarrow as pa
+		self._codec = pa.Codec(codec, level)
+
+	def compress(self, data: bytes) -> bytes:
+		return self._codec.compress(data, asbytes=True)
+
+	def flush(self) -> bytes:
+		return b""
+
+
+def _compressor(codec: str, level: int):
+	""" Streaming compressor with compress(data) and flush(), which ends the compressed file """
+	if codec == 'gzip':
+		# wbits 31 writes a gzip header and trailer instead of a zlib one
+		return zlib.compressobj(level, zlib.DEFLATED, 31)
+	if codec == 'zstd':
+		return _ArrowCompressor(codec, level)
+	raise NotImplementedError(f"Unknown codec {codec}. Should be one of {CODECS}")
+
+
+# Handlers of this process, reset in forked processes
+_handlers = weakref.WeakSet()
+
+
+def _after_fork_in_child():
+	for handler in list(_handlers):
+		handler._after_fork_in_child()
+
+
+os.register_at_fork(after_in_child=_after_fork_in_child)
+
+
+class LogShippingHandler(logging.Handler):
+	"""
+	Uploads the logs in compressed segments through a storage handler.
+	emit never waits for compression or uploads: it only appends the formatted record to a buffer. If more than
+	max_buffer_bytes are waiting, e.g. because uploads are slow, new records are dropped and the number of dropped records
+	is logged into the next segment. Segments whose upload failed are retried with the next segment, and the oldest
+	are dropped if more than max_failed_bytes of them wait.
+	"""
+
+	def __init__(self, prefix: str, storage_handler: StorageHandler = None, codec: str = 'gzip',
+				 compression_level: int = 6, segment_bytes: int = 16 * 1024 ** 2, segment_seconds: float = 60.,
+				 flush_seconds: float = 1., max_buffer_bytes: int = 64 * 1024 ** 2, max_failed_bytes: int = 64 * 1024 ** 2,
+				 close_timeout_seconds: float = 30., level=logging.NOTSET):
+		"""
+		Parameters
+		----------
+		prefix
+			Segments are uploaded to {prefix}/part-00000.log.gz etc.
+		storage_handler
+			Handler to upload the segments. config.STORAGE_HANDLER if None
+		codec
+			gzip or zstd. zstd is compressed by pyarrow
+		compression_level
+			Level of the codec
+		segment_bytes
+			A segment is uploaded and a new one started once it has this many bytes of uncompressed logs
+		segment_seconds
+			or once it is this old, so that not more than this much of the logs is lost if the process dies
+		flush_seconds
+			How often the buffered records are compressed into the segment
+		max_buffer_bytes
+			Records which are logged while this many bytes wait for compression are dropped
+		max_failed_bytes
+			The oldest segments whose upload failed are dropped while more than this many compressed bytes wait for a
+			retry
+		close_timeout_seconds
+			Maximum time close waits for the last segment to be uploaded
+		"""
+		super().__init__(level=level)
+		assert codec in CODECS, f"Unknown codec {codec}. Should be one of {CODECS}"
+		# Fails here instead of in the background thread if the codec or level can not be used
+		_compressor(codec, compression_level).compress(b"")
+		self.prefix = prefix
+		self._storage_handler = storage_handler
+		self.codec = codec
+		self.compression_level = compression_level
+		self.segment_bytes = segment_bytes
+		self.segment_seconds = segment_seconds
+		self.flush_seconds = flush_seconds
+		self.max_buffer_bytes = max_buffer_bytes
+		self.max_failed_bytes = max_failed_bytes
+		self.close_timeout_seconds = close_timeout_seconds
+
+		# Formatted records waiting for the background thread
+		self._buffer: List[bytes] = []
+		self._buffered_bytes = 0
+		self._dropped = 0
+		self._buffer_lock = threading.Lock()
+		# Whether this is a process forked from the one which created the handler
+		self._is_forked = False
+
+		# Current segment, only used by the background thread
+		self._compressor = None
+		self._compressed: List[bytes] = []
+		self._segment_raw_bytes = 0
+		self._segment_started = None
+		self._n_segments = 0
+		self._uploaded: List[str] = []
+		# Segments whose upload failed, retried with the next one. (path, data)
+		self._failed: List[Tuple[str, bytes]] = []
+		self._n_dropped_segments = 0
+
+		self._wake = threading.Event()
+		self._closing = threading.Event()
+		self._thread = threading.Thread(target=self._run, name='log-shipping', daemon=True)
+		self._thread.start()
+		_handlers.add(self)
+
+	def _after_fork_in_child(self):
+		"""
+		The background thread does not exist in a forked process, and the buffer lock could have been held by another
+		thread when the process forked. Records of the forked process are not shipped
+		"""
+		self._buffer_lock = threading.Lock()
+		self._buffer, self._buffered_bytes, self._dropped = [], 0, 0
+		self._is_forked = True
+
+	@property
+	def storage_handler(self) -> StorageHandler:
+		if self._storage_handler is None:
+			from project_starter_lib.config import config
+			self._storage_handler = config.STORAGE_HANDLER
+		return self._storage_handler
+
+	@property
+	def segment_paths(self) -> List[str]:
+		""" Paths of all segments uploaded so far """
+		return sorted(self._uploaded)
+
+	@property
+	def n_lost_segments(self) -> int:
+		""" Number of segments which were not uploaded, because their upload failed and was not retried yet or dropped """
+		return len(self._failed) + self._n_dropped_segments
+
+	def _segment_path(self, i: int) -> str:
+		return f"{self.prefix}/part-{i:05d}.log.{EXTENSIONS[self.codec]}"
+
+	def emit(self, record: logging.LogRecord):
+		if self._is_forked:
+			return
+		try:
+			line = (self.format(record) + "\n").encode()
+		except Exception:
+			self.handleError(record)
+			return
+		with self._buffer_lock:
+			if self._buffered_bytes + len(line) > self.max_buffer_bytes:
+				self._dropped += 1
+				return
+			self._buffer.append(line)
+			self._buffered_bytes += len(line)
+			# Compress early, before records have to be dropped
+			is_half_full = self._buffered_bytes >= self.max_buffer_bytes // 2
+		if is_half_full:
+			self._wake.set()
+
+	def flush(self):
+		""" Ask the background thread to compress the buffered records now. Does not wait for it """
+		self._wake.set()
+
+	def _compress_buffer(self):
+		""" Move the buffered records into the current segment """
+		with self._buffer_lock:
+			lines, self._buffer, self._buffered_bytes = self._buffer, [], 0
+			dropped, self._dropped = self._dropped, 0
+		if dropped > 0:
+			lines.append(f"{dropped} log records were dropped because the log shipping buffer was full\n".encode())
+		if len(lines) == 0:
+			return
+
+		if self._compressor is None:
+			self._compressor = _compressor(self.codec, self.compression_level)
+			self._segment_started = time.monotonic()
+		data = b"".join(lines)
+		self._compressed.append(self._compressor.compress(data))
+		self._segment_raw_bytes += len(data)
+
+	def _ship_segment(self):
+		""" Finish the current segment and upload it, together with earlier segments whose upload failed """
+		if self._compressor is not None:
+			self._compressed.append(self._compressor.flush())
+			self._failed.append((self._segment_path(self._n_segments), b"".join(self._compressed)))
+			self._n_segments += 1
+			self._compressor, self._compressed, self._segment_raw_bytes = None, [], 0
+
+		failed = []
+		for path, data in self._failed:
+			try:
+				self.storage_handler.save(path, data)
+				self._uploaded.append(path)
+			except Exception as e:
+				# Not logged, the record would come back to this handler
+				print(f"Could not upload log segment {path}: {e!r}", file=sys.stderr)
+				failed.append((path, data))
+
+		failed_bytes = sum(len(data) for _, data in failed)
+		while failed_bytes > self.max_failed_bytes:
+			path, data = failed.pop(0)
+			failed_bytes -= len(data)
+			self._n_dropped_segments += 1
+			print(f"Dropped log segment {path}, more than {self.max_failed_bytes} bytes of segments failed to upload",
+				  file=sys.stderr)
+		self._failed = failed
+
+	def _is_segment_due(self) -> bool:
+		return self._compressor is not None and (
+				self._segment_raw_bytes >= self.segment_bytes or
+				time.monotonic() - self._segment_started >= self.segment_seconds
+		)
+
+	def _run(self):
+		""" Background thread """
+		while not self._closing.is_set():
+			self._wake.wait(timeout=self.flush_seconds)
+			self._wake.clear()
+			try:
+				self._compress_buffer()
+				if self._is_segment_due():
+					self._ship_segment()
+			except Exception as e:
+				# The thread keeps shipping the next records
+				print(f"Log shipping failed: {e!r}", file=sys.stderr)
+		# Everything which was logged until close
+		self._compress_buffer()
+		self._ship_segment()
+
+	def close(self):
+		""" Upload the last segment. Waits at most close_timeout_seconds """
+		if not self._closing.is_set() and not self._is_forked:
+			self._closing.set()
+			self._wake.set()
+			self._thread.join(timeout=self.close_timeout_seconds)
+			if self._thread.is_alive():
+				print(f"Log shipping did not finish within {self.close_timeout_seconds}s", file=sys.stderr)
+		super().close()
+
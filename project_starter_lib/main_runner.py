@@ -2,24 +2,27 @@
 
 import click
 
-""" Entry point for the repo"""
+""" Entry point for the repo
+
+Only click and the constants are imported at the top, so that --help and invalid arguments are handled without
+importing pandas, boto3 etc. Everything else is imported when the pipelines run.
+"""
 import logging
 from collections import OrderedDict
 
-from project_starter_lib.config import config
 from project_starter_lib.constants import (
 	PIPELINE_INGEST_SOURCE_DATA,
 	PIPELINE_AGG_DATA,
 )
-from project_starter_lib.data.data_stores import AllDataStores, DataStore
-from project_starter_lib.pipelines import (
-	IngestSourceData,
-	AggData,
-)
 
 # Configure logger for use in package
 logger = logging.getLogger(__name__)
 
+# Whether the cli got to run pipelines, i.e. whether there are logs of a run to save
+run_started = False
+# Uploads the logs while the pipelines run, see start_log_shipping
+log_shipping_handler = None
+
 cmd_line_pipeline_choices = [
 	'all',
 	PIPELINE_INGEST_SOURCE_DATA,
@@ -42,6 +45,18 @@ def cli(pipelines):
     :return:
     """
 
+	from project_starter_lib.config import config
+	from project_starter_lib.data.data_stores import AllDataStores
+	from project_starter_lib.pipelines import (
+		IngestSourceData,
+		AggData,
+	)
+	from project_starter_lib.scheduler import DagScheduler
+
+	global run_started
+	run_started = True
+	start_log_shipping()
+
 	logger.info(f"Run Configs - root_folder_name:{config.ROOT_FOLDER_NAME}")
 
 	# Specify in which order the pipelines should run
@@ -93,26 +108,78 @@ def cli(pipelines):
 		pipeline_class_map[pipeline_name].all_data_stores = all_data_store
 
 	logger.info(f"Started running the pipelines {filtered_pipeline_names}")
-	# Run the pipelines that we want to run
-	for pipeline_name in filtered_pipeline_names:
-		pipeline_object = pipeline_class_map[pipeline_name]
-		pipeline_object.run_pipeline()
+	if config.SCHEDULER_CONFIGS['enabled']:
+		# Run the tasks of all pipelines concurrently, as allowed by the dependencies between them
+		DagScheduler(
+			pipelines=[pipeline_class_map[pipeline_name] for pipeline_name in filtered_pipeline_names],
+			max_workers=config.SCHEDULER_CONFIGS['max_workers'],
+			executor=config.SCHEDULER_CONFIGS['executor'],
+		).run()
+	else:
+		# Run the pipelines that we want to run
+		for pipeline_name in filtered_pipeline_names:
+			pipeline_object = pipeline_class_map[pipeline_name]
+			pipeline_object.run_pipeline()
 
 	logger.info("Completed Running all pipelines")
 
 
+def start_log_shipping():
+	""" Upload the logs of the run in compressed segments while the pipelines run """
+	from project_starter_lib.config import config
+	from project_starter_lib.config.logging_config import LOGGING_CONFIG
+	from project_starter_lib.log_shipping import LogShippingHandler
+
+	global log_shipping_handler
+	shipping_configs = config.LOG_SHIPPING_CONFIGS
+	time_stamp = config.current_time.strftime(format='%Y-%m-%d-%H%M%S')
+	log_shipping_handler = LogShippingHandler(
+		prefix=f"output_data/{config.ROOT_FOLDER_NAME}/logs/{time_stamp}_run_logs",
+		codec=shipping_configs['codec'],
+		compression_level=shipping_configs['compression_level'],
+		segment_bytes=int(shipping_configs['segment_mb'] * 1024 ** 2),
+		segment_seconds=shipping_configs['segment_seconds'],
+		flush_seconds=shipping_configs['flush_seconds'],
+		max_buffer_bytes=int(shipping_configs['max_buffer_mb'] * 1024 ** 2),
+		max_failed_bytes=int(shipping_configs['max_failed_mb'] * 1024 ** 2),
+		close_timeout_seconds=shipping_configs['close_timeout_seconds'],
+		level=logging.INFO,
+	)
+	log_format = LOGGING_CONFIG['formatters']['standard']
+	log_shipping_handler.setFormatter(logging.Formatter(log_format['format'], log_format['datefmt']))
+	logging.getLogger().addHandler(log_shipping_handler)
+	logger.info(f"Shipping logs to {log_shipping_handler.prefix}")
+
+
+def save_run_logs():
+	""" Export the storage I/O metrics, if traced, and upload the last segment of the logs of the run """
+	from project_starter_lib.config import config
+	from project_starter_lib.data.handlers.tracing import TracingStorageHandler
+
+	if isinstance(config.STORAGE_HANDLER, TracingStorageHandler):
+		config.STORAGE_HANDLER.export(config.STORAGE_TRACING_CONFIGS['textfile_path'])
+	if log_shipping_handler is not None:
+		logging.getLogger().removeHandler(log_shipping_handler)
+		log_shipping_handler.close()
+		# Only in the local logs, the shipped logs end with the last segment
+		logger.info(f"Uploaded {len(log_shipping_handler.segment_paths)} log segments to "
+					f"{log_shipping_handler.prefix}")
+		if log_shipping_handler.n_lost_segments > 0:
+			logger.warning(f"{log_shipping_handler.n_lost_segments} log segments could not be uploaded")
+
+
 if __name__ == "__main__":
 	exit_code = 1
 	try:
 		cli()
+	except SystemExit as e:
+		# click exits with the exit code of the command
+		exit_code = e.code
 	except Exception:
 		logger.error('Got exception on main runner', exc_info=True)  # Save all logs to S3
 		exit_code = -1
 	finally:
-		all_logs = open('./logs/run_logs.log', 'rb').read()
-		time_stamp = config.current_time.strftime(format='%Y-%m-%d-%H%M%S')
-		DataStore(
-			file_name=f"output_data/{config.ROOT_FOLDER_NAME}/logs/{time_stamp}_run_logs.txt",
-			flag_copy_to_latest=False
-		).data = all_logs
+		# Nothing to save if only --help was shown or the arguments were invalid
+		if run_started:
+			save_run_logs()
 	exit(exit_code)
@@ -0,0 +1,153 @@
+""" Hash partitioned map reduce of data frames across cores
+
+The rows of the input are split into shards by the hash of the partition columns, so that all rows with the same key
+are in the same shard. The map function processes every shard in a worker process, and the results of the shards are
+concatenated and passed to the reduce function. For an aggregation grouped by the partition columns the groups of the
+shards are disjoint, so the concatenated results of the shards are the result, also for aggregations such as mean which
+can not be merged.
+
+Shards and results are exchanged as Arrow IPC files in a temporary folder, which the workers memory map. Data frames are
+never pickled. With tmp_dir=/dev/shm the files are in shared memory.
+"""
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+
+logger = logging.getLogger(__name__)
+
+
+def _hash_column(column: pa.ChunkedArray) -> np.ndarray:
+	""" Hash of every value. Strings are dictionary encoded by arrow and only the distinct values are hashed """
+	if pa.types.is_string(column.type) or pa.types.is_large_string(column.type) or pa.types.is_binary(column.type):
+		encoded = pc.dictionary_encode(column).combine_chunks()
+		hashes = pd.util.hash_array(encoded.dictionary.to_numpy(zero_copy_only=False), categorize=False)
+		# Missing values have no index in the dictionary and get the hash after the last value
+		hashes = np.append(hashes, np.uint64(0))
+		return hashes[encoded.indices.fill_null(len(encoded.dictionary)).to_numpy()]
+	return pd.util.hash_pandas_object(column.to_pandas(), index=False).to_numpy()
+
+
+def partition_codes(table: pa.Table, partition_by: List[str], n_partitions: int) -> np.ndarray:
+	"""
+	Shard of every row. Rows with equal values in the partition columns are in the same shard
+	:param table:
+	:param partition_by: Partition columns
+	:param n_partitions: Number of shards
+	:return:
+	"""
+	hashes = np.zeros(len(table), dtype='uint64')
+	for col in partition_by:
+		hashes = hashes * np.uint64(1_000_003) ^ _hash_column(table[col])
+	return (hashes % np.uint64(n_partitions)).astype('int64')
+
+
+def _write_ipc_file(table: pa.Table, path: str):
+	with pa.OSFile(path, 'wb') as sink, pa.ipc.new_file(sink, table.schema) as writer:
+		writer.write_table(table)
+
+
+def _read_ipc_file(path: str) -> pa.Table:
+	""" Table backed by the memory mapped file, without copying it """
+	return pa.ipc.open_file(pa.memory_map(path)).read_all()
+
+
+def _split_chunk(chunk_path: str, split_path: str, partition_by: List[str], n_partitions: int) -> List[int]:
+	"""
+	Reorder the rows of a chunk by shard in a worker process, so that the rows of every shard are a slice of the
+	reordered chunk. Module level function so that it can be sent to a process.
+	:return: Number of rows of every shard
+	"""
+	table = _read_ipc_file(chunk_path)
+	codes = partition_codes(table, partition_by, n_partitions)
+	_write_ipc_file(table.take(np.argsort(codes, kind='stable')), split_path)
+	# The chunk is not needed anymore. It stays readable for as long as it is memory mapped
+	os.remove(chunk_path)
+	return np.bincount(codes, minlength=n_partitions).tolist()
+
+
+def _map_shard(slices: List[Tuple[str, int, int]], result_path: str,
+			   map_function: Callable[[pd.DataFrame], pd.DataFrame]) -> int:
+	"""
+	Apply the map function to one shard in a worker process and write the result to result_path.
+	Module level function so that it can be sent to a process.
+	:param slices: (path, offset, number of rows) of the rows of the shard in every split chunk
+	:return: Number of rows of the result
+	"""
+	table = pa.concat_tables([_read_ipc_file(path).slice(offset, n_rows) for path, offset, n_rows in slices])
+	df_result = map_function(table.to_pandas())
+	_write_ipc_file(pa.Table.from_pandas(df_result, preserve_index=False), result_path)
+	return len(df_result)
+
+
+def map_reduce(chunks: Iterable[pd.DataFrame], partition_by: List[str],
+			   map_function: Callable[[pd.DataFrame], pd.DataFrame],
+			   reduce_function: Optional[Callable[[pd.DataFrame], pd.DataFrame]] = None, n_partitions: int = None,
+			   max_workers: int = None, tmp_dir: str = None) -> pd.DataFrame:
+	"""
+	reduce_function(concat(map_function(shard) for every shard)), where the shards are the rows of the chunks split by
+	the hash of the partition columns.
+	Chunks are written to Arrow files as they come and split by shard in the worker processes, so hashing the keys
+	runs in parallel and overlaps with producing the next chunks. Once all chunks are split, the shards are mapped.
+	:param chunks: Data frames with the same columns, e.g. DataStore.iter_chunks
+	:param partition_by: Partition columns
+	:param map_function: Applied to every shard in a worker process. Must be picklable, e.g. a module level function or
+		a functools.partial of one
+	:param reduce_function: Applied to the concatenated results of the shards in this process. None to return them
+	:param n_partitions: Number of shards. Defaults to the number of cores
+	:param max_workers: Number of worker processes. Defaults to the number of cores
+	:param tmp_dir: Folder of the chunk and shard files, e.g. /dev/shm. Defaults to the temporary folder of the system
+	:return:
+	"""
+	n_partitions = n_partitions or os.cpu_count() or 1
+	max_workers = max_workers or os.cpu_count() or 1
+	with tempfile.TemporaryDirectory(prefix='shards_', dir=tmp_dir) as shard_dir, \
+			ProcessPoolExecutor(max_workers=max_workers) as executor:
+		schema, split_futures = None, []
+		for i, chunk in enumerate(chunks):
+			if schema is None:
+				# Every chunk is converted with the schema of the first one, so that all shards have the same schema,
+				# e.g. also if a column of a later chunk only has missing values
+				schema = pa.Schema.from_pandas(chunk, preserve_index=False)
+			chunk_path = os.path.join(shard_dir, f'chunk_{i}.arrow')
+			split_path = os.path.join(shard_dir, f'split_{i}.arrow')
+			_write_ipc_file(pa.Table.from_pandas(chunk, schema=schema, preserve_index=False), chunk_path)
+			split_futures.append(
+				(split_path, executor.submit(_split_chunk, chunk_path, split_path, partition_by, n_partitions))
+			)
+
+		# Where the rows of every shard are in the split chunks
+		shard_slices = [[] for _ in range(n_partitions)]
+		for split_path, future in split_futures:
+			offset = 0
+			for shard, n_rows in enumerate(future.result()):
+				if n_rows > 0:
+					shard_slices[shard].append((split_path, offset, n_rows))
+				offset += n_rows
+		shard_slices = [slices for slices in shard_slices if len(slices) > 0]
+		if len(shard_slices) == 0:
+			raise ValueError("No rows to map reduce")
+
+		logger.info(f"Mapping {len(shard_slices)} shards of {len(split_futures)} chunks by {partition_by} on "
+					f"{max_workers} processes")
+		result_paths = [os.path.join(shard_dir, f'result_{i}.arrow') for i in range(len(shard_slices))]
+		map_futures = [
+			executor.submit(_map_shard, slices, result_path, map_function)
+			for slices, result_path in zip(shard_slices, result_paths)
+		]
+		n_rows = sum(future.result() for future in map_futures)
+
+		# The data is copied once from the memory mapped results by to_pandas
+		tables = [_read_ipc_file(result_path) for result_path in result_paths]
+		# The results of all shards must have the same schema, e.g. aggregation.aggregate gives dtypes which only depend
+		# on the dtypes of the data
+		df = pa.concat_tables(tables, promote_options="default").to_pandas()
+		logger.info(f"Mapped {len(shard_slices)} shards to {n_rows} rows")
+
+	return df if reduce_function is None else reduce_function(df)
@@ -1,10 +1,8 @@
 """ All Pipeline Definitions"""
 
 import logging
-import gc
 
 from project_starter_lib.config import config
-from project_starter_lib import constants
 from project_starter_lib.common import Pipeline
 from project_starter_lib.constants import (
 	TASK_INGEST_FILE,
@@ -20,22 +18,38 @@ logger = logging.getLogger(__name__)
 class IngestSourceData(Pipeline):
 	""" Ingest Source Data Pipeline"""
 
+	task_classes = {
+		TASK_INGEST_FILE: IngestFile,
+	}
+
+	@property
+	def task_runner(self):
+		return config.TASK_RUNNER_INGEST_SOURCE_DATA
+
 	@decorate_run_pipeline
 	def run_pipeline(self):
 		""" Specify and run all tasks of the name"""
 
-		if config.TASK_RUNNER_INGEST_SOURCE_DATA[constants.TASK_INGEST_FILE]:
-			IngestFile(task_name=constants.TASK_INGEST_FILE, pipeline=self).run_task()
+		for task in self.get_tasks():
+			self.task_metrics.append(task.run())
 
 
 
 class AggData(Pipeline):
 	""" Aggregate up TXN and Inv Data and calculate sell by date for all stores """
 
+	task_classes = {
+		TASK_AGG_FILE: AggFile,
+	}
+
+	@property
+	def task_runner(self):
+		return config.TASK_RUNNER_AGG_DATA
+
 	@decorate_run_pipeline
 	def run_pipeline(self):
 		""" """
 
-		if config.TASK_RUNNER_AGG_DATA[constants.TASK_AGG_FILE]:
-			AggFile(task_name=constants.TASK_AGG_FILE, pipeline=self).run_task()
+		for task in self.get_tasks():
+			self.task_metrics.append(task.run())
 
@@ -0,0 +1,151 @@
+""" Runs the tasks of multiple pipelines concurrently, following the dependencies between their data stores """
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Dict, List
+
+from project_starter_lib.common import Pipeline, Task
+from project_starter_lib.utils import save_run_info, save_timings
+
+logger = logging.getLogger(__name__)
+
+
+def run_task(task: Task) -> dict:
+	""" Run a task and return its metrics. Module level function so that it can be sent to a process """
+	return task.run()
+
+
+class DagScheduler:
+	"""
+	Builds the dependency graph of the tasks of all pipelines from the data stores they read and write. A task depends
+	on every other task which writes a data store it reads. Tasks whose dependencies have completed run concurrently on
+	a thread or process pool. If a task fails, no new task is started and the error is raised.
+	"""
+
+	def __init__(self, pipelines: List[Pipeline], max_workers: int = 4, executor: str = 'thread'):
+		"""
+		Parameters
+		----------
+		pipelines
+			Pipelines to run. All their enabled tasks are scheduled
+		max_workers
+			Maximum number of tasks running at the same time
+		executor
+			thread or process
+		"""
+		assert executor in ['thread', 'process'], f"Unknown executor {executor}"
+		self.pipelines = pipelines
+		self.max_workers = max_workers
+		self.executor = executor
+		self.tasks: Dict[str, Task] = {
+			task.task_id: task
+			for pipeline in pipelines
+			for task in pipeline.get_tasks()
+		}
+		self.dependencies = self.build_dependencies()
+		self.durations: Dict[str, float] = {}
+
+	def build_dependencies(self) -> Dict[str, List[str]]:
+		"""
+		Task id -> ids of the tasks it depends on. Data stores which are not written by any scheduled task are read from
+		previous runs, so they do not create a dependency.
+		"""
+		writers: Dict[str, List[str]] = {}
+		for task_id, task in self.tasks.items():
+			for data_store_name in task.outputs:
+				writers.setdefault(data_store_name, []).append(task_id)
+
+		dependencies = {
+			task_id: sorted({
+				writer
+				for data_store_name in task.inputs
+				for writer in writers.get(data_store_name, [])
+				if writer != task_id
+			})
+			for task_id, task in self.tasks.items()
+		}
+		self.topological_order(dependencies)
+		return dependencies
+
+	def topological_order(self, dependencies: Dict[str, List[str]] = None) -> List[str]:
+		""" Task ids ordered so that every task comes after its dependencies. Raises if there is a cycle """
+		dependencies = self.dependencies if dependencies is None else dependencies
+		order, done, visiting = [], set(), []
+
+		def visit(task_id):
+			if task_id in done:
+				return
+			if task_id in visiting:
+				raise Exception(f"Cyclic dependency between tasks {visiting[visiting.index(task_id):] + [task_id]}")
+			visiting.append(task_id)
+			for dependency in dependencies[task_id]:
+				visit(dependency)
+			visiting.pop()
+			done.add(task_id)
+			order.append(task_id)
+
+		for task_id in dependencies:
+			visit(task_id)
+		return order
+
+	def critical_path(self) -> List[str]:
+		""" Chain of dependent tasks with the longest total duration """
+		finish_times, previous = {}, {}
+		for task_id in self.topological_order():
+			longest_dependency = max(self.dependencies[task_id], key=lambda x: finish_times[x], default=None)
+			previous[task_id] = longest_dependency
+			start_time = 0 if longest_dependency is None else finish_times[longest_dependency]
+			finish_times[task_id] = start_time + self.durations.get(task_id, 0)
+
+		path = []
+		task_id = max(finish_times, key=lambda x: finish_times[x], default=None)
+		while task_id is not None:
+			path.append(task_id)
+			task_id = previous[task_id]
+		return path[::-1]
+
+	def run(self):
+		""" Run all tasks """
+		for pipeline in self.pipelines:
+			logger.info(f"======={pipeline.name} Started with run_id {pipeline.current_run_id}=======")
+			save_run_info(pipeline)
+
+		logger.info(f"Running tasks {self.topological_order()} on {self.max_workers} {self.executor} workers")
+		start_time = time.perf_counter()
+
+		executor_class = ThreadPoolExecutor if self.executor == 'thread' else ProcessPoolExecutor
+		pending = dict(self.dependencies)
+		with executor_class(max_workers=self.max_workers) as executor:
+			running = {}
+			while len(pending) > 0 or len(running) > 0:
+				# Start all tasks whose dependencies have completed
+				ready = [task_id for task_id, deps in pending.items() if all(x in self.durations for x in deps)]
+				for task_id in ready:
+					logger.info(f"Starting task {task_id}")
+					running[executor.submit(run_task, self.tasks[task_id])] = task_id
+					pending.pop(task_id)
+
+				completed, _ = wait(running, return_when=FIRST_COMPLETED)
+				for future in completed:
+					task_id = running.pop(future)
+					try:
+						task_metrics = future.result()
+					except Exception:
+						logger.error(f"Task {task_id} failed. Not starting any other task")
+						for other_future in running:
+							other_future.cancel()
+						raise
+					self.durations[task_id] = task_metrics['wall_seconds']
+					self.tasks[task_id].pipeline.task_metrics.append(task_metrics)
+					logger.info(f"Completed task {task_id} in {self.durations[task_id]:.1f}s")
+
+		wall_time = time.perf_counter() - start_time
+		critical_path = self.critical_path()
+		logger.info(
+			f"Critical path: {' -> '.join(f'{x} ({self.durations[x]:.1f}s)' for x in critical_path)}. "
+			f"Total {sum(self.durations[x] for x in critical_path):.1f}s of {wall_time:.1f}s wall clock time"
+		)
+		for pipeline in self.pipelines:
+			save_run_info(pipeline, pipeline_metrics={'wall_seconds': wall_time, 'critical_path': critical_path})
+			save_timings(pipeline)
+			logger.info(f"{pipeline.name} Completed")
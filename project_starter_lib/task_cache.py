@@ -0,0 +1,88 @@
+""" Skip tasks whose inputs, configs and code have not changed since a previous run """
+import dataclasses
+import hashlib
+import json
+import logging
+from typing import Optional
+
+from project_starter_lib.config import config
+
+logger = logging.getLogger(__name__)
+
+
+class TaskCache:
+	"""
+	Ledger of successful task runs, keyed by a fingerprint of everything that determines the outputs of a task:
+	- the files of the data stores it reads (path and etag), including source files outside of the pipelines. Data
+	stores which the task also writes, e.g. the state of an incremental task, are left out, as they change in every run
+	- its section of the configs, and the file names and formats of the data stores it reads and writes
+	- the git hash of the code, and the uncommitted changes of the tracked files if any
+	If a task is about to run with a fingerprint found in the ledger, the outputs of that earlier run are published to
+	latest instead of running the task again.
+	"""
+
+	def __init__(self, task):
+		self.task = task
+		self.storage_handler = config.STORAGE_HANDLER
+
+	def fingerprint(self) -> str:
+		data_stores = self.task.get_source_data_stores() + [
+			getattr(self.task.all_data_stores, name) for name in self.task.inputs if name not in self.task.outputs
+		]
+		file_formats = {}
+		for name in sorted(set(self.task.inputs + self.task.outputs)):
+			data_store = getattr(self.task.all_data_stores, name)
+			file_format = data_store.file_format
+			file_formats[name] = [data_store.file_name, dataclasses.asdict(file_format) if file_format else None]
+		fingerprint_input = {
+			'task_id'     : self.task.task_id,
+			'data_stores' : {
+				f"{data_store.pipeline_name}/{data_store.task_name}/{data_store.file_name}": data_store.fingerprint()
+				for data_store in data_stores
+			},
+			'config'      : self.task.config_section(),
+			'file_formats': file_formats,
+			'git_hash'    : config.GIT_HASH,
+			'git_dirty'   : config.GIT_DIRTY,
+			'git_diff'    : config.GIT_DIFF_HASH,
+		}
+		return hashlib.sha256(json.dumps(fingerprint_input, sort_keys=True, default=str).encode()).hexdigest()
+
+	def ledger_path(self, fingerprint: str) -> str:
+		return f'output_data/{config.ROOT_FOLDER_NAME}/run_ledger/{self.task.task_id}/{fingerprint}.json'
+
+	def lookup(self, fingerprint: str) -> Optional[dict]:
+		""" Ledger entry of an earlier run with the same fingerprint, if any and if all its outputs still exist """
+		path = self.ledger_path(fingerprint)
+		if len(self.storage_handler.list_files(prefix=path)) == 0:
+			return None
+
+		entry = self.storage_handler.load(path=path)
+		for name in entry['outputs']:
+			if not getattr(self.task.all_data_stores, name).at_run(entry['run_id']).exists():
+				logger.info(f"Output {name} of run {entry['run_id']} of {self.task.task_id} does not exist anymore")
+				return None
+		return entry
+
+	def record(self, fingerprint: str):
+		""" Add the current run of the task to the ledger """
+		run_id = self.task.pipeline.current_run_id
+		entry = {
+			'task_id'    : self.task.task_id,
+			'fingerprint': fingerprint,
+			'run_id'     : run_id,
+			# Some outputs are only written in some modes of the task
+			'outputs'    : [
+				name for name in self.task.outputs
+				if getattr(self.task.all_data_stores, name).at_run(run_id).exists()
+			],
+		}
+		self.storage_handler.save(self.ledger_path(fingerprint), entry)
+
+	def reuse(self, entry: dict):
+		""" Point latest of every output of the task to the run in the ledger entry """
+		logger.info(f"Inputs of {self.task.task_id} did not change since run {entry['run_id']}. Reusing its outputs")
+		for name in entry['outputs']:
+			data_store = getattr(self.task.all_data_stores, name)
+			data_store.publish_to_latest(run_id=entry['run_id'])
+			del data_store.data
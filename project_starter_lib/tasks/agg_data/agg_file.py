@@ -1,27 +1,186 @@
 """ Task to Prepare Sell By Date File """
 import logging
 from datetime import timedelta
+from functools import partial
+from itertools import chain
+from typing import List
 
-import numpy as np
 import pandas as pd
 
+from project_starter_lib.aggregation import aggregate
 from project_starter_lib.common import Task
 from project_starter_lib.config import config
 from project_starter_lib.data import schemas
-from project_starter_lib.data.data_stores import DataStore, clean
+from project_starter_lib.data.data_stores import DataStore, clean, digest_rows
 
 logger = logging.getLogger(__name__)
 
+GROUP_BY_COLS = ['Key']
+AGG_SPEC = {'Value': 'sum'}
+
+# How partial aggregates of decomposable aggregations are merged into each other
+MERGE_AGGREGATIONS = {
+	'sum'  : 'sum',
+	'count': 'sum',
+	'min'  : 'min',
+	'max'  : 'max',
+}
+
+
+def is_decomposable(agg_spec: dict) -> bool:
+	""" Whether the aggregation can be computed exactly by merging partial aggregates """
+	return all(agg in MERGE_AGGREGATIONS for agg in agg_spec.values())
+
 
 class AggFile(Task):
 	""" """
+	inputs = ['ingest_file', 'aggregated_file_state']
+	outputs = ['aggregated_file', 'aggregated_file_state']
+	partition_by = GROUP_BY_COLS
+
+	def aggregate(self, df: pd.DataFrame) -> pd.DataFrame:
+		return aggregate(df, GROUP_BY_COLS, AGG_SPEC, engine=config.AGGREGATION_ENGINE)
+
+	def aggregate_partitioned(self, chunks) -> pd.DataFrame:
+		"""
+		Aggregate the chunks shard by shard on a process pool. The shards are split by the group by columns, so every
+		group is aggregated in exactly one shard and the results of the shards only need to be sorted
+		"""
+		return self.map_reduce(
+			chunks,
+			partial(aggregate, group_by_cols=GROUP_BY_COLS, agg_spec=AGG_SPEC, engine=config.AGGREGATION_ENGINE),
+			lambda df: df.sort_values(GROUP_BY_COLS, ignore_index=True),
+		)
+
+	def merge(self, df_state: pd.DataFrame, df_partial: pd.DataFrame) -> pd.DataFrame:
+		""" Fold partial aggregates into the state """
+		if df_state is None:
+			return df_partial
+		merge_spec = {col: MERGE_AGGREGATIONS[agg] for col, agg in AGG_SPEC.items()}
+		return aggregate(
+			pd.concat([df_state, df_partial], ignore_index=True),
+			GROUP_BY_COLS,
+			merge_spec,
+			engine=config.AGGREGATION_ENGINE
+		)
+
+	def _aggregate_chunks(self, chunks) -> pd.DataFrame:
+		""" Partial aggregates of the rows of the chunks. None if there are none """
+		chunks = iter(chunks)
+		first_chunk = next(chunks, None)
+		if first_chunk is None:
+			return None
+		chunks = chain([first_chunk], chunks)
+
+		if config.PARTITIONING_CONFIGS['enabled']:
+			return self.aggregate_partitioned(chunks)
+		df_agg = None
+		for chunk in chunks:
+			df_agg = self.merge(df_agg, self.aggregate(chunk))
+		return df_agg
+
+	def _appended_chunks(self, folded_parts: List[dict], parts: List[dict]):
+		"""
+		Chunks of the rows of ingest_file which were not folded into the state, found by comparing the part index of
+		ingest_file with the parts folded before. Only the parts after those are read, and the last part folded before
+		if rows were appended to it, whose rows folded before are checked against their digest.
+		:param folded_parts: Part index entries of the rows folded into the state
+		:param parts: Part index of ingest_file
+		:return: Chunks, or None if rows folded before changed
+		"""
+		ingest_file = self.all_data_stores.ingest_file
+		n_same = 0
+		while n_same < min(len(folded_parts), len(parts)) and folded_parts[n_same] == parts[n_same]:
+			n_same += 1
+
+		if n_same == len(folded_parts):
+			new_parts, first_rows = parts[n_same:], []
+		elif n_same == len(folded_parts) - 1 and n_same < len(parts) \
+				and parts[n_same]['n_rows'] > folded_parts[n_same]['n_rows']:
+			n_folded = folded_parts[n_same]['n_rows']
+			df_part = pd.concat(
+				ingest_file.iter_chunks(chunksize=config.CHUNK_SIZE, parts=parts[n_same:n_same + 1]), ignore_index=True
+			)
+			if digest_rows(df_part.iloc[:n_folded]) != folded_parts[n_same]['digest']:
+				return None
+			new_parts, first_rows = parts[n_same + 1:], [df_part.iloc[n_folded:]]
+		else:
+			return None
+
+		if len(new_parts) == 0:
+			return first_rows
+		return chain(first_rows, ingest_file.iter_chunks(chunksize=config.CHUNK_SIZE, parts=new_parts))
+
+	def run_incremental(self) -> pd.DataFrame:
+		"""
+		Aggregate the same data as the full aggregation, i.e. the ingest_file read by the pipeline, by folding only the
+		rows appended to it since the previous run into the partial aggregates saved by that run. The appended rows are
+		found from the part index written with ingest_file, see DataStore.part_index, so the rows folded before are not
+		read again. If they changed, e.g. the data was ingested again with other rows, everything is aggregated again.
+		:return: Aggregated data
+		"""
+		state_store = self.all_data_stores.aggregated_file_state
+		ingest_file = self.all_data_stores.ingest_file
+
+		folded_parts, df_state = [], None
+		if state_store.exists():
+			state = state_store.data
+			if state['agg_spec'] != AGG_SPEC or state['group_by_cols'] != GROUP_BY_COLS:
+				logger.warning("Aggregation changed since the state was saved. Aggregating all rows again")
+			# The rows folded into states without parts are not known
+			elif state.get('parts') is not None:
+				folded_parts, df_state = state['parts'], state['data']
+
+		parts = ingest_file.part_index()
+		if parts is None:
+			logger.warning(f"{ingest_file.file_name} has no part index. Aggregating all rows again")
+			chunks = None
+		else:
+			# The rows folded before are checked before anything is aggregated
+			chunks = self._appended_chunks(folded_parts, parts)
+			if chunks is None:
+				logger.warning(f"Rows folded before changed in {ingest_file.file_name}. Aggregating all rows again")
+
+		if chunks is None:
+			df_state = self._aggregate_chunks(ingest_file.iter_chunks(chunksize=config.CHUNK_SIZE))
+		else:
+			n_new_rows = sum(part['n_rows'] for part in parts) - sum(part['n_rows'] for part in folded_parts)
+			logger.info(f"Folding {n_new_rows} new rows of {ingest_file.file_name}")
+			df_new = self._aggregate_chunks(chunks)
+			if df_new is not None:
+				df_state = self.merge(df_state, df_new)
+
+		if df_state is None:
+			raise Exception("No ingested data found to aggregate")
+
+		# The state and the rows folded into it are saved together so that they never get out of sync
+		state_store.data = {
+			'agg_spec'     : AGG_SPEC,
+			'group_by_cols': GROUP_BY_COLS,
+			'parts'        : parts,
+			'data'         : df_state,
+		}
+
+		# For decomposable aggregations the merged partial aggregates are the result
+		return df_state
 
 	def run_task(self):
 		logger.info(f"{self.task_name} Task Started")
 
-		df_input_file = self.all_data_stores.ingest_file.data
+		if config.AGG_FILE_INCREMENTAL and is_decomposable(AGG_SPEC):
+			df_agg = self.run_incremental()
+		else:
+			if config.AGG_FILE_INCREMENTAL:
+				logger.warning(f"{AGG_SPEC} can not be computed incrementally. Recomputing from the full history")
+
+			if config.PARTITIONING_CONFIGS['enabled']:
+				df_agg = self.aggregate_partitioned(
+					self.all_data_stores.ingest_file.iter_chunks(chunksize=config.CHUNK_SIZE)
+				)
+			else:
+				df_input_file = self.all_data_stores.ingest_file.data
 
-		df_agg = df_input_file.groupby('Key',as_index=False).agg({'Value':'sum'})
+				df_agg = self.aggregate(df_input_file)
 
 		self.all_data_stores.aggregated_file.data = df_agg
 
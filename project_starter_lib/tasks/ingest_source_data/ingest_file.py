@@ -5,28 +5,30 @@ import logging
 from project_starter_lib.common import Task
 from project_starter_lib.config import config
 from project_starter_lib.data import schemas
-from project_starter_lib.data.data_stores import DataStore, checks, clean
+from project_starter_lib.data.data_stores import DataStore
 
 logger = logging.getLogger(__name__)
 
 
 class IngestFile(Task):
 	""" """
+	inputs = []
+	outputs = ['ingest_file']
+
+	def get_source_data_stores(self):
+		return [DataStore(file_name=config.INPUT_FILE)]
 
 	def run_task(self):
 		logger.info(f"{self.task_name} Task Started")
 
-		df = DataStore(
+		# The input file is streamed in chunks which are cleaned, checked and written one at a time so that the
+		# memory used is bounded by the chunk size and not by the size of the input file
+		chunks = DataStore(
 			file_name=config.INPUT_FILE,
 			schema=schemas.INPUT_INGEST_FILE
-		).data
-
-		df = clean(
-			df=df,
-			expected_schema=schemas.INPUT_INGEST_FILE
-		)
+		).iter_chunks(chunksize=config.CHUNK_SIZE)
 
-		checks(df=df, expected_schema=schemas.INPUT_INGEST_FILE)
-		self.all_data_stores.ingest_file.data = df
+		n_parts = self.all_data_stores.ingest_file.write_chunks(chunks)
+		logger.info(f"Wrote {n_parts} parts")
 
 		logger.info(f"{self.task_name} Task Completed")
@@ -4,14 +4,15 @@ import json
 import logging
 import os
 import shutil
-from typing import List
+from typing import List, Iterator, Tuple, Dict, Union
 
 import numpy as np
 import pandas as pd
-from joblib import parallel_backend, Parallel, delayed
 
 import project_starter_lib.data.data_stores as data_stores
+from project_starter_lib import instrumentation
 from project_starter_lib.config import config
+from project_starter_lib.data.multi_file_reader import MultiFileReader
 
 logger = logging.getLogger(__name__)
 
@@ -58,18 +59,22 @@ def convert_week_date(data: pd.Series, target: str) -> pd.Series:
 	return converted_data
 
 
-def read_all_new_data(prefix: str, schema: dict, incremental_files: List, **kwargs):
+def _new_data_file_paths(prefix: str, incremental_files: List) -> List[str]:
+	return [f'{prefix}_{file_name}.csv' for file_name in incremental_files]
+
+
+def read_all_new_data(prefix: str, schema: dict, incremental_files: List, max_workers: int = None, **kwargs):
 	"""
-    Read in all the csv files which prefix returns and return a combined dataframe
+    Read in all the csv files which prefix returns and return a combined dataframe. The files are parsed in parallel
+    on a process pool, see MultiFileReader
     :param incremental_files:
     :param schema: Schema of the csv file
     :param prefix: Prefix name of the file to search for
+    :param max_workers: Number of worker processes. Defaults to the number of cores
     :return: combined dataframe or None if no new file found
     """
 
-	files_to_store = [
-		f'{prefix}_{file_name}.csv' for file_name in incremental_files
-	]
+	files_to_store = _new_data_file_paths(prefix, incremental_files)
 
 	if len(files_to_store) == 0:
 		logger.warning("No new  file found.")
@@ -79,17 +84,82 @@ def read_all_new_data(prefix: str, schema: dict, incremental_files: List, **kwar
 	else:
 		logger.info(f"New DF will be created from {files_to_store}")
 
-		def multi_processing_func(file_path, schema, **kwargs):
-			df = data_stores.DataStore(file_name=file_path, schema=json.loads(schema), **kwargs).data
-			return df
+		df_new = MultiFileReader(files_to_store, schema=schema, max_workers=max_workers, **kwargs).read()
+	return df_new
 
-		with parallel_backend("threading", n_jobs=-1):
-			new_file_dataframes = Parallel()(
-				delayed(multi_processing_func)(filename, json.dumps(schema), **kwargs)
-				for filename in files_to_store)
 
-		df_new = pd.concat(new_file_dataframes, axis=0, ignore_index=True)
-	return df_new
+def iter_all_new_data(prefix: str, schema: dict, incremental_files: List, max_workers: int = None,
+					  **kwargs) -> Iterator[pd.DataFrame]:
+	"""
+    Same as read_all_new_data, but yields one dataframe per file instead of combining them, so that only a few files
+    have to be in memory at a time
+    :param incremental_files:
+    :param schema: Schema of the csv file
+    :param prefix: Prefix name of the file to search for
+    :param max_workers: Number of worker processes. Defaults to the number of cores
+    :return: Iterator of dataframes, in the order of incremental_files
+    """
+
+	files_to_store = _new_data_file_paths(prefix, incremental_files)
+
+	if len(files_to_store) == 0:
+		logger.warning("No new  file found.")
+		return
+
+	logger.info(f"Streaming new data from {files_to_store}")
+	yield from MultiFileReader(files_to_store, schema=schema, max_workers=max_workers, **kwargs).iter_data_frames()
+
+
+def _run_info_dir(pipeline_object) -> str:
+	return f'output_data/{config.ROOT_FOLDER_NAME}/{pipeline_object.name}/{pipeline_object.current_run_id}/' \
+		   f'pipeline_run_info'
+
+
+def save_run_info(pipeline_object, pipeline_metrics: dict = None):
+	"""
+	Save some information about the pipeline run, e.g. git hash and configs, to run_info.json of the run. Once the
+	pipeline has run, also the metrics of the pipeline and of every task, see instrumentation.Metrics
+	:param pipeline_object:
+	:param pipeline_metrics: Metrics of the whole pipeline. None if the pipeline has not run yet
+	:return:
+	"""
+
+	# Gathering some information about the pipeline and saving it
+	output_dict = {
+		'git_branch'       : config.GIT_BRANCH,
+		'git_hash'         : config.GIT_HASH,
+		'config': json.dumps(config.cfg.export(), indent=4, sort_keys=True, default=str),
+	}
+	if pipeline_metrics is not None:
+		output_dict['pipeline_metrics'] = pipeline_metrics
+		output_dict['task_metrics'] = pipeline_object.task_metrics
+
+	output_file_path = f'{_run_info_dir(pipeline_object)}/run_info.json'
+
+	output_file = data_stores.DataStore(
+		file_name=output_file_path,
+		flag_copy_to_latest=False
+	)
+	output_file.data = output_dict
+
+
+def save_timings(pipeline_object):
+	"""
+	Save the metrics of every task of the pipeline run as one row per task to timings.csv of the run
+	:param pipeline_object:
+	:return:
+	"""
+	if len(pipeline_object.task_metrics) == 0:
+		return
+
+	timings = pd.DataFrame([
+		{key: value for key, value in task_metrics.items() if key != 'data_stores'}
+		for task_metrics in pipeline_object.task_metrics
+	])
+	data_stores.DataStore(
+		file_name=f'{_run_info_dir(pipeline_object)}/timings.csv',
+		flag_copy_to_latest=False
+	).data = timings
 
 
 def decorate_run_pipeline(method):
@@ -102,24 +172,14 @@ def decorate_run_pipeline(method):
 		""" Pipeline wrapper """
 		logger.info(f"======={pipeline_object.name} Started with run_id {pipeline_object.current_run_id}=======")
 
-		# Gathering some information about the pipeline and saving it
-		output_dict = {
-			'git_branch'       : config.GIT_BRANCH,
-			'git_hash'         : config.GIT_HASH,
-			'config': json.dumps(config.cfg.export(), indent=4, sort_keys=True, default=str),
-		}
-
-		output_file_path = f'output_data/{config.ROOT_FOLDER_NAME}/{pipeline_object.name}/' \
-						   f'{pipeline_object.current_run_id}/pipeline_run_info/run_info.json'
-
-		output_file = data_stores.DataStore(
-			file_name=output_file_path,
-			flag_copy_to_latest=False
-		)
-		output_file.data = output_dict
+		save_run_info(pipeline_object)
 
 		# Running the pipeline
-		value = method(pipeline_object, *args, **kwargs)
+		with instrumentation.measure(pipeline_object.name) as pipeline_metrics:
+			value = method(pipeline_object, *args, **kwargs)
+
+		save_run_info(pipeline_object, pipeline_metrics=pipeline_metrics.to_dict())
+		save_timings(pipeline_object)
 
 		logger.info(f"{pipeline_object.name} Completed")
 
@@ -145,7 +205,8 @@ def delete_directory(path: str):
 
 def custom_agg_pandas_second_last(df):
 	"""
-    Custom Pandas aggrgator to return the second last value of a group
+    Custom Pandas aggrgator to return the second last value of a group. Called once per group, second_last computes
+    the same for all groups at once
     :param df:
     :return:
     """
@@ -158,7 +219,8 @@ def custom_agg_pandas_second_last(df):
 
 def mode_avg_custom(df):
 	"""
-    Custom pandas function to calculate the mode of a group. if two modes, take the average of the mode
+    Custom pandas function to calculate the mode of a group. if two modes, take the average of the mode. Called once
+    per group, mode_avg computes the same for all groups at once
     :param df:
     :return:
     """
@@ -167,7 +229,8 @@ def mode_avg_custom(df):
 
 def mode_max_custom(df):
 	"""
-    Custom pandas function to calculate the mode of a group. if two modes, take the min of the mode
+    Custom pandas function to calculate the mode of a group. if two modes, take the min of the mode. Called once per
+    group, mode_min computes the same for all groups at once
     :param df:
     :return:
     """
@@ -175,3 +238,184 @@ def mode_max_custom(df):
 		return pd.Series.mode(df).min()
 	else:
 		return pd.Series.mode(df).mean()
+
+
+_PANDAS_MAJOR_VERSION = int(pd.__version__.split('.')[0])
+
+
+def _missing_float_dtype(dtype: np.dtype) -> np.dtype:
+	"""
+    Dtype of the result of grouped.agg of a float column if it is missing for some groups. pandas < 3 makes float32
+    results float64 then, pandas 3 keeps float32
+    """
+	if dtype == 'float32' and _PANDAS_MAJOR_VERSION < 3:
+		return np.dtype('float64')
+	return dtype
+
+
+def _group_codes(grouped) -> Tuple[np.ndarray, pd.Index]:
+	"""
+    Number of the group of every row, -1 for rows whose keys are missing and which pandas drops, and the keys of the
+    groups in the order of their numbers
+    :param grouped: SeriesGroupBy
+    :return:
+    """
+	codes = grouped.ngroup().fillna(-1).to_numpy(dtype='int64')
+	return codes, grouped.size().index
+
+
+def _modes(grouped) -> Tuple[np.ndarray, np.ndarray, pd.Index]:
+	"""
+    Modes of every group, as pd.Series.mode: missing values are skipped and tied modes are all kept
+    :param grouped: SeriesGroupBy of a numeric column
+    :return: Group numbers and values of the modes sorted by group and value, and the keys of the groups
+    """
+	codes, group_index = _group_codes(grouped)
+	values = grouped.obj.to_numpy()
+	is_valid = (codes >= 0) & pd.notna(values)
+	codes, values = codes[is_valid], values[is_valid]
+	order = np.lexsort((values, codes))
+	codes, values = codes[order], values[order]
+
+	# Runs of equal values within a group, and how often each value occurs
+	is_run_start = np.ones(len(codes), dtype=bool)
+	is_run_start[1:] = (codes[1:] != codes[:-1]) | (values[1:] != values[:-1])
+	run_starts = np.flatnonzero(is_run_start)
+	run_codes, run_values = codes[run_starts], values[run_starts]
+	run_counts = np.diff(np.append(run_starts, len(codes)))
+	if len(run_codes) == 0:
+		return run_codes, run_values, group_index
+
+	# The modes are the values which occur as often as the most frequent value of their group
+	group_starts = np.flatnonzero(np.append(True, run_codes[1:] != run_codes[:-1]))
+	max_counts = np.maximum.reduceat(run_counts, group_starts)
+	is_mode = run_counts == np.repeat(max_counts, np.diff(np.append(group_starts, len(run_codes))))
+	return run_codes[is_mode], run_values[is_mode], group_index
+
+
+def _group_starts(codes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+	""" Start and length of every run of equal sorted codes """
+	starts = np.flatnonzero(np.append(True, codes[1:] != codes[:-1])) if len(codes) > 0 else np.array([], dtype=int)
+	return starts, np.diff(np.append(starts, len(codes)))
+
+
+def second_last(grouped) -> pd.Series:
+	"""
+    Second last value of every group, NaN if a group has a single row. Same as
+    grouped.agg(custom_agg_pandas_second_last), also the dtype, computed from the position of every row in its group
+    :param grouped: SeriesGroupBy
+    :return:
+    """
+	codes, group_index = _group_codes(grouped)
+	position_from_end = grouped.cumcount(ascending=False).fillna(-1).to_numpy(dtype='int64')
+	is_second_last = np.flatnonzero((position_from_end == 1) & (codes >= 0))
+	result = grouped.obj.iloc[is_second_last].set_axis(codes[is_second_last])
+	if len(is_second_last) == 0:
+		# Like pandas, which infers a float dtype if every group has a single row, also for bool columns
+		dtype = result.dtype if result.dtype.kind == 'f' else np.dtype('float64')
+		return pd.Series(np.nan, index=group_index, name=grouped.obj.name, dtype=_missing_float_dtype(dtype))
+	result = result.reindex(range(len(group_index))).set_axis(group_index)
+	if len(is_second_last) < len(group_index) and result.dtype.kind == 'f':
+		result = result.astype(_missing_float_dtype(result.dtype))
+	return result
+
+
+def mode_avg(grouped) -> pd.Series:
+	"""
+    Mode of every group, the average of the modes if there are several. Same as grouped.agg(mode_avg_custom), also the
+    dtype: float64 for integer and bool columns and the dtype of float columns, computed from the sorted value counts
+    of all groups
+    :param grouped: SeriesGroupBy of a numeric column
+    :return:
+    """
+	mode_codes, mode_values, group_index = _modes(grouped)
+	dtype = grouped.obj.dtype
+	sum_dtype = dtype if dtype.kind == 'f' else np.dtype('float64')
+	mode_values = mode_values.astype(sum_dtype)
+
+	starts, n_modes = _group_starts(mode_codes)
+	sums = np.empty(len(starts), dtype=sum_dtype)
+	# Groups with the same number of modes are summed row wise, which adds up the modes in the same order as
+	# pd.Series.mean, so that the averages are identical
+	for n in np.unique(n_modes):
+		is_n = np.flatnonzero(n_modes == n)
+		sums[is_n] = mode_values[starts[is_n][:, None] + np.arange(n)].sum(axis=1)
+
+	result = np.full(len(group_index), np.nan, dtype=sum_dtype)
+	result[mode_codes[starts]] = sums / n_modes.astype(sum_dtype)
+	if len(starts) < len(group_index):
+		result = result.astype(_missing_float_dtype(sum_dtype))
+	return pd.Series(result, index=group_index, name=grouped.obj.name)
+
+
+def mode_min(grouped) -> pd.Series:
+	"""
+    Mode of every group, the smallest of the modes if there are several. Same as grouped.agg(mode_max_custom), also the
+    dtype, computed from the sorted value counts of all groups
+    :param grouped: SeriesGroupBy of a numeric column
+    :return:
+    """
+	mode_codes, mode_values, group_index = _modes(grouped)
+	dtype = grouped.obj.dtype
+	starts, n_modes = _group_starts(mode_codes)
+	# Like pandas, which infers the dtype from the values returned per group: the min of tied modes has the dtype of
+	# the column, but the mean of a single mode and the NaN of a group without values are floats
+	if dtype.kind == 'f':
+		result = np.full(len(group_index), np.nan,
+						 dtype=_missing_float_dtype(dtype) if len(starts) < len(group_index) else dtype)
+	elif len(starts) == len(group_index) and (n_modes > 1).all():
+		result = np.empty(len(group_index), dtype=dtype)
+	elif dtype.kind == 'b' and (n_modes > 1).any():
+		# Bools of tied modes and floats of single modes do not have a common dtype
+		result = np.full(len(group_index), np.nan, dtype=object)
+		is_single = n_modes == 1
+		result[mode_codes[starts[~is_single]]] = mode_values[starts[~is_single]]
+		result[mode_codes[starts[is_single]]] = mode_values[starts[is_single]].astype('float64')
+		return pd.Series(result, index=group_index, name=grouped.obj.name)
+	else:
+		result = np.full(len(group_index), np.nan)
+	# The modes of a group are sorted, the first one is the smallest
+	result[mode_codes[starts]] = mode_values[starts]
+	return pd.Series(result, index=group_index, name=grouped.obj.name)
+
+
+# Vectorized aggregations which groupby_agg accepts by name, in addition to the aggregations of pandas
+CUSTOM_AGGREGATIONS = {
+	'second_last': second_last,
+	'mode_avg'   : mode_avg,
+	'mode_min'   : mode_min,
+}
+
+
+def _aggregate_column(grouped, col: str, agg) -> pd.Series:
+	if isinstance(agg, str) and agg in CUSTOM_AGGREGATIONS:
+		return CUSTOM_AGGREGATIONS[agg](grouped[col]).rename(col)
+	return grouped[col].agg(agg)
+
+
+def groupby_agg(grouped, agg_spec: Dict[str, Union[str, List[str]]] = None, **named_aggregations) -> pd.DataFrame:
+	"""
+    grouped.agg(agg_spec) or grouped.agg(**named_aggregations), where the aggregations can also be the names of
+    CUSTOM_AGGREGATIONS. E.g.
+        groupby_agg(df.groupby('Key'), {'Value': ['sum', 'second_last'], 'Price': 'mode_avg'})
+        groupby_agg(df.groupby('Key'), last_value=('Value', 'second_last'))
+    :param grouped: DataFrameGroupBy with as_index=True
+    :param agg_spec: {column: aggregation or list of aggregations}
+    :param named_aggregations: output column=(column, aggregation)
+    :return: Same columns as grouped.agg, indexed by the group keys
+    """
+	assert grouped.as_index, "Aggregate with as_index=True and reset the index of the result"
+	assert (agg_spec is None) != (len(named_aggregations) == 0), "Pass either agg_spec or named aggregations"
+
+	columns = {}
+	if agg_spec is not None:
+		for col, aggs in agg_spec.items():
+			if isinstance(aggs, (list, tuple)):
+				for agg in aggs:
+					columns[(col, agg if isinstance(agg, str) else agg.__name__)] = _aggregate_column(grouped, col, agg)
+			else:
+				columns[col] = _aggregate_column(grouped, col, aggs)
+	else:
+		for output_col, (col, agg) in named_aggregations.items():
+			columns[output_col] = _aggregate_column(grouped, col, agg)
+	return pd.concat(columns, axis=1)
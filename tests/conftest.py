@@ -0,0 +1,81 @@
+""" Fixtures of the tests
+
+The configs are read from config/config.yaml relative to the working directory when project_starter_lib is imported, so
+the tests run from the root directory of the repo, on the local storage handler in a temporary folder:
+	python -m pytest tests
+"""
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+os.chdir(REPO_ROOT)
+
+# Before project_starter_lib is imported by the tests
+os.environ['STORAGE_HANDLER'] = 'local'
+os.environ['STORAGE_LOCAL_ROOT_DIR'] = tempfile.mkdtemp(prefix='project_starter_tests_')
+
+
+def generate_input(n_rows: int, seed: int = 0) -> pd.DataFrame:
+	""" Input file of the ingest_file task, with the columns of schemas.INPUT_INGEST_FILE """
+	rng = np.random.default_rng(seed)
+	return pd.DataFrame({'Key': rng.integers(0, 1000, n_rows), 'Value': rng.integers(0, 100, n_rows)})
+
+
+class PipelineRunner:
+	""" Runs all pipelines in a new process, as main_runner does, on the local storage handler in root_dir """
+
+	def __init__(self, root_dir: str):
+		self.root_dir = root_dir
+
+	def write_input(self, df: pd.DataFrame):
+		from project_starter_lib.config import config
+		input_path = os.path.join(self.root_dir, config.INPUT_FILE)
+		os.makedirs(os.path.dirname(input_path), exist_ok=True)
+		df.to_csv(input_path, index=False)
+
+	def run(self, root_folder_name: str = 'test', **env):
+		"""
+		:param root_folder_name:
+		:param env: Environment variables of the configs, e.g. AGG_FILE_INCREMENTAL='True'
+		:return:
+		"""
+		env = dict(
+			os.environ,
+			STORAGE_HANDLER='local',
+			STORAGE_LOCAL_ROOT_DIR=self.root_dir,
+			ROOT_FOLDER_NAME=root_folder_name,
+			**env,
+		)
+		subprocess.run([sys.executable, '-m', 'project_starter_lib.main_runner', '-p', 'all'], env=env, check=True,
+					   cwd=REPO_ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+		# Run ids have a resolution of a second
+		time.sleep(1)
+
+	def timings(self, pipeline_name: str, root_folder_name: str = 'test') -> pd.DataFrame:
+		""" timings.csv of the last run of the pipeline """
+		pipeline_dir = os.path.join(self.root_dir, 'output_data', root_folder_name, pipeline_name)
+		run_id = max(x for x in os.listdir(pipeline_dir) if x not in ['latest', 'latest_pointers'])
+		return pd.read_csv(os.path.join(pipeline_dir, run_id, 'pipeline_run_info', 'timings.csv'))
+
+	def load_agg_file(self, root_folder_name: str = 'test') -> pd.DataFrame:
+		path = os.path.join(self.root_dir, 'output_data', root_folder_name, 'agg_data', 'latest', 'agg_file',
+							'agg_file.csv')
+		return pd.read_csv(path).sort_values('Key', ignore_index=True)
+
+
+@pytest.fixture
+def pipeline_runner(tmp_path) -> PipelineRunner:
+	return PipelineRunner(str(tmp_path))
+
+
+@pytest.fixture
+def local_handler(tmp_path):
+	from project_starter_lib.data.handlers.local import LocalStorageHandler
+	return LocalStorageHandler(root_dir=str(tmp_path / 'storage'))
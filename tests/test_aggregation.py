@@ -0,0 +1,59 @@
+""" Tests of the aggregation engines against pandas """
+import numpy as np
+import pandas as pd
+import pytest
+
+from project_starter_lib.aggregation import AGGREGATIONS, aggregate, choose_engine
+
+ENGINES = ['dense', 'sort', 'hash']
+AGG_SPECS = [{'a': agg, 'b': agg} for agg in AGGREGATIONS]
+
+
+def _generate(n_rows: int, key_dtype: str = 'int64', value_dtype: str = 'int8', seed: int = 0) -> pd.DataFrame:
+	rng = np.random.default_rng(seed)
+	return pd.DataFrame({
+		'k1': rng.integers(0, 50, n_rows).astype(key_dtype),
+		'k2': rng.integers(-3, 3, n_rows).astype(key_dtype),
+		# Sums of int8 values overflow int8
+		'a' : rng.integers(-100, 100, n_rows).astype(value_dtype),
+		'b' : rng.normal(size=n_rows),
+	})
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+@pytest.mark.parametrize('agg_spec', AGG_SPECS, ids=AGGREGATIONS)
+def test_engines_give_the_values_of_pandas(engine, agg_spec):
+	df = _generate(10_000)
+	for group_by_cols in [['k1'], ['k1', 'k2']]:
+		df_expected = df.groupby(group_by_cols, as_index=False).agg(agg_spec)
+		pd.testing.assert_frame_equal(aggregate(df, group_by_cols, agg_spec, engine=engine), df_expected,
+									  check_dtype=False)
+
+
+@pytest.mark.parametrize('engine', ENGINES)
+def test_dtypes_do_not_depend_on_the_values(engine):
+	# The sums of the first rows fit in int8, the sums of all rows do not
+	df = _generate(10_000)
+	agg_spec = {'a': 'sum', 'b': 'sum'}
+	dtypes = [aggregate(df_slice, ['k1'], agg_spec, engine=engine).dtypes for df_slice in [df.iloc[:1], df, df.iloc[:0]]]
+	for df_dtypes in dtypes:
+		pd.testing.assert_series_equal(df_dtypes, pd.Series({'k1': np.dtype('int64'), 'a': np.dtype('int64'),
+															   'b': np.dtype('float64')}))
+
+
+def test_unsigned_and_bool_sums():
+	df = pd.DataFrame({'k': [0, 0, 1], 'u': np.array([200, 100, 1], dtype='uint8'), 'f': [True, True, False]})
+	for engine in ENGINES:
+		df_agg = aggregate(df, ['k'], {'u': 'sum', 'f': 'sum'}, engine=engine)
+		assert df_agg['u'].tolist() == [300, 1] and df_agg['u'].dtype == np.dtype('uint64')
+		assert df_agg['f'].tolist() == [2, 0] and df_agg['f'].dtype == np.dtype('int64')
+
+
+def test_choose_engine():
+	df = _generate(1000)
+	assert choose_engine(df, ['k1'], {'a': 'sum'}) == 'dense'
+	# Too many possible keys for the dense engine
+	df['k1'] = df['k1'] * 10 ** 9
+	assert choose_engine(df, ['k1'], {'a': 'sum'}) == 'hash'
+	assert choose_engine(df.sort_values('k1'), ['k1'], {'a': 'sum'}) == 'sort'
+	assert choose_engine(df.astype({'k1': str}), ['k1'], {'a': 'sum'}) == 'hash'
@@ -0,0 +1,79 @@
+""" Tests of the read-through cache handler """
+import json
+from multiprocessing import get_context
+from typing import List
+
+import pandas as pd
+import pytest
+
+from project_starter_lib.data.handlers.cache import CachingStorageHandler
+from project_starter_lib.data.handlers.common import ObjectInfo
+from project_starter_lib.data.handlers.local import LocalStorageHandler
+
+
+class ListingStorageHandler(LocalStorageHandler):
+	""" Local handler which, like the s3 one, gives the metadata of objects from the listing. HEAD requests fail """
+
+	def head(self, path) -> ObjectInfo:
+		raise AssertionError(f"HEAD of {path}")
+
+	def list_object_infos(self, prefix) -> List[ObjectInfo]:
+		return [super(ListingStorageHandler, self).head(path) for path in self.list_files(prefix=prefix)]
+
+
+@pytest.fixture
+def storage_handler(tmp_path) -> ListingStorageHandler:
+	return ListingStorageHandler(root_dir=str(tmp_path / 'storage'))
+
+
+def _cache(storage_handler, tmp_path) -> CachingStorageHandler:
+	return CachingStorageHandler(storage_handler, cache_dir=str(tmp_path / 'cache'), max_bytes=10 ** 9)
+
+
+def _index_keys(tmp_path) -> List[str]:
+	with open(tmp_path / 'cache' / 'index.json') as f:
+		return sorted(entry['key'] for _, entry in json.load(f))
+
+
+def test_changed_object_is_downloaded_again(storage_handler, tmp_path):
+	cache = _cache(storage_handler, tmp_path)
+	storage_handler.save('data.csv', pd.DataFrame({'a': [1]}))
+	assert cache.load('data.csv')['a'].tolist() == [1]
+	assert cache.load('data.csv')['a'].tolist() == [1]
+	assert (cache.stats.misses, cache.stats.hits) == (1, 1)
+
+	storage_handler.save('data.csv', pd.DataFrame({'a': [2, 3]}))
+	assert cache.load('data.csv')['a'].tolist() == [2, 3]
+	assert cache.stats.misses == 2
+
+
+def test_files_which_are_not_listed_anymore_are_removed(storage_handler, tmp_path):
+	cache = _cache(storage_handler, tmp_path)
+	storage_handler.save('data.parquet', pd.DataFrame({'p': [0, 1, 2], 'a': [0, 1, 2]}), partition_cols=['p'])
+	assert len(cache.load('data.parquet')) == 3
+
+	# Written again with other files
+	storage_handler.delete('data.parquet')
+	storage_handler.save('data.parquet', pd.DataFrame({'p': [0, 1], 'a': [3, 4]}), partition_cols=['p'])
+	assert sorted(cache.load('data.parquet')['a'].tolist()) == [3, 4]
+	assert _index_keys(tmp_path) == sorted(storage_handler.list_files(prefix='data.parquet'))
+
+
+def _load_in_process(args):
+	storage_handler, tmp_path, path = args
+	_cache(storage_handler, tmp_path).load(path)
+
+
+def test_processes_sharing_the_cache_keep_each_others_entries(storage_handler, tmp_path):
+	paths = [f'data_{i}.csv' for i in range(8)]
+	for i, path in enumerate(paths):
+		storage_handler.save(path, pd.DataFrame({'a': [i]}))
+
+	# Every process read the index before the others wrote theirs
+	with get_context('fork').Pool(len(paths)) as pool:
+		pool.map(_load_in_process, [(storage_handler, tmp_path, path) for path in paths])
+	assert _index_keys(tmp_path) == paths
+
+	cache = _cache(storage_handler, tmp_path)
+	cache.clear()
+	assert _index_keys(tmp_path) == []
@@ -0,0 +1,44 @@
+""" Tests of the data stores """
+import pandas as pd
+
+from project_starter_lib import constants
+from project_starter_lib.config import config
+from project_starter_lib.data.data_stores import DataStore
+
+RUN_IDS = ['2026-01-01-00:00:00_agg_data', '2026-01-02-00:00:00_agg_data']
+
+
+def _data_store(storage_handler, run_id=None) -> DataStore:
+	return DataStore(
+		file_name='data.csv',
+		storage_handler=storage_handler,
+		pipeline_name=constants.PIPELINE_AGG_DATA,
+		task_name='task',
+		pipeline_current_run_ids={constants.PIPELINE_AGG_DATA: run_id},
+	)
+
+
+def test_manifest_mode_points_latest_to_the_last_run(local_handler, monkeypatch):
+	monkeypatch.setattr(config, 'LATEST_MODE', 'manifest')
+	for i, run_id in enumerate(RUN_IDS):
+		_data_store(local_handler, run_id).data = pd.DataFrame({'a': [i]})
+
+	data_store = _data_store(local_handler)
+	assert data_store.resolve_run_id('latest') == RUN_IDS[1]
+	assert data_store.data['a'].tolist() == [1]
+	# Nothing is copied
+	assert not any('/latest/' in path for path in local_handler.list_files(prefix='output_data'))
+	manifest = local_handler.load(data_store.create_manifest_path(RUN_IDS[1]))
+	assert manifest['files'] == [data_store.create_file_path(RUN_IDS[1])]
+
+
+def test_copy_mode_copies_the_last_run_to_latest(local_handler, monkeypatch):
+	monkeypatch.setattr(config, 'LATEST_MODE', 'copy')
+	for i, run_id in enumerate(RUN_IDS):
+		_data_store(local_handler, run_id).data = pd.DataFrame({'a': [i]})
+
+	data_store = _data_store(local_handler)
+	assert data_store.resolve_run_id('latest') == 'latest'
+	assert data_store.data['a'].tolist() == [1]
+	assert local_handler.list_files(prefix=data_store.create_file_path('latest')) == \
+		   [data_store.create_file_path('latest')]
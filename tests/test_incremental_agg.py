@@ -0,0 +1,69 @@
+""" Tests of the incremental aggregation of agg_file, against the full aggregation """
+import pandas as pd
+import pytest
+
+from project_starter_lib import constants
+from project_starter_lib.data.data_stores import DataStore, digest_rows
+from tests.conftest import generate_input
+
+CHUNK_SIZE = 300
+
+
+def _run_both(pipeline_runner, df: pd.DataFrame, **env):
+	""" Run all pipelines on the input, once with the full and once with the incremental aggregation """
+	pipeline_runner.write_input(df)
+	pipeline_runner.run('full', AGG_FILE_INCREMENTAL='False', CHUNK_SIZE=str(CHUNK_SIZE), **env)
+	pipeline_runner.run('incremental', AGG_FILE_INCREMENTAL='True', CHUNK_SIZE=str(CHUNK_SIZE), **env)
+	pd.testing.assert_frame_equal(pipeline_runner.load_agg_file('incremental'), pipeline_runner.load_agg_file('full'))
+
+
+def _agg_file_rows_read(pipeline_runner) -> int:
+	timings = pipeline_runner.timings('agg_data', 'incremental')
+	return int(timings.loc[timings['name'] == 'agg_data.agg_file', 'rows_read'].iloc[0])
+
+
+@pytest.mark.parametrize('partitioning_enabled', ['False', 'True'])
+def test_appended_rows_are_the_only_rows_read(pipeline_runner, partitioning_enabled):
+	df = generate_input(1000)
+	_run_both(pipeline_runner, df, PARTITIONING_ENABLED=partitioning_enabled)
+
+	df = pd.concat([df, generate_input(100, seed=1)], ignore_index=True)
+	_run_both(pipeline_runner, df, PARTITIONING_ENABLED=partitioning_enabled)
+	# The new rows and the last part folded before, to which rows were appended
+	assert _agg_file_rows_read(pipeline_runner) == 100 + 1000 % CHUNK_SIZE
+
+	_run_both(pipeline_runner, df, PARTITIONING_ENABLED=partitioning_enabled)
+	assert _agg_file_rows_read(pipeline_runner) == 0
+
+
+@pytest.mark.parametrize('change', [
+	lambda df: df.assign(Value=df['Value'].where(df.index % 7 != 0, 0)),
+	lambda df: df.iloc[500:],
+	# Rows appended to a changed last part
+	lambda df: pd.concat([df.iloc[:-1], generate_input(100, seed=1)], ignore_index=True),
+], ids=['rows changed', 'rows removed', 'last row replaced'])
+def test_changed_rows_are_aggregated_again(pipeline_runner, change):
+	df = generate_input(1000)
+	_run_both(pipeline_runner, df)
+
+	df = change(df)
+	_run_both(pipeline_runner, df)
+	# All rows, after the rows folded before were checked
+	assert _agg_file_rows_read(pipeline_runner) >= len(df)
+
+
+def test_write_chunks_indexes_the_parts(local_handler):
+	data_store = DataStore(
+		file_name='data.csv',
+		storage_handler=local_handler,
+		pipeline_name=constants.PIPELINE_AGG_DATA,
+		task_name='task',
+		pipeline_current_run_ids={constants.PIPELINE_AGG_DATA: '2026-01-01-00:00:00_agg_data'},
+		multipart=True,
+	)
+	chunks = [generate_input(3, seed=i) for i in range(2)]
+	assert data_store.write_chunks(iter(chunks)) == 2
+
+	parts = data_store.part_index()
+	assert [(part['n_rows'], part['digest']) for part in parts] == [(3, digest_rows(chunk)) for chunk in chunks]
+	assert len(list(data_store.iter_chunks(chunksize=10, parts=parts[1:]))) == 1
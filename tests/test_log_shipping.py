@@ -0,0 +1,117 @@
+""" Tests of the upload of the logs in compressed segments """
+import gzip
+import logging
+import os
+import signal
+import threading
+import time
+from typing import Dict
+
+import pyarrow as pa
+import pytest
+
+from project_starter_lib.log_shipping import LogShippingHandler
+
+
+class MemoryStorageHandler:
+	""" Keeps the uploaded segments. Uploads fail while fail is set """
+
+	def __init__(self):
+		self.saved: Dict[str, bytes] = {}
+		self.fail = False
+
+	def save(self, path, data):
+		if self.fail:
+			raise IOError("Storage is down")
+		self.saved[path] = data
+
+
+def _decompress(data: bytes, codec: str) -> str:
+	if codec == 'gzip':
+		return gzip.decompress(data).decode()
+	return pa.CompressedInputStream(pa.py_buffer(data), codec).read().decode()
+
+
+@pytest.fixture
+def logger(request):
+	logger = logging.getLogger(f'test_log_shipping.{request.node.name}')
+	logger.setLevel(logging.INFO)
+	logger.propagate = False
+	yield logger
+	for handler in list(logger.handlers):
+		logger.removeHandler(handler)
+
+
+def _add_handler(logger, storage_handler, **kwargs) -> LogShippingHandler:
+	handler = LogShippingHandler('logs/run', storage_handler=storage_handler, flush_seconds=0.05, **kwargs)
+	logger.addHandler(handler)
+	return handler
+
+
+@pytest.mark.parametrize('codec', ['gzip', 'zstd'])
+def test_segments_decompress_to_the_records(logger, codec):
+	storage_handler = MemoryStorageHandler()
+	handler = _add_handler(logger, storage_handler, codec=codec, compression_level=3, segment_bytes=100)
+	for i in range(20):
+		logger.info("line %d", i)
+		time.sleep(0.01)
+	handler.close()
+
+	assert handler.segment_paths == sorted(storage_handler.saved)
+	assert len(handler.segment_paths) > 1
+	lines = "".join(_decompress(storage_handler.saved[path], codec) for path in handler.segment_paths).splitlines()
+	assert lines == [f"line {i}" for i in range(20)]
+
+
+def test_unusable_codec_fails_at_construction():
+	with pytest.raises(AssertionError):
+		LogShippingHandler('logs/run', storage_handler=MemoryStorageHandler(), codec='lzma')
+	with pytest.raises(ValueError):
+		LogShippingHandler('logs/run', storage_handler=MemoryStorageHandler(), codec='gzip', compression_level=99)
+
+
+def test_failed_uploads_are_retried_and_capped(logger):
+	storage_handler = MemoryStorageHandler()
+	storage_handler.fail = True
+	handler = _add_handler(logger, storage_handler, segment_bytes=1, max_failed_bytes=60)
+	for i in range(5):
+		logger.info("line %d", i)
+		time.sleep(0.2)
+	assert handler.segment_paths == []
+	assert handler.n_lost_segments > 0
+
+	storage_handler.fail = False
+	logger.info("line 5")
+	handler.close()
+	lines = "".join(_decompress(storage_handler.saved[path], 'gzip') for path in handler.segment_paths).splitlines()
+	# The oldest segments were dropped
+	assert lines[-1] == "line 5" and len(lines) == 6 - handler.n_lost_segments
+
+
+def test_fork_while_the_buffer_is_locked(logger):
+	storage_handler = MemoryStorageHandler()
+	handler = _add_handler(logger, storage_handler)
+	logger.info("before fork")
+
+	# Another thread holds the lock of the buffer while the process forks
+	handler._buffer_lock.acquire()
+	threading.Timer(0.5, handler._buffer_lock.release).start()
+	pid = os.fork()
+	if pid == 0:
+		# Would wait forever for the lock, which no thread of the child releases
+		logger.info("from child")
+		handler.close()
+		os._exit(0)
+
+	deadline = time.monotonic() + 10
+	while os.waitpid(pid, os.WNOHANG) == (0, 0):
+		if time.monotonic() > deadline:
+			os.kill(pid, signal.SIGKILL)
+			os.waitpid(pid, 0)
+			pytest.fail("Child process blocked on the lock of the buffer")
+		time.sleep(0.05)
+
+	logger.info("after fork")
+	handler.close()
+	lines = "".join(_decompress(storage_handler.saved[path], 'gzip') for path in handler.segment_paths).splitlines()
+	assert lines == ["before fork", "after fork"]
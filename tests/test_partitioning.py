@@ -0,0 +1,57 @@
+""" Tests of map_reduce on a process pool """
+from functools import partial
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pytest
+
+from project_starter_lib.aggregation import aggregate
+from project_starter_lib.partitioning import map_reduce, partition_codes
+
+
+def _sort(df: pd.DataFrame) -> pd.DataFrame:
+	return df.sort_values('Key', ignore_index=True)
+
+
+def _map_reduce(chunks, agg_spec: dict) -> pd.DataFrame:
+	return map_reduce(chunks, ['Key'], partial(aggregate, group_by_cols=['Key'], agg_spec=agg_spec),
+					  reduce_function=_sort, n_partitions=16, max_workers=2)
+
+
+def test_aggregation_by_shard_is_the_aggregation_of_all_rows():
+	rng = np.random.default_rng(0)
+	n_rows = 100_000
+	df = pd.DataFrame({
+		'Key'  : rng.integers(0, 5000, n_rows).astype('int16'),
+		'Value': rng.integers(0, 100, n_rows).astype('int8'),
+		'Float': rng.normal(size=n_rows),
+	})
+	# Only the sums of some shards overflow int8
+	df.loc[df['Key'] < 10, 'Value'] = 127
+	agg_spec = {'Value': 'sum', 'Float': 'max'}
+
+	df_agg = _map_reduce([df.iloc[i::4] for i in range(4)], agg_spec)
+	pd.testing.assert_frame_equal(df_agg, aggregate(df, ['Key'], agg_spec))
+
+
+def test_missing_values_of_later_chunks():
+	chunks = [
+		pd.DataFrame({'Key': ['a', 'b', None], 'Value': [1.0, 2.0, 3.0]}),
+		# Converted with the schema of the first chunk
+		pd.DataFrame({'Key': ['a', None], 'Value': [None, None]}),
+	]
+	df = pd.concat([chunk.astype({'Value': 'float64'}) for chunk in chunks], ignore_index=True)
+	pd.testing.assert_frame_equal(_map_reduce(chunks, {'Value': 'sum'}), aggregate(df, ['Key'], {'Value': 'sum'}))
+
+
+def test_equal_keys_are_in_the_same_shard():
+	table = pa.table({'Key': ['a', 'b', None, 'a', None], 'Key2': [1, 2, 3, 1, 3]})
+	codes = partition_codes(table, ['Key', 'Key2'], n_partitions=7)
+	assert codes[0] == codes[3] and codes[2] == codes[4]
+	assert ((codes >= 0) & (codes < 7)).all()
+
+
+def test_no_rows():
+	with pytest.raises(ValueError):
+		_map_reduce([], {'Value': 'sum'})
@@ -0,0 +1,66 @@
+""" Tests of skipping tasks whose fingerprint did not change, see task_cache """
+import pandas as pd
+
+from project_starter_lib import constants
+from project_starter_lib.data.data_stores import AllDataStores
+from project_starter_lib.data.file_formats import FileFormat
+from project_starter_lib.pipelines import AggData
+from project_starter_lib.task_cache import TaskCache
+from tests.conftest import generate_input
+
+TASKS = {'ingest_source_data': 'ingest_source_data.ingest_file', 'agg_data': 'agg_data.agg_file'}
+
+
+def _reused_run_ids(pipeline_runner) -> dict:
+	""" Run id whose outputs each task reused in the last run, None if it ran """
+	reused_run_ids = {}
+	for pipeline_name, name in TASKS.items():
+		timings = pipeline_runner.timings(pipeline_name)
+		reused_run_id = timings.loc[timings['name'] == name, 'reused_run_id'].iloc[0]
+		reused_run_ids[name] = None if pd.isna(reused_run_id) else reused_run_id
+	return reused_run_ids
+
+
+def test_unchanged_tasks_are_reused_in_every_run(pipeline_runner):
+	# The state written by the incremental aggregation in every run does not change its fingerprint
+	env = dict(TASK_CACHE='True', AGG_FILE_INCREMENTAL='True')
+	df = generate_input(1000)
+	pipeline_runner.write_input(df)
+	pipeline_runner.run(**env)
+	df_agg = pipeline_runner.load_agg_file()
+	assert all(run_id is None for run_id in _reused_run_ids(pipeline_runner).values())
+
+	pipeline_runner.run(**env)
+	reused_run_ids = _reused_run_ids(pipeline_runner)
+	assert all(run_id is not None for run_id in reused_run_ids.values())
+
+	pipeline_runner.run(**env)
+	assert _reused_run_ids(pipeline_runner) == reused_run_ids
+	pd.testing.assert_frame_equal(pipeline_runner.load_agg_file(), df_agg)
+
+
+def test_changed_input_runs_the_tasks_again(pipeline_runner):
+	env = dict(TASK_CACHE='True', AGG_FILE_INCREMENTAL='True')
+	pipeline_runner.write_input(generate_input(1000))
+	pipeline_runner.run(**env)
+
+	df = generate_input(1000, seed=1)
+	pipeline_runner.write_input(df)
+	pipeline_runner.run(**env)
+	assert all(run_id is None for run_id in _reused_run_ids(pipeline_runner).values())
+	df_expected = df.groupby('Key', as_index=False)['Value'].sum()
+	pd.testing.assert_frame_equal(pipeline_runner.load_agg_file(), df_expected, check_dtype=False)
+
+
+def test_fingerprint_of_agg_file(monkeypatch):
+	pipeline = AggData(constants.PIPELINE_AGG_DATA)
+	pipeline.all_data_stores = AllDataStores({constants.PIPELINE_AGG_DATA: pipeline.current_run_id})
+	task = pipeline.get_tasks()[0]
+	fingerprint = TaskCache(task).fingerprint()
+
+	# Outputs of the task are not part of it, even if the task reads them
+	pipeline.all_data_stores.aggregated_file_state.data = {'parts': []}
+	assert TaskCache(task).fingerprint() == fingerprint
+
+	monkeypatch.setattr(pipeline.all_data_stores.aggregated_file, 'file_format', FileFormat(format='parquet'))
+	assert TaskCache(task).fingerprint() != fingerprint